@@ -0,0 +1,178 @@
+#!/usr/bin/python2.4
+#
+# Copyright 2006 Google, Inc.
+# All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License")
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+
+""" A local copy of what Google has for many accounts at once
+
+class AccountSnapshot: the accounts, by username
+class Fetcher: a thread which retrieves accounts into an AccountSnapshot
+function Fetch: retrieve accounts with several Fetchers
+"""
+
+import adaptive_concurrency
+import logging
+import Queue
+import threading
+import time
+from google.appsforyourdomain import provisioning_errs
+
+# how long a Fetcher waits before retrying a call which overloaded the
+# server; doubles with each retry
+RETRY_BASE_DELAY = 1.0
+
+
+class AccountSnapshot(object):
+
+  """ What RetrieveAccount returned for each of a set of usernames, keyed
+  by lower-cased username.  A username is either there, known to be
+  missing from Google, or unknown (Google couldn't be asked).
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._accounts = {}
+    self._unknown = set()
+
+  def Put(self, username, account):
+    """ Record what Google has for a username
+    Args:
+      username: the username
+      account: what RetrieveAccount returned, or None if there's no
+        such account
+    """
+    self._lock.acquire()
+    try:
+      self._accounts[username.lower()] = account
+    finally:
+      self._lock.release()
+
+  def PutUnknown(self, username):
+    """ Record that Google couldn't be asked about a username
+    """
+    self._lock.acquire()
+    try:
+      self._unknown.add(username.lower())
+    finally:
+      self._lock.release()
+
+  def Knows(self, username):
+    """ Whether the snapshot has the answer for a username, i.e. whether
+    Get() means anything.
+    """
+    return username.lower() in self._accounts
+
+  def Get(self, username):
+    """ What Google has for a username
+    Returns:
+      what RetrieveAccount returned, or None if there's no such account
+      (or the username isn't known; see Knows())
+    """
+    return self._accounts.get(username.lower())
+
+  def GetCounts(self):
+    """ Returns:
+      (# of accounts found, # missing, # unknown)
+    """
+    found = len([acct for acct in self._accounts.itervalues() if acct])
+    return (found, len(self._accounts) - found, len(self._unknown))
+
+
+class Fetcher(threading.Thread):
+
+  """ Takes usernames from a queue until it reads a None, and puts what
+  Google has for each in an AccountSnapshot.  A call which overloaded
+  the server is retried, up to 'max_retries' times, after which the
+  username is unknown.  Any other error is taken to mean the account
+  doesn't exist, as for SyncGoogle.FetchOneUser().
+  """
+
+  def __init__(self, api, names, snapshot, max_retries):
+    """ Constructor
+    Args:
+      api: a provisioning API object, for this thread alone
+      names: Queue.Queue of usernames
+      snapshot: the AccountSnapshot
+      max_retries: how many times to retry an overloaded call
+    """
+    threading.Thread.__init__(self)
+    self._api = api
+    self._names = names
+    self._snapshot = snapshot
+    self._max_retries = max_retries
+
+  def run(self):
+    while True:
+      username = self._names.get()
+      if username is None:
+        break
+      self._FetchOne(username)
+
+  def _FetchOne(self, username):
+    attempt = 0
+    while True:
+      try:
+        self._snapshot.Put(username, self._api.RetrieveAccount(username))
+        return
+      except provisioning_errs.ProvisioningApiError, e:
+        if not adaptive_concurrency.IsOverload(e):
+          logging.debug('%s: %s' % (username, str(e)))
+          self._snapshot.Put(username, None)
+          return
+        if attempt >= self._max_retries:
+          logging.error('cannot retrieve %s: %s' % (username, str(e)))
+          self._snapshot.PutUnknown(username)
+          return
+        attempt += 1
+        time.sleep(RETRY_BASE_DELAY * 2 ** (attempt - 1))
+
+
+def Fetch(apis, usernames, max_retries=0):
+  """ Retrieve many accounts, one Fetcher thread per API object.  The
+  time taken grows linearly with the number of usernames, divided by the
+  number of threads (or by the rate limit, if the APIs are throttled).
+  Args:
+    apis: list of provisioning API objects, one per thread
+    usernames: the usernames to retrieve; duplicates are only retrieved
+      once
+    max_retries: as for Fetcher
+  Returns:
+    AccountSnapshot
+  """
+  snapshot = AccountSnapshot()
+  names = Queue.Queue()
+  seen = set()
+  for username in usernames:
+    if username.lower() not in seen:
+      seen.add(username.lower())
+      names.put(username)
+  fetchers = []
+  for api in apis:
+    names.put(None)
+    fetcher = Fetcher(api, names, snapshot, max_retries)
+    fetcher.setName('fetcher-%d' % len(fetchers))
+    fetcher.setDaemon(True)
+    fetchers.append(fetcher)
+    fetcher.start()
+  for fetcher in fetchers:
+    fetcher.join()
+  logging.debug('snapshot: %d found, %d missing, %d unknown' %
+                snapshot.GetCounts())
+  return snapshot
+
+if __name__ == '__main__':
+  pass
@@ -0,0 +1,220 @@
+#!/usr/bin/python2.4
+#
+# Copyright 2006 Google, Inc.
+# All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License")
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+
+""" Adapts the number of threads talking to Google to how it's responding
+
+class ConcurrencyLimiter: how many workers may be busy at once
+class MeasuredAPI: a provisioning API object which reports on its calls
+"""
+
+import logging
+import threading
+import time
+
+# a call "overloaded" the server if its error contains one of these
+OVERLOAD_MARKERS = ('503', 'quota', 'unavailable', 'timed out', 'toomany')
+
+# the limit is cut by this factor when the server is overloaded
+DECREASE_FACTOR = 0.7
+
+# latency this many times the best seen counts as overloading the server
+LATENCY_TOLERANCE = 2.0
+
+# weight of each new call in the average latency
+LATENCY_WEIGHT = 0.2
+
+# the best latency creeps up by this factor on each call, so that an
+# unusually fast call long ago doesn't count forever
+BEST_LATENCY_DRIFT = 1.01
+
+# how often a waiting worker checks whether it may go ahead
+WAIT_INTERVAL = 1.0
+
+
+def IsOverload(error):
+  """ Whether an error from the provisioning API means the server is
+  overloaded, rather than that the request itself was bad.
+  Args:
+    error: the exception
+  Returns:
+    boolean
+  """
+  text = str(error).lower()
+  for marker in OVERLOAD_MARKERS:
+    if text.find(marker) >= 0:
+      return True
+  return False
+
+
+class ConcurrencyLimiter(object):
+
+  """ Limits how many of the worker threads are busy at once, adjusting
+  the limit with AIMD (additive increase, multiplicative decrease): each
+  call which goes well raises the limit by 1/limit, i.e. by about one
+  per round of calls, and a quota error, a 503, or a jump in the average
+  latency to LATENCY_TOLERANCE times the best seen cuts it by
+  DECREASE_FACTOR, at most once per round.  The latencies are kept per
+  operation, since e.g. creating an account takes much longer than
+  locking one, and a mix of the two isn't the server slowing down.  The
+  limit stays within the bounds given to SetBounds().
+  """
+
+  def __init__(self, initial=1, minimum=1, maximum=1):
+    """ Constructor
+    Args:
+      initial: the starting limit
+      minimum, maximum: bounds for the limit
+    """
+    self._condition = threading.Condition()
+    self._active = 0
+    self._minimum = 1
+    self._maximum = 1
+    self._limit = 1.0
+    # by operation
+    self._average = {}
+    self._best = {}
+    self._calls_since_decrease = 0
+    self.SetBounds(initial, minimum, maximum)
+
+  def SetBounds(self, initial, minimum, maximum):
+    """ Set new bounds for the limit, e.g. for a new batch of work.  What
+    has been learned about the server's latency is kept.
+    Args:
+      initial: the limit to start at, unless the limit has already been
+        reduced below it
+      minimum, maximum: bounds for the limit
+    """
+    self._condition.acquire()
+    try:
+      self._minimum = max(1, minimum)
+      self._maximum = max(self._minimum, maximum)
+      if not self._average:
+        self._limit = float(initial)
+      else:
+        self._limit = min(self._limit, float(initial))
+      self._Clamp()
+      self._condition.notifyAll()
+    finally:
+      self._condition.release()
+
+  def GetLimit(self):
+    """ The current limit, as a whole number of workers
+    """
+    return int(self._limit)
+
+  def Acquire(self):
+    """ Wait until another worker may be busy, and count this one as
+    busy.
+    """
+    self._condition.acquire()
+    try:
+      while self._active >= int(self._limit):
+        self._condition.wait(WAIT_INTERVAL)
+      self._active += 1
+    finally:
+      self._condition.release()
+
+  def Release(self):
+    """ Count a worker as no longer busy.
+    """
+    self._condition.acquire()
+    try:
+      self._active -= 1
+      self._condition.notify()
+    finally:
+      self._condition.release()
+
+  def Record(self, latency, overloaded=False, operation=None):
+    """ Adjust the limit for the outcome of a call to the server.
+    Args:
+      latency: how long the call took, in seconds
+      overloaded: whether it failed because the server was overloaded
+      operation: what the call was, e.g. 'LockAccount', whose latency
+        it's compared with
+    """
+    self._condition.acquire()
+    try:
+      old_limit = int(self._limit)
+      self._calls_since_decrease += 1
+      if operation not in self._average:
+        self._average[operation] = latency
+        self._best[operation] = latency
+      else:
+        self._average[operation] += LATENCY_WEIGHT * (
+            latency - self._average[operation])
+        self._best[operation] = min(
+            self._best[operation] * BEST_LATENCY_DRIFT, latency)
+      average = self._average[operation]
+      best = self._best[operation]
+      if overloaded or average > LATENCY_TOLERANCE * best:
+        # one cut per round, or a burst of errors would take us to the
+        # minimum
+        if self._calls_since_decrease >= self._limit:
+          self._limit *= DECREASE_FACTOR
+          self._calls_since_decrease = 0
+      else:
+        self._limit += 1.0 / self._limit
+      self._Clamp()
+      if int(self._limit) != old_limit:
+        logging.debug('concurrency limit now %d (%s: average latency '
+                      '%.3fs, best %.3fs)' % (int(self._limit), operation,
+                                              average, best))
+        self._condition.notifyAll()
+    finally:
+      self._condition.release()
+
+  def _Clamp(self):
+    self._limit = min(max(self._limit, float(self._minimum)),
+                      float(self._maximum))
+
+
+class MeasuredAPI(object):
+
+  """ Wraps a provisioning API object, timing each of its calls and
+  reporting them to a ConcurrencyLimiter.  Anything else is passed
+  straight through.
+  """
+
+  def __init__(self, api, limiter):
+    """ Constructor
+    Args:
+      api: a google.appsforyourdomain.provisioning.API object
+      limiter: the ConcurrencyLimiter
+    """
+    self._api = api
+    self._limiter = limiter
+
+  def __getattr__(self, name):
+    attr = getattr(self._api, name)
+    if not callable(attr):
+      return attr
+    limiter = self._limiter
+    def Measured(*args, **kwargs):
+      start = time.time()
+      try:
+        result = attr(*args, **kwargs)
+      except Exception, e:
+        limiter.Record(time.time() - start, IsOverload(e), name)
+        raise
+      limiter.Record(time.time() - start, operation=name)
+      return result
+    return Measured
+
+if __name__ == '__main__':
+  pass
@@ -49,15 +49,33 @@ class AddedUserGoogleAction(google_action.GoogleAction):
     self.attrs = None # public
     self._api = api
     self._result_queue = result_queue
+    self._sync_google = moreargs.get('vars')
 
   def Handle(self, dn, attrs):
-    """ Override of superclass.Handle() method.
+    """ Override of superclass.Handle() method.  If the pre-flight check
+    (see SyncGoogle.existing_accounts) says the account is already
+    there, it is unlocked and updated without trying to create it
+    first.
     Args:
       dn: distinguished name of the user, usually from UserDB
       attrs: dictionary of all the user's attributes
     """
     self.dn = dn
     self.attrs = attrs
+    if self._AlreadyExists():
+      try:
+        logging.debug('%s already exists; syncing attrs' %
+                      self.attrs['GoogleUsername'])
+        self._SyncExisting()
+        return
+      except Exception, e:
+        if not _IsMissing(e):
+          logging.error('error: %s' % str(e))
+          self._thread_stats.IncrementStat('add_fails', 1)
+          self._result_queue.PutResult(self.dn, 'added', str(e))
+          return
+        logging.info('%s was not there after all; creating it' %
+                     self.attrs['GoogleUsername'])
     try:
       logging.debug('about to CreateAccount for %s' % 
                     self.attrs['GoogleUsername'])
@@ -69,7 +87,10 @@ class AddedUserGoogleAction(google_action.GoogleAction):
           userdb.toUnicode(self.attrs['GoogleLastName']), 
           self.attrs['GooglePassword'],
           self.attrs['GoogleUsername'], **moreargs)
-      self._result_queue.PutResult(self.dn, 'added', None, self.attrs)
+      pushed = updated_user_google_action.Pushed(
+          updated_user_google_action.AccountFields(self.attrs))
+      self._result_queue.PutResult(self.dn, 'added', None,
+          updated_user_google_action.WithPushed(self.attrs, pushed))
       self._thread_stats.IncrementStat('adds', 1)
     except provisioning_errs.ProvisioningApiError, e:
       # report failure
@@ -79,36 +100,12 @@ class AddedUserGoogleAction(google_action.GoogleAction):
         logging.info(
            'Attempted add of existing user.  Syncing attrs instead. %s' %
            str(e))
-
-        # Make sure the account is unlocked if it is a valid user.
-        # Note: users are exited in only one of two ways:
-        # 1) the user matches an exit filter
-        # 2) the user disappeared from the ldap search filter that lists all 
-        #    users
-        # This method is never called on an account in state #1.  
-        # Consequently, we can safely unlock this account since
-        # it must have reappeared in our ldap query result (hence rebecame a 
-        # user) in order to be added.
-        logging.info('Making sure this account unlocked: %s' %
-            self.attrs['GoogleUsername'])
-        self._api.UnlockAccount(self.attrs['GoogleUsername'])
-
-        logging.debug('Updating account %s' % self.dn)
-        # Make sure that the user's attributes are synced because there is 
-        # no other time that this will get done.
         try:
-          updated_user_google_action.Update(self._api, attrs)
+          self._SyncExisting()
         except Exception, e:
           logging.error('error during update: %s' % str(e)) 
           self._thread_stats.IncrementStat('add_fails', 1)
           self._result_queue.PutResult(self.dn, 'added', str(e))
-          return
-
-        logging.debug('Marking account %s add a success' % self.dn)
-
-        # trying to add a user that is already there is not an error
-        self._result_queue.PutResult(self.dn, 'added', None, self.attrs)
-        self._thread_stats.IncrementStat('adds', 1)
         return
 
       logging.error('error: %s' % str(e))
@@ -120,5 +117,54 @@ class AddedUserGoogleAction(google_action.GoogleAction):
       self._thread_stats.IncrementStat('add_fails', 1)
       self._result_queue.PutResult(self.dn, 'added', str(e))
 
+  def _AlreadyExists(self):
+    """ Whether the pre-flight check found the user's account in Google
+    """
+    existing = getattr(self._sync_google, 'existing_accounts', None)
+    if not existing:
+      return False
+    return self.attrs['GoogleUsername'].lower() in existing
+
+  def _SyncExisting(self):
+    """ Bring an account which is already in Google up to date, and
+    report success
+    Raises:
+      provisioning_errs.ProvisioningApiError: from the unlock or update
+    """
+    # Make sure the account is unlocked if it is a valid user.
+    # Note: users are exited in only one of two ways:
+    # 1) the user matches an exit filter
+    # 2) the user disappeared from the ldap search filter that lists all 
+    #    users
+    # This method is never called on an account in state #1.  
+    # Consequently, we can safely unlock this account since
+    # it must have reappeared in our ldap query result (hence rebecame a 
+    # user) in order to be added.
+    logging.info('Making sure this account unlocked: %s' %
+        self.attrs['GoogleUsername'])
+    self._api.UnlockAccount(self.attrs['GoogleUsername'])
+
+    logging.debug('Updating account %s' % self.dn)
+    # Make sure that the user's attributes are synced because there is 
+    # no other time that this will get done.  Whatever meta-Google-pushed
+    # says was sent before, the account may have been changed since.
+    pushed = updated_user_google_action.Update(self._api, self.attrs,
+                                               force=True)
+
+    logging.debug('Marking account %s add a success' % self.dn)
+
+    # trying to add a user that is already there is not an error
+    self._result_queue.PutResult(self.dn, 'added', None,
+        updated_user_google_action.WithPushed(self.attrs, pushed))
+    self._thread_stats.IncrementStat('adds', 1)
+
+
+def _IsMissing(error):
+  """ Whether an error from the provisioning API means the account isn't
+  there
+  """
+  return (str(error).find('InvalidEmailException') >= 0 or
+          str(error).find('Object does not exist') >= 0)
+
 if __name__ == '__main__':
   pass
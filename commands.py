@@ -30,10 +30,12 @@ class Commands: main class, subclass of the Python cmd.Cmd class
 
 import cmd
 import last_update_time
+import ldap_ctxt
 import logging
 import messages
 import os
 from google.appsforyourdomain import provisioning
+from google.appsforyourdomain import provisioning_errs
 import pprint
 import time
 import userdb
@@ -44,6 +46,13 @@ pp = pprint.PrettyPrinter(indent=2)
 # the most user records to be displayed at a time
 MAX_USER_DISPLAY = 32
 
+# timestamp attributes only an AD directory has
+AD_ONLY_TIMESTAMPS = ('whenChanged', 'uSNChanged')
+
+# the attributes a user needs for a comparison with Google
+TWO_WAY_ATTRS = ('GoogleFirstName', 'GoogleLastName', 'GoogleUsername',
+                 'GooglePassword', 'GoogleQuota')
+
 class Commands(cmd.Cmd):
 
   """ main class, subclass of the Python cmd.Cmd class.
@@ -77,7 +86,6 @@ class Commands(cmd.Cmd):
     self.sync_google = google
     self._config = config
 
-    self.new_users = None
     self.last_update = None
 
     # stuff needed by the Cmd superclass:
@@ -183,7 +191,7 @@ class Commands(cmd.Cmd):
     if len(args):
       self.ldap_context.SetUserFilter(args)
     try:
-      self.new_users = self.ldap_context.Search(attrlist=['cn'])
+      count = self.ldap_context.CountUsers()
     except RuntimeError,e:
       logging.exception('**Error: %s\n', str(e))
       return
@@ -191,34 +199,22 @@ class Commands(cmd.Cmd):
       logging.exception(str(e))
       return
 
-    if not self.new_users or self.new_users.UserCount() == 0:
+    if not count:
       print messages.msg(messages.MSG_FIND_USERS_RETURNED, "0")
       return
 
-    print messages.msg(messages.MSG_FIND_USERS_RETURNED, 
-                       str(self.new_users.UserCount()))
+    print messages.msg(messages.MSG_FIND_USERS_RETURNED, str(count))
 
-    # do it again with a small set, but get all attrs this time
+    # now get all attrs, but only on a sample
     try:
       print messages.msg(messages.ERR_TEST_FILTER_SAMPLING)
-      sample_full_attrs = self.ldap_context.Search(rest,
-           min(10, self.new_users.UserCount()))
+      (sample_full_attrs, full_attr_set) = self._SampleAttributes()
       if not sample_full_attrs:
         return
-
-      # and since 'all attrs' doesn't include important stuff like
-      # the modifyTimestamp, we have to do that separately:
-      sample_top_attrs = self.ldap_context.Search(rest, 1, ['+'])
-      if not sample_top_attrs:
-        return
     except utils.ConfigError,e:
       logging.error(str(e))
       return
 
-    # and then union the two sets:
-    full_attr_set = sample_full_attrs.GetAttributes()
-    top = sample_top_attrs.GetAttributes()
-    full_attr_set.extend(top)
     print messages.msg(messages.MSG_TEST_FILTER_ATTRS)
     pp.pprint(full_attr_set)
     (self.trialAttrs, self.trialMappings) = sample_full_attrs.SuggestAttrs()
@@ -260,6 +256,42 @@ class Commands(cmd.Cmd):
         print messages.msg(messages.ERR_YES_OR_NO)
 
 
+  def _SampleAttributes(self):
+    """ Find out which attributes the users passing the filter have, from
+    one user, with its operational attributes (like the modifyTimestamp,
+    which 'all attrs' doesn't include), plus whatever the server's schema
+    allows for that user's object classes.  If the server won't return
+    both kinds of attribute at once, a sample of ten users and one with
+    just its operational attributes are used instead.
+    Returns:
+      a UserDB of the sample users, and a list of the attribute names;
+      or (None, None) if the searches failed
+    """
+    sample = self.ldap_context.Search(None, 1, ['*', '+'])
+    if sample and sample.UserCount():
+      attr_set = sample.GetAttributes()
+      attrs = sample.LookupDN(sample.UserDNs()[0])
+      object_classes = attrs.get('objectClass', [])
+      if not isinstance(object_classes, list):
+        object_classes = [object_classes]
+      schema_attrs = self.ldap_context.GetSchemaAttributes(object_classes)
+      if schema_attrs:
+        for attr in schema_attrs:
+          if attr not in attr_set:
+            attr_set.append(attr)
+      attr_set.sort()
+      return (sample, attr_set)
+
+    sample = self.ldap_context.Search(None, 10)
+    if not sample:
+      return (None, None)
+    sample_top_attrs = self.ldap_context.Search(None, 1, ['+'])
+    if not sample_top_attrs:
+      return (None, None)
+    attr_set = sample.GetAttributes()
+    attr_set.extend(sample_top_attrs.GetAttributes())
+    return (sample, attr_set)
+
   def help_testFilter(self):
     print messages.msg(messages.HELP_TEST_FILTER)
 
@@ -282,18 +314,59 @@ class Commands(cmd.Cmd):
         self.last_update = self._TimeFromLDAPTime(last_update_time.get())
 
       logging.debug('last_update time=%s' % str(self.last_update))
-      attrs = self.users.GetAttributes()
-      directory_type = _GetDirectoryType(attrs)
+      attrs = self.users.GetSearchAttributes()
+      directory_type = _GetDirectoryType(self.users.GetAttributes(),
+                                         self.users.GetTimestampAttributeName())
       if self.last_update:
         search_filter = self._AndUpdateTime(search_filter,
                    self.users.GetTimestampAttributeName(), self.last_update,
                    directory_type)
+
+      # the changed users, the exited users and the complete list of DNs
+      # don't depend on each other, so search for them all at once.  If
+      # the LDAP context can track changes itself, it tells us the deleted
+      # users too, so there's no need to search for all of them.
+      tracking_changes = self.ldap_context.IsTrackingChanges()
+      if tracking_changes:
+        searches = [('SearchChanges', {'attrlist': attrs})]
+      else:
+        searches = [('Search', {'filter_arg': search_filter,
+                                'attrlist': attrs})]
+      exits_search = self._ExitedUsersSearch(attrs)
+      if exits_search:
+        searches.append(exits_search)
+      if not tracking_changes:
+        searches.append(('Search', {'filter_arg': None, 'attrlist': []}))
       try:
-        found_users = self.ldap_context.Search(filter_arg=search_filter,
-                                attrlist=attrs)
+        results = self.ldap_context.ConcurrentSearch(searches)
       except RuntimeError,e:
         logging.exception(str(e))
         return
+      all_users = None
+      deleted_users = None
+      if tracking_changes:
+        (found_users, deleted_users) = results[0]
+        if deleted_users is None:
+          # the context's first run: it found everyone, and the users not
+          # among them are the deleted ones
+          all_users = found_users
+      else:
+        found_users = results[0]
+        all_users = results[-1]
+      userdb_exits = None
+      if exits_search:
+        userdb_exits = results[1]
+      if (found_users is None or (exits_search and userdb_exits is None) or
+          (not tracking_changes and all_users is None)):
+        # a partial picture of LDAP could make users look deleted
+        logging.error(messages.ERR_LDAP_SEARCH_FAILED)
+        last_update_time.reportError()
+        return
+
+      # users who've lost their Google username to a changed user (from
+      # another LDAP source) belong to nobody now
+      for dn in self.ldap_context.PopSuperseded():
+        self.users.DeleteUser(dn)
 
       if not found_users or found_users.UserCount() == 0:
         print messages.msg(messages.MSG_FIND_USERS_RETURNED, "0")
@@ -323,7 +396,8 @@ class Commands(cmd.Cmd):
                              (str(len(renames))))
 
       # find exited users & lock their accounts
-      self._FindExitedUsers()
+      self._FindExitedUsers(exits_search, userdb_exits, all_users,
+                            deleted_users)
     except utils.ConfigError, e:
       logging.error(str(e))
 
@@ -558,6 +632,8 @@ class Commands(cmd.Cmd):
       does not fetch the list of users from Google and compare.  (in a future 
       version of the Provisioning API, this will be feasible;  right now (late 
       2006), it would be too slow.
+    reconcileUsers: the two-way comparison of syncOneUser, for all users at
+      once.  It only re-marks the users;  syncAllUsers then syncs them.
   """
 
 
@@ -631,7 +707,10 @@ class Commands(cmd.Cmd):
       ans = raw_input(messages.MSG_PROCEED_TO_APPLY)
       if ans[:1] != messages.CHAR_YES:
         return
-    self.sync_google.DoAction(act, dn)
+    try:
+      self.sync_google.DoAction(act, dn)
+    finally:
+      self.sync_google.StopWorkers()
 
   def help_syncOneUser(self):
     print messages.HELP_SYNC_ONE_USER
@@ -663,20 +742,82 @@ class Commands(cmd.Cmd):
       return
 
     try:
-      for action in actions:
-        stats = self.sync_google.DoAction(action)
+      try:
+        stats = self.sync_google.DoActions(actions)
         if stats is not None:
           self._ShowSyncStats(stats)
 
-    except utils.ConfigError, e:
-      logging.error(str(e))
-      return
+      except utils.ConfigError, e:
+        logging.error(str(e))
+        return
+    finally:
+      self.sync_google.StopWorkers()
 
     last_update_time.updateIfNoErrors()
 
   def help_syncAllUsers(self):
     print messages.HELP_SYNC_USERS_GOOGLE
 
+  # *******************                    reconcileUsers command
+  def do_reconcileUsers(self, rest):
+    """ Retrieve the Google account of every user in the UserDB (under
+    both their current and old usernames) into a snapshot, then join the
+    two on GoogleUsername and correct every user's meta-Google-action, as
+    syncOneUser does for one.  The snapshot is a dictionary, so the join
+    is one lookup per user, and the whole thing takes time in proportion
+    to the number of users.
+    Args:
+      -f:  "force" acceptance by the user, as for syncOneUser
+    """
+    (unused_args, force_accept) = self._ProcessArgs(rest)
+    errs = self.sync_google.TestConnectivity()
+    if errs:
+      logging.error(messages.msg(messages.ERR_CONNECTING_GOOGLE, errs))
+      return
+
+    dns = self.users.UserDNs()
+    usernames = []
+    for dn in dns:
+      attrs = self.users.LookupDN(dn)
+      for attr in ('GoogleUsername', 'meta-Google-old-username'):
+        if attrs.get(attr):
+          usernames.append(attrs[attr])
+    print messages.msg(messages.MSG_RECONCILE_FETCHING, str(len(usernames)))
+    try:
+      snapshot = self.sync_google.TakeSnapshot(usernames)
+    except (provisioning_errs.ProvisioningApiError, utils.ConfigError), e:
+      logging.error(str(e))
+      return
+    print messages.msg(messages.MSG_RECONCILE_SNAPSHOT, snapshot.GetCounts())
+
+    corrections = {}
+    counts = {}
+    for dn in dns:
+      current = self.users.LookupDN(dn).get('meta-Google-action')
+      act = self._ReconcileUser(dn, snapshot)
+      if act != current:
+        corrections[dn] = act
+        counts[(current, act)] = counts.get((current, act), 0) + 1
+    if not corrections:
+      print messages.MSG_RECONCILE_NO_CHANGES
+      return
+    changes = counts.keys()
+    changes.sort()
+    for (current, act) in changes:
+      print messages.msg(messages.MSG_RECONCILE_CHANGE,
+                         (counts[(current, act)], current, act))
+
+    if not force_accept:  # normal case: ask the human
+      ans = raw_input(messages.MSG_RECONCILE_PROCEED)
+      if ans[:1] != messages.CHAR_YES:
+        return
+    for (dn, act) in corrections.iteritems():
+      self.users.SetGoogleAction(dn, act)
+    print messages.msg(messages.MSG_RECONCILE_APPLIED, str(len(corrections)))
+
+  def help_reconcileUsers(self):
+    print messages.HELP_RECONCILE_USERS
+
   """
   ******************  Reading and writing the users to a file
   Commands:
@@ -777,11 +918,13 @@ class Commands(cmd.Cmd):
   _AndUpdateTime
   _ChooseFromList
   _CompareWithGoogle
+  _ExitedUsersSearch
   _FetchOneUser
   _FindExitedUsers
   _FindOneUser
   _GetNumArgs
   _ProcessArgs
+  _ReconcileUser
   _SetSuggestedAttrs
   _SetSuggestedMappings
   _ShowGoogleAttributes
@@ -833,20 +976,10 @@ class Commands(cmd.Cmd):
       stamp = self._testing_last_update
     else:
       stamp = ts
-    # NOTE: The following table summarizes the format the modifyTimestamp
-    #       filter needs to be in for various directories
-    #
-    #                    %sZ  %s.Z   %s.0Z
-    #  ad                 N     Y      Y
-    #  edirectory         Y     N      N
-    #  openldap           Y     N      Y
-    if directoryType == 'ad':
-      cond = '%s>=%s.Z' % (timeStampAttr, time.strftime('%Y%m%d%H%M%S',
-                          time.localtime(stamp)))
-    else:
-      cond = '%s>=%sZ' % (timeStampAttr, time.strftime('%Y%m%d%H%M%S',
-                          time.localtime(stamp)))
-    s = "(&%s(%s))" % (search_filter, cond)
+    s = ldap_ctxt.TimestampFilter(search_filter, timeStampAttr,
+                                  time.strftime('%Y%m%d%H%M%S',
+                                                time.localtime(stamp)),
+                                  directoryType)
     logging.debug("new filter is: %s" % s)
     return s
 
@@ -913,47 +1046,61 @@ class Commands(cmd.Cmd):
       self._PrintGoogleUserRec(user_rec)
     return user_rec
 
-  def _FindExitedUsers(self):
+  def _ExitedUsersSearch(self, attrs):
+    """ The search for "exited" users, if we have a special filter for
+    that.  The LDAP context builds it (a CompositeContext does so for
+    each source, with the source's own timestamp and last update time).
+    Args:
+      attrs: attributes to return for each user
+    Returns:
+      a (method, kwargs) tuple for ConcurrentSearch(), or None if
+      there's no such filter
+    """
+    timestamp = self.users.GetTimestampAttributeName()
+    directory_type = _GetDirectoryType(self.users.GetAttributes(), timestamp)
+    if self._testing_last_update:
+      stamp = self._testing_last_update
+    else:
+      stamp = self.last_update
+    since = time.strftime('%Y%m%d%H%M%S', time.localtime(stamp))
+    return self.ldap_context.ExitedUsersSearch(attrs, timestamp, since,
+                                               directory_type)
+
+  def _FindExitedUsers(self, exits_search, userdb_exits, all_users,
+                       deleted_users=None):
     """
-    Finding "exited" users: if we have a special filter for that, use it.
-    Else do the search without the "> lastUpdate" filter, to find
-    users no longer in the DB.
+    Finding "exited" users: if we have a special filter for that, use
+    the users it found.  Else use the search without the "> lastUpdate"
+    filter, to find users no longer in the DB.
     Even if we DO have a ldap_disabled_filter, still check for deleted
     entries, since you never know what might have happened.
-
+    Args:
+      exits_search: return value of _ExitedUsersSearch()
+      userdb_exits: UserDB of the users found by exits_search, if any
+      all_users: UserDB of all the users passing the ldap_user_filter
+      deleted_users: list of DNs deleted from LDAP, if the LDAP context
+        tracks changes.  If given, all_users is not used.
     """
     total_exits = 0
-    if (self.ldap_context.ldap_disabled_filter and 
-        self.users.GetTimestampAttributeName()):
-      attrs = self.users.GetAttributes()
-      directory_type = _GetDirectoryType(attrs)
-      search_filter = self._AndUpdateTime(
-          self.ldap_context.ldap_disabled_filter, 
-          self.users.GetTimestampAttributeName(), self.last_update,
-          directory_type)
-      try:
-        logging.debug(messages.msg(messages.MSG_FIND_EXITS,
-                                   self.ldap_context.ldap_disabled_filter))
-        userdb_exits = self.ldap_context.Search(filter_arg=search_filter,
-                                                attrlist=attrs)
-        if not userdb_exits:
-          return
-        logging.debug('userdb_exits=%s' % userdb_exits.UserDNs())
-        exited_users = userdb_exits.UserDNs()
-        for dn in exited_users:
-          # Note: users previously marked added can be reset to exited
-          # if they match the exit filter.  This ensures 
-          # added_user_google_action is never called on a locked user that 
-          # exists in Google Apps 
-          self.users.SetGoogleAction(dn, 'exited')
-          total_exits += 1
-      except RuntimeError,e:
-        logging.exception(str(e))
+    if exits_search:
+      if not userdb_exits:
         return
+      logging.debug('userdb_exits=%s' % userdb_exits.UserDNs())
+      exited_users = userdb_exits.UserDNs()
+      for dn in exited_users:
+        # Note: users previously marked added can be reset to exited
+        # if they match the exit filter.  This ensures 
+        # added_user_google_action is never called on a locked user that 
+        # exists in Google Apps 
+        self.users.SetGoogleAction(dn, 'exited')
+        total_exits += 1
 
     # Also: find ALL the users, and see which old ones are no longer
     # there:
-    exited_users = self.users.FindDeletedUsers(self.ldap_context)
+    if deleted_users is not None:
+      exited_users = self.users.FilterDeletedUsers(deleted_users)
+    else:
+      exited_users = self.users.FindDeletedUsers(self.ldap_context, all_users)
     if not exited_users:
       return
     logging.debug('deleted users=%s' % str(exited_users))
@@ -975,12 +1122,13 @@ class Commands(cmd.Cmd):
     """
     try:
       user_hits = self.ldap_context.Search(filter_arg=expr,
-                                   attrlist=self.users.GetAttributes())
+                                   attrlist=self.users.GetSearchAttributes())
     except RuntimeError, e:
       logging.error(str(e))
       return
     if not user_hits:
       print messages.msg(messages.MSG_FIND_USERS_RETURNED, '0')
+      return
     count = user_hits.UserCount()
     dns = user_hits.UserDNs()
     if count == 0:
@@ -1041,6 +1189,51 @@ class Commands(cmd.Cmd):
     args = args.strip().lower()
     return (args, force)
 
+  def _ReconcileUser(self, dn, snapshot):
+    """ For the reconcileUsers command: the right action for a user, given
+    what Google has.  A user with an action pending gets the same answer
+    as from _TwoWayCompare().  One with nothing pending is checked for
+    drift:  if Google has no account for them, they're 'added' (or
+    'renamed', if the account is still under their old username), and if
+    the account differs from the UserDB, they're 'updated'.
+    Args:
+      dn: DN of the user
+      snapshot: account_snapshot.AccountSnapshot with the user's
+        GoogleUsername and meta-Google-old-username in it
+    Return:
+      act: one of ('added','exited','renamed','updated', None), or the
+        user's current meta-Google-action if there's no telling (Google
+        couldn't be asked, the user has been exited already, or lacks
+        some of TWO_WAY_ATTRS)
+    """
+    attrs = self.users.LookupDN(dn)
+    current = attrs.get('meta-Google-action')
+    if current == 'previously-exited':
+      return current
+    for gattr in TWO_WAY_ATTRS:
+      if gattr not in attrs:
+        return current
+    username = attrs['GoogleUsername']
+    if not snapshot.Knows(username):
+      return current
+    google_result = snapshot.Get(username)
+    google_result_old = None
+    old_username = attrs.get('meta-Google-old-username')
+    if old_username and old_username.lower() != username.lower():
+      if not snapshot.Knows(old_username):
+        return current
+      google_result_old = snapshot.Get(old_username)
+
+    if current:
+      return self._TwoWayCompare(dn, google_result, google_result_old)
+    if not google_result:
+      if google_result_old:
+        return 'renamed'
+      return 'added'
+    if self._CompareWithGoogle(attrs, google_result):
+      return 'updated'
+    return None
+
   def _SetSuggestedAttrs(self):
     self.users.RemoveAllAttributes()
     for attr in self.trialAttrs:
@@ -1080,6 +1273,9 @@ class Commands(cmd.Cmd):
     if stats['updates'] > 0 or stats['update_fails'] > 0:
       print messages.msg(messages.MSG_UPDATE_RESULTS, (stats['updates'],
                          stats['update_fails']))
+    if stats.get('throttled_seconds'):
+      print messages.msg(messages.MSG_THROTTLED_RESULTS,
+                         stats['throttled_seconds'])
 
   def _SplitExpression(self, expr):
     """ For an admin-typed expression, e.g. givenName=joe, split it
@@ -1140,8 +1336,7 @@ class Commands(cmd.Cmd):
       act: one of ('added','exited','renamed','updated', None)
     """
     attrs = self.users.LookupDN(dn)
-    for gattr in ['GoogleFirstName', 'GoogleLastName', 'GoogleUsername',
-                  'GooglePassword', 'GoogleQuota']:
+    for gattr in TWO_WAY_ATTRS:
       if gattr not in attrs:
         logging.error(messages.msg(messages.ERR_NO_ATTR_FOR_USER, gattr))
         return
@@ -1196,8 +1391,16 @@ class Commands(cmd.Cmd):
       ft = None
     return ft
 
-def _GetDirectoryType(attrs):
+def _GetDirectoryType(attrs, timestamp=None):
+  """ Tell an AD directory from the others
+  Args:
+    attrs: the attributes the directory has returned, i.e.
+      UserDB.GetAttributes() rather than what's asked for in a search
+    timestamp: the timestamp attribute, if any
+  Returns:
+    'ad' or 'openldap'
+  """
   directory_type = 'openldap'
-  if 'sAMAccountName' in attrs:
+  if 'sAMAccountName' in attrs or timestamp in AD_ONLY_TIMESTAMPS:
     directory_type = 'ad'
   return directory_type
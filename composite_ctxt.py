@@ -0,0 +1,523 @@
+#!/usr/bin/python2.4
+#
+# Copyright 2006 Google, Inc.
+# All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License")
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+
+""" Several LDAP servers as a single source of users
+
+class CompositeContext: an LdapContext which searches several servers
+class SourceContext: the LdapContext for one of those servers
+
+Each server ("source") is configured by a dictionary in the ldap_sources
+list, which can set any of the LdapContext or UserDB variables (ldap_url,
+ldap_base_dn, ldap_user_filter, timestamp, ...) for that source alone;
+anything not set is taken from the main configuration.  A source can
+also have a 'name', used for its state files (default: its position in
+the list), and a 'directory_type' of 'ad' or 'openldap' (default: 'ad'
+if its timestamp is whenChanged).
+
+All the sources are searched at once, each on its own connection, and
+each keeps its own state (last update time and DNs, or its syncrepl or
+USN state), so a source added later is searched in full without the
+others being.  The state is only saved if the whole run is good: if any
+source can't be searched, the run is abandoned and no source's state
+moves, since a partial picture could make users look deleted.
+
+If users map to the same GoogleUsername, the one from the source listed
+first wins, and within a source, the one with the smaller DN.  That
+goes for the users already in the UserDB too, whose source is kept in
+their meta-ldap-source attribute: a changed user who loses to one of
+them is skipped, and one who wins takes the username over, the loser
+being dropped from the UserDB (not exited, since the account is the
+winner's now) by the caller, once all the run's searches have succeeded
+(see PopSuperseded).
+
+The users disabled since the last run (see ExitedUsersSearch) are found
+on each source with its own ldap_disabled_filter, timestamp attribute
+and last update time.
+"""
+
+import copy
+import last_update_time
+import ldap_ctxt
+import logging
+import messages
+import userdb
+import utils
+
+
+class CompositeContext(ldap_ctxt.LdapContext):
+
+  """ An LdapContext which merges the users from several LDAP servers.
+  It always tracks changes itself (see SearchChanges), since every
+  source has its own last update time.  Its own LdapContext variables,
+  e.g. ldap_user_filter, are the defaults for the sources.
+  """
+  config_parms = ldap_ctxt.LdapContext.config_parms.copy()
+  config_parms.update({'ldap_sources': messages.MSG_LDAP_SOURCES})
+
+  def __init__(self, config, users=None, **moreargs):
+    """ Constructor
+    Args:
+      config: a utils.Config object, which should have been initialized with
+        the Sync Tool's configuration.
+      users: the UserDB the changes will be merged into, whose users'
+        Google usernames the changed users are checked against
+    """
+    self.ldap_sources = []
+    super(CompositeContext, self).__init__(config, **moreargs)
+    self._required_config = ['ldap_sources']
+    self.contexts = []
+    self.users = users
+    self.superseded = []
+
+  def SetConfigVar(self, attr, val):
+    """ Overrides: the superclass method.  ldap_sources has to be set in
+    the config file.
+    """
+    if attr == 'ldap_sources':
+      return messages.ERR_NO_SET_SOURCES
+    return super(CompositeContext, self).SetConfigVar(attr, val)
+
+  def Connect(self):
+    """ Overrides: the superclass method.  Connects to every source.
+    Returns:
+      None if success, -1 if error occurred
+    Raises:
+      utils.ConfigError: if any required config items are not
+        present.
+    """
+    self._config.TestConfig(self, self._required_config)
+    if not self.contexts:
+      self.contexts = self._MakeContexts()
+    for ctxt in self.contexts:
+      if not ctxt.conn and ctxt.Connect():
+        logging.error('Cannot connect to source %s (%s)' %
+                      (ctxt.name, ctxt.ldap_url))
+        return -1
+    # stands in for the connection, so "connected" means what it does for
+    # the superclass
+    self.conn = self.contexts
+    return None
+
+  def Disconnect(self):
+    """ Overrides: the superclass method.  Disconnects from every source.
+    """
+    for ctxt in self.contexts:
+      ctxt.Disconnect()
+    self.conn = None
+
+  def _Clone(self):
+    """ Overrides: the superclass method.  The copy gets new connections
+    to every source.
+    """
+    clone = copy.copy(self)
+    clone.contexts = []
+    clone.conn = None
+    for ctxt in self.contexts:
+      source = ctxt._Clone()
+      if not source:
+        clone.Disconnect()
+        return None
+      clone.contexts.append(source)
+    clone.conn = clone.contexts
+    return clone
+
+  def IsTrackingChanges(self):
+    """ Overrides: the superclass method.
+    """
+    return True
+
+  def Search(self, filter_arg=None, sizelimit=0, attrlist=None):
+    """ Overrides: the superclass method.  Searches all the sources at
+    once and merges the results.
+    Args:
+      filter_arg: LDAP search filter to use. If not provided, each
+        source's own ldap_user_filter is used.
+      sizelimit: limits the number of users returned from each source.
+        If zero, all users matching the filter are returned
+      attrlist: attributes to return for each user.  If None, all
+        attribute are returned
+    Returns:
+      a UserDB, or None if the search of any source failed
+    Raises:
+      utils.ConfigError: if any required config items are not present
+      RuntimeError:  if not connected
+    """
+    self._config.TestConfig(self, self._required_config)
+    results = self._OnEachSource('Search', {'filter_arg': filter_arg,
+                                            'sizelimit': sizelimit,
+                                            'attrlist': attrlist})
+    for found in results:
+      if found is None:
+        return None
+    return self._MergeSources(results)[0]
+
+  def CountUsers(self, filter_arg=None):
+    """ Overrides: the superclass method.
+    """
+    total = 0
+    for count in self._OnEachSource('CountUsers', {'filter_arg': filter_arg}):
+      if count is None:
+        return None
+      total += count
+    return total
+
+  def GetSchemaAttributes(self, object_classes):
+    """ Overrides: the superclass method.  Uses the first source's schema.
+    """
+    if not self.contexts:
+      return None
+    return self.contexts[0].GetSchemaAttributes(object_classes)
+
+  def SearchChanges(self, attrlist=None):
+    """ Overrides: the superclass method.  Finds the changes on all the
+    sources at once (see SourceContext.SearchSourceChanges) and merges
+    them.
+    Args:
+      attrlist: attributes to return for each user.  If None, all
+        attributes are returned
+    Returns:
+      a UserDB of the added and modified users, and a list of the DNs of
+      the deleted users.  (None, None) if the changes on any source
+      couldn't be found.
+    Side-effects:
+      the users in self.users who lose their GoogleUsername to a changed
+      user are kept for PopSuperseded()
+    Raises:
+      utils.ConfigError: if any required config items are not present
+      RuntimeError:  if not connected
+    """
+    self._config.TestConfig(self, self._required_config)
+    self.superseded = []
+    results = self._OnEachSource('SearchSourceChanges', {'attrlist': attrlist})
+    found = []
+    deleted = []
+    for ix in xrange(len(results)):
+      (users, gone) = results[ix]
+      if users is None:
+        return (None, None)
+      if gone is None:
+        gone = self._SourceUsersGone(ix, users)
+      found.append(users)
+      deleted.extend(gone)
+    (merged, self.superseded) = self._MergeSources(found, deleted)
+    return (merged, deleted)
+
+  def PopSuperseded(self):
+    """ Overrides: the superclass method.
+    """
+    superseded = self.superseded
+    self.superseded = []
+    return superseded
+
+  def ExitedUsersSearch(self, attrlist, timestamp, since, directory_type):
+    """ Overrides: the superclass method.  Each source is searched with
+    its own ldap_disabled_filter, timestamp attribute and last update
+    time (see SourceContext.SearchExited), so only attrlist is used.
+    """
+    if not self.contexts:
+      self.contexts = self._MakeContexts()
+    for ctxt in self.contexts:
+      if ctxt.ldap_disabled_filter and ctxt.timestamp:
+        return ('SearchExited', {'attrlist': attrlist})
+    return None
+
+  def SearchExited(self, attrlist=None):
+    """ Find the users disabled on all the sources since their last
+    update, at once, and merge them.
+    Args:
+      attrlist: attributes to return for each user.  If None, all
+        attributes are returned
+    Returns:
+      a UserDB, or None if the search of any source failed
+    Raises:
+      RuntimeError:  if not connected
+    """
+    results = self._OnEachSource('SearchExited', {'attrlist': attrlist})
+    merged = userdb.UserDB(config=self._config)
+    for ix in xrange(len(results)):
+      users = results[ix]
+      if users is None:
+        return None
+      for dn in users.UserDNs():
+        users.SetMetaAttribute(dn, 'meta-ldap-source', self.contexts[ix].name)
+      merged.MergeUsers(users)
+    return merged
+
+  def _SourceUsersGone(self, ix, users):
+    """ The deleted users of a source which has found all its users,
+    rather than just the changed ones, e.g. on its first run in a
+    change-tracking ldap_sync_mode: those in self.users from that source
+    (by meta-ldap-source) who aren't among them.
+    Args:
+      ix: index of the source in self.contexts
+      users: UserDB of all the source's users
+    Returns:
+      list of DNs
+    """
+    if not self.users:
+      return []
+    name = self.contexts[ix].name
+    found = set(users.UserDNs())
+    gone = []
+    for dn in self.users.UserDNs():
+      if (dn not in found and
+          self.users.LookupDN(dn).get('meta-ldap-source') == name):
+        gone.append(dn)
+    return gone
+
+  def _OnEachSource(self, method, kwargs):
+    """ Call a method on every source's LdapContext at the same time.
+    Args:
+      method: name of the method
+      kwargs: dictionary of its arguments
+    Returns:
+      list of the return values, in the order of ldap_sources
+    Raises:
+      RuntimeError: if not connected
+      anything the method raises
+    """
+    if not self.conn:
+      raise RuntimeError('Not connected')
+    threads = []
+    for ctxt in self.contexts[1:]:
+      thread = ldap_ctxt.SearchThread(ctxt, method, kwargs, disconnect=False)
+      thread.start()
+      threads.append(thread)
+    results = [getattr(self.contexts[0], method)(**kwargs)]
+    for thread in threads:
+      thread.join()
+      if thread.exc_info:
+        (exc_type, exc_value, exc_tb) = thread.exc_info
+        raise exc_type, exc_value, exc_tb
+      results.append(thread.result)
+    return results
+
+  def _MergeSources(self, results, deleted=None):
+    """ Merge the users found on each source into one UserDB, dropping
+    any whose GoogleUsername was already taken by a user from an earlier
+    source, or by one with a smaller DN from the same source.  Each is
+    marked with its source's name, in meta-ldap-source.
+    Args:
+      results: list of UserDBs, in the order of ldap_sources
+      deleted: if not None, the results are only the changed users, so
+        they're checked against the rest of self.users too, apart from
+        these DNs
+    Returns:
+      the UserDB, and a list of the DNs of the users in self.users who
+      lost their GoogleUsername to one of the changed users
+    """
+    merged = userdb.UserDB(config=self._config)
+    superseded = []
+    owners = {}
+    if deleted is not None:
+      owners = self._ExistingOwners(results, deleted)
+    for ix in xrange(len(results)):
+      users = results[ix]
+      dns = users.UserDNs()
+      dns.sort()
+      for dn in dns:
+        users.SetMetaAttribute(dn, 'meta-ldap-source', self.contexts[ix].name)
+        username = users.LookupDN(dn).get('GoogleUsername')
+        if not username:
+          continue
+        key = username.lower()
+        if key in owners and owners[key] < (ix, dn):
+          logging.warn(messages.msg(messages.MSG_SOURCE_CONFLICT,
+                                    (dn, self.contexts[ix].name, username,
+                                     owners[key][1])))
+          users.DeleteUser(dn)
+          continue
+        if key in owners:
+          # it can only be one of self.users, whose account this one takes
+          logging.warn(messages.msg(messages.MSG_SOURCE_SUPERSEDED,
+                                    (owners[key][1], username, dn,
+                                     self.contexts[ix].name)))
+          superseded.append(owners[key][1])
+        owners[key] = (ix, dn)
+      merged.MergeUsers(users)
+    return (merged, superseded)
+
+  def _ExistingOwners(self, results, deleted):
+    """ The users in self.users who hold a GoogleUsername, apart from
+    those found again or deleted, and so not holding it any more.
+    Args:
+      results: list of UserDBs, as for _MergeSources()
+      deleted: list of the DNs of the deleted users
+    Returns:
+      dictionary of (source index, DN) tuples, by lower-cased
+      GoogleUsername.  A user whose source isn't known (e.g. from before
+      meta-ldap-source) ranks ahead of all the sources, so it keeps its
+      username.
+    """
+    if not self.users:
+      return {}
+    rank = {}
+    for ix in xrange(len(self.contexts)):
+      rank[self.contexts[ix].name] = ix
+    gone = set([dn.lower() for dn in deleted])
+    for users in results:
+      gone.update(users.UserDNs())
+    owners = {}
+    for dn in self.users.UserDNs():
+      if dn in gone:
+        continue
+      attrs = self.users.LookupDN(dn)
+      username = attrs.get('GoogleUsername')
+      if not username:
+        continue
+      owner = (rank.get(attrs.get('meta-ldap-source'), -1), dn)
+      key = username.lower()
+      if key not in owners or owner < owners[key]:
+        owners[key] = owner
+    return owners
+
+  def _MakeContexts(self):
+    """ Create the LdapContexts for the sources.  Each gets a Config of
+    its own, holding the variables set for the source, and the rest
+    copied from this context and the main configuration.
+    Returns:
+      list of SourceContexts
+    """
+    parms = {}
+    parms.update(ldap_ctxt.LdapContext.config_parms)
+    parms.update(userdb.UserDB.config_parms)
+    contexts = []
+    for ix in xrange(len(self.ldap_sources)):
+      source = self.ldap_sources[ix]
+      config = utils.Config(parms)
+      for attr in ldap_ctxt.LdapContext.config_parms:
+        config.SetAttr(attr, getattr(self, attr))
+      for attr in userdb.UserDB.config_parms:
+        config.SetAttr(attr, self._config.GetAttr(attr))
+      for (attr, val) in source.iteritems():
+        if attr in parms:
+          config.SetAttr(attr, val)
+        elif attr not in ('name', 'directory_type'):
+          logging.warn('Unrecognized property in ldap_sources: %s ignored' %
+                       attr)
+      contexts.append(SourceContext(config, str(source.get('name', ix)),
+                                    source.get('directory_type')))
+    return contexts
+
+
+class SourceContext(ldap_ctxt.LdapContext):
+
+  """ The LdapContext for one of a CompositeContext's sources.  It can
+  find its changes in timestamp mode too, keeping its own last update
+  time and list of DNs.
+  """
+
+  def __init__(self, config, name, directory_type=None):
+    """ Constructor
+    Args:
+      config: a utils.Config object for this source alone
+      name: the source's name, for its state files
+      directory_type: 'ad' or 'openldap'; guessed from the timestamp
+        attribute if not given
+    """
+    super(SourceContext, self).__init__(config)
+    self.name = name
+    self.state_prefix = '.source-%s' % name
+    self.timestamp = config.GetAttr('timestamp')
+    if directory_type:
+      self.directory_type = directory_type
+    elif self.timestamp == 'whenChanged':
+      self.directory_type = 'ad'
+    else:
+      self.directory_type = 'openldap'
+
+  def SearchSourceChanges(self, attrlist=None):
+    """ Find the users added, modified or deleted on this source since
+    its last good run.  Sources with a change-tracking ldap_sync_mode
+    use that; for the others, the users with a timestamp after the last
+    update are the changed ones, and the DNs found last time but not
+    this time are the deleted ones.
+    Args:
+      attrlist: as for SearchChanges()
+    Returns:
+      as for SearchChanges()
+    """
+    if self.IsTrackingChanges():
+      return self.SearchChanges(attrlist)
+    (watermark, known_dns) = self._ReadSourceState()
+    query = self.ldap_user_filter
+    if watermark and self.timestamp:
+      query = ldap_ctxt.TimestampFilter(query, self.timestamp, watermark,
+                                        self.directory_type)
+    (found, everyone) = self.ConcurrentSearch([
+        ('Search', {'filter_arg': query, 'attrlist': attrlist}),
+        ('Search', {'filter_arg': None, 'attrlist': []})])
+    if found is None or everyone is None:
+      return (None, None)
+    dns = set(everyone.UserDNs())
+    deleted = [dn for dn in known_dns if dn not in dns]
+    logging.debug('Source %s: %d changed and %d deleted users' %
+                  (self.name, found.UserCount(), len(deleted)))
+    self._SaveSourceState(last_update_time.GetBaseline(), dns)
+    return (found, deleted)
+
+  def SearchExited(self, attrlist=None):
+    """ Find the users disabled on this source since its last good run:
+    those passing its ldap_disabled_filter with a timestamp after its
+    last update time, or all of them if it hasn't had one.  A source
+    tracking its changes itself has no time of its own, so the main last
+    update time is used for it.
+    Args:
+      attrlist: as for Search()
+    Returns:
+      a UserDB (empty if the source has no ldap_disabled_filter or
+      timestamp), or None if the search failed
+    """
+    if not self.ldap_disabled_filter or not self.timestamp:
+      return userdb.UserDB(config=self._config)
+    if self.IsTrackingChanges():
+      watermark = (last_update_time.get() or '').strip() or None
+    else:
+      watermark = self._ReadSourceState()[0]
+    query = self.ldap_disabled_filter
+    if watermark:
+      query = ldap_ctxt.TimestampFilter(query, self.timestamp, watermark,
+                                        self.directory_type)
+    logging.debug('Source %s: finding disabled users with %s' %
+                  (self.name, query))
+    return self.Search(filter_arg=query, attrlist=attrlist)
+
+  def _ReadSourceState(self):
+    """ Read this source's state saved by the last good run.  The first
+    line of the file is the last update time, as YYYYMMDDHHMMSS, and
+    each following line is a DN.
+    Returns:
+      the time (None if there isn't one), and a list of the DNs
+    """
+    state = last_update_time.getState(self.state_prefix)
+    if not state:
+      return (None, [])
+    lines = state.split('\n')
+    return (lines[0] or None, [dn for dn in lines[1:] if dn])
+
+  def _SaveSourceState(self, watermark, dns):
+    """ Arrange for this source's state to be saved if this run is good.
+    Args:
+      watermark: the time this run started, as YYYYMMDDHHMMSS
+      dns: iterable of the DNs of all this source's users
+    """
+    lines = [watermark]
+    lines.extend(dns)
+    last_update_time.setPendingState(self.state_prefix,
+                                     '%s\n' % '\n'.join(lines))
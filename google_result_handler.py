@@ -74,6 +74,10 @@ class GoogleResultHandler(object):
           'previously-exited')
     if attrs:
       self._userdb.SetMetaLastUpdated(dn, attrs)
+      if attrs.get('meta-Google-pushed'):
+        # what Google now has, so later updates can skip unchanged fields
+        self._userdb.SetMetaAttribute(dn, 'meta-Google-pushed',
+                                      attrs['meta-Google-pushed'])
       if action == 'renamed' or action == 'added':
         # We should only ever change the old username on add or rename
         self._userdb.SetMetaAttribute(dn, "meta-Google-old-username", 
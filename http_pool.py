@@ -0,0 +1,324 @@
+#!/usr/bin/python2.4
+#
+# Copyright 2006 Google, Inc.
+# All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License")
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+
+""" Keep-alive HTTP connections for the calls to Google
+
+class ConnectionPool: idle connections, by host
+class KeepAliveHandler: a urllib2 handler which uses a ConnectionPool
+class PooledAPI: a provisioning API object whose calls use a ConnectionPool
+function Install: make urllib2 able to use a ConnectionPool
+"""
+
+import httplib
+import logging
+import select
+import socket
+import StringIO
+import threading
+import time
+import urllib
+import urllib2
+
+# the ConnectionPool for the calls being made by each thread, if any
+_current = threading.local()
+_installed = False
+
+
+class ConnectionPool(object):
+
+  """ Holds up to 'size' idle HTTP(S) connections per host, for reuse,
+  closing any left idle more than 'idle_timeout' seconds.  Counts the
+  requests made, the connections opened (each one a TCP, and for HTTPS
+  a TLS, handshake), and the time the requests took on new and on
+  reused connections.
+  """
+
+  def __init__(self, size=10, idle_timeout=60):
+    """ Constructor
+    Args:
+      size: max # of idle connections kept per host
+      idle_timeout: seconds an idle connection is kept
+    """
+    self.size = size
+    self.idle_timeout = idle_timeout
+    self._lock = threading.Lock()
+    self._idle = {}
+    self._stats = {'requests': 0, 'handshakes': 0, 'reused': 0,
+                   'new_seconds': 0.0, 'reused_seconds': 0.0}
+
+  def Get(self, scheme, host, tunnel=None, tunnel_headers=None):
+    """ Get a connection to a host, an idle one if there is one.  An idle
+    connection the server has closed (or sent anything on, which it
+    shouldn't have) is thrown away.
+    Args:
+      scheme: 'http' or 'https'
+      host: host[:port]
+      tunnel: for an https URL through a proxy, the host[:port] to tunnel
+        to, 'host' being the proxy's
+      tunnel_headers: dictionary of the headers for the proxy, for a new
+        connection
+    Returns:
+      (httplib connection, whether it was reused)
+    """
+    key = (scheme, host, tunnel)
+    now = time.time()
+    self._lock.acquire()
+    try:
+      idle = self._idle.get(key, [])
+      while idle:
+        (conn, since) = idle.pop()
+        if now - since <= self.idle_timeout and _IsOpen(conn):
+          return (conn, True)
+        conn.close()
+    finally:
+      self._lock.release()
+    if scheme == 'https':
+      conn = _SendCountingHTTPS(host)
+    else:
+      conn = _SendCountingHTTP(host)
+    if tunnel:
+      conn.set_tunnel(tunnel, headers=tunnel_headers)
+    return (conn, False)
+
+  def Put(self, scheme, host, conn, tunnel=None):
+    """ Give back a connection, whose response has been read, for reuse
+    """
+    self._lock.acquire()
+    try:
+      idle = self._idle.setdefault((scheme, host, tunnel), [])
+      if len(idle) < self.size:
+        idle.append((conn, time.time()))
+        return
+    finally:
+      self._lock.release()
+    conn.close()
+
+  def Record(self, reused, seconds):
+    """ Count a request
+    Args:
+      reused: whether it was on a reused connection
+      seconds: how long it took
+    """
+    self._lock.acquire()
+    try:
+      self._stats['requests'] += 1
+      if reused:
+        self._stats['reused'] += 1
+        self._stats['reused_seconds'] += seconds
+      else:
+        self._stats['handshakes'] += 1
+        self._stats['new_seconds'] += seconds
+    finally:
+      self._lock.release()
+
+  def GetStats(self):
+    """ A copy of the counts (see the class doc)
+    """
+    self._lock.acquire()
+    try:
+      return self._stats.copy()
+    finally:
+      self._lock.release()
+
+  def CloseAll(self):
+    """ Close all the idle connections
+    """
+    self._lock.acquire()
+    try:
+      for idle in self._idle.itervalues():
+        for (conn, unused_since) in idle:
+          conn.close()
+      self._idle = {}
+    finally:
+      self._lock.release()
+
+
+class _SendCountingHTTP(httplib.HTTPConnection):
+
+  """ An HTTP connection which notes whether it has tried to send
+  anything, so a failed request is only sent again if none of it can
+  have reached the server.
+  """
+
+  started_sending = False
+
+  def send(self, data):
+    self.started_sending = True
+    httplib.HTTPConnection.send(self, data)
+
+
+class _SendCountingHTTPS(httplib.HTTPSConnection):
+
+  """ An HTTPS connection which notes whether it has tried to send
+  anything; see _SendCountingHTTP.
+  """
+
+  started_sending = False
+
+  def send(self, data):
+    self.started_sending = True
+    httplib.HTTPSConnection.send(self, data)
+
+
+def _IsOpen(conn):
+  """ Whether an idle connection can still be used: a socket the server
+  has closed reads as ready (with nothing to read).
+  """
+  if conn.sock is None:
+    return False
+  try:
+    (readable, unused_w, unused_x) = select.select([conn.sock], [], [], 0)
+  except (select.error, socket.error, ValueError):
+    return False
+  return not readable
+
+
+class KeepAliveHandler(urllib2.HTTPHandler, urllib2.HTTPSHandler):
+
+  """ A urllib2 handler for http and https URLs which sends each request
+  on a connection from a ConnectionPool, and gives it back afterwards,
+  rather than closing it as urllib2 does.  The pool is the one given,
+  or else the one for the calling thread's current PooledAPI call; with
+  neither, the request is left to urllib2's own handlers, so requests
+  made other than through a PooledAPI are unaffected.
+  """
+
+  def __init__(self, pool=None):
+    urllib2.HTTPHandler.__init__(self)
+    urllib2.HTTPSHandler.__init__(self)
+    self._pool = pool
+
+  def http_open(self, req):
+    if not self._GetPool():
+      return urllib2.HTTPHandler.http_open(self, req)
+    return self._Open('http', req)
+
+  def https_open(self, req):
+    tunnel = getattr(req, '_tunnel_host', None)
+    if (not self._GetPool() or
+        (tunnel and not hasattr(httplib.HTTPSConnection, 'set_tunnel'))):
+      return urllib2.HTTPSHandler.https_open(self, req)
+    return self._Open('https', req)
+
+  def _GetPool(self):
+    return self._pool or getattr(_current, 'pool', None)
+
+  def _Open(self, scheme, req):
+    """ Send a request, and read all of the response, so the connection
+    is free for the next one.  If sending fails before any of the
+    request has gone out, e.g. because a reused connection turns out to
+    be closed, the request is sent again on a new connection; once any
+    of it has gone out, it isn't, since the server may have acted on it.
+    Args:
+      scheme: 'http' or 'https'
+      req: the urllib2.Request
+    Returns:
+      a response, as urllib2's handlers return
+    Raises:
+      urllib2.URLError: if the request cannot be sent
+    """
+    pool = self._GetPool()
+    host = req.get_host()
+    if not host:
+      raise urllib2.URLError('no host given')
+    headers = dict(req.headers)
+    headers.update(req.unredirected_hdrs)
+    tunnel = getattr(req, '_tunnel_host', None)
+    tunnel_headers = {}
+    if tunnel and 'Proxy-authorization' in headers:
+      # as urllib2 does: the proxy's credentials go on the CONNECT
+      tunnel_headers['Proxy-Authorization'] = headers.pop(
+          'Proxy-authorization')
+    while True:
+      (conn, reused) = pool.Get(scheme, host, tunnel, tunnel_headers)
+      conn.started_sending = False
+      start = time.time()
+      try:
+        conn.request(req.get_method(), req.get_selector(), req.get_data(),
+                     headers)
+        response = conn.getresponse()
+        body = response.read()
+      except (socket.error, httplib.HTTPException), e:
+        conn.close()
+        if reused and not conn.started_sending:
+          continue
+        raise urllib2.URLError(e)
+      break
+    pool.Record(reused, time.time() - start)
+    if response.will_close:
+      conn.close()
+    else:
+      pool.Put(scheme, host, conn, tunnel)
+    result = urllib.addinfourl(StringIO.StringIO(body), response.msg,
+                               req.get_full_url())
+    result.code = response.status
+    result.msg = response.reason
+    return result
+
+
+class PooledAPI(object):
+
+  """ Wraps a provisioning API object, so the requests its calls make
+  through urllib2.urlopen() go on the connections of a ConnectionPool.
+  Anything else is passed straight through.
+  """
+
+  def __init__(self, api, pool):
+    """ Constructor
+    Args:
+      api: a google.appsforyourdomain.provisioning.API object
+      pool: the ConnectionPool
+    """
+    self._api = api
+    self._pool = pool
+
+  def __getattr__(self, name):
+    attr = getattr(self._api, name)
+    if not callable(attr):
+      return attr
+    pool = self._pool
+    def Pooled(*args, **kwargs):
+      previous = getattr(_current, 'pool', None)
+      _current.pool = pool
+      try:
+        return attr(*args, **kwargs)
+      finally:
+        _current.pool = previous
+    return Pooled
+
+
+def Install(size, idle_timeout):
+  """ Make urllib2.urlopen(), which the provisioning API uses, able to
+  send requests through a ConnectionPool, and make a new one for
+  PooledAPIs to use.  Only their requests use it; other callers of
+  urlopen() get urllib2's usual handling.
+  Args:
+    size, idle_timeout: as for ConnectionPool
+  Returns:
+    the ConnectionPool
+  """
+  global _installed
+  if not _installed:
+    urllib2.install_opener(urllib2.build_opener(KeepAliveHandler()))
+    _installed = True
+  logging.debug('keeping up to %d HTTP connections per host' % size)
+  return ConnectionPool(size, idle_timeout)
+
+if __name__ == '__main__':
+  pass
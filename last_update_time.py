@@ -27,6 +27,10 @@ FILENAME = ""
 LASTUPDATEFILE = None
 NEXT_UPDATE_TIME = None
 
+# state to be saved next to the last update file, keyed by file suffix.
+# Like the last update time, it's only written if the run had no errors.
+PENDING_STATE = {}
+
 def initialize():
   """ Reset whether any errors occurred in a run."""
   global WAS_ERRORS
@@ -75,6 +79,7 @@ def beginNewRun():
   global NEXT_UPDATE_TIME
   global WAS_ERRORS
   NEXT_UPDATE_TIME = time.gmtime()
+  PENDING_STATE.clear()
   logging.debug('last_update_time.beginNewRun(): baseline set to %s' % 
       str(NEXT_UPDATE_TIME))
   WAS_ERRORS = False
@@ -97,8 +102,57 @@ def updateIfNoErrors():
     logging.info(messages.MSG_UPDATING_LAST_UPDATE_TIME % 
         str(NEXT_UPDATE_TIME))
     _set(NEXT_UPDATE_TIME)
+    for (suffix, data) in PENDING_STATE.iteritems():
+      _setState(suffix, data)
+    PENDING_STATE.clear()
 
 def GetBaseline():
   """ Return the time that the new run started which is known as the 'baseline'.
   """
   return time.strftime('%Y%m%d%H%M%S', NEXT_UPDATE_TIME)
+
+def getStateFilename(suffix):
+  """ Return the name of a state file kept next to the last update file.
+  Args:
+    suffix: appended to the name of the last update file
+  """
+  return '%s%s' % (FILENAME, suffix)
+
+def getState(suffix):
+  """ Return the contents of a state file saved by a previous good run.
+  Args:
+    suffix: as for getStateFilename()
+  Returns:
+    A string, or None if there is no such file.
+  """
+  try:
+    f = file(getStateFilename(suffix), 'r')
+  except IOError:
+    return None
+  try:
+    return f.read()
+  finally:
+    f.close()
+
+def setPendingState(suffix, data):
+  """ Note some state to be saved next to the last update file.  It's
+  written by updateIfNoErrors(), so it's only kept if the run was good.
+  Args:
+    suffix: as for getStateFilename()
+    data: string to be written to the file
+  """
+  PENDING_STATE[suffix] = data
+
+def _setState(suffix, data):
+  """ Write a state file.
+  Args:
+    suffix: as for getStateFilename()
+    data: string to be written to the file
+  """
+  name = getStateFilename(suffix)
+  logging.debug('last_update_time._setState(): writing %s' % name)
+  f = file(name, 'w')
+  try:
+    f.write(data)
+  finally:
+    f.close()
@@ -20,16 +20,25 @@
 """ The module that talks to the LDAP server
 
 class LdapContext:  class that encapsulates all LDAP info
+class SearchThread: runs one LdapContext search on its own connection
+class SyncreplConnection: connection for RFC 4533 content synchronization
 
 """
 
 
+import binascii
+import copy
+import last_update_time
 import ldap
 import logging
 import messages
+import result_spool
+import sys
+import threading
 import time
 import userdb
 import utils
+from ldap.controls import LDAPControl
 
 # The user may have requesting LDAP results paging, so try to load the
 # library for this.  But don't die yet if it's not available.
@@ -38,10 +47,53 @@ try:
 except ImportError:
   SimplePagedResultsControl = None
 
+# and for reading the server's schema
+try:
+  from ldap.schema import SubSchema
+except ImportError:
+  SubSchema = None
+
+# Likewise for content synchronization (RFC 4533), which only newer
+# versions of python-ldap support.
+try:
+  from ldap.ldapobject import LDAPObject
+  from ldap.syncrepl import SyncreplConsumer
+except ImportError:
+  SyncreplConsumer = None
+
 
 SLEEP_TIME = 0.1
 TIMEOUT_SECS = 15
 
+# errors after which a search is worth retrying on a new connection
+RETRYABLE_ERRORS = (ldap.SERVER_DOWN, ldap.TIMEOUT, ldap.UNAVAILABLE,
+                    ldap.BUSY)
+MAX_RETRIES = 3
+RETRY_SLEEP = 5    # seconds; multiplied by the attempt number
+
+# how often (in entries) a paged search reports its progress
+PROGRESS_ENTRIES = 10000
+
+# the ways of finding the users changed since the last run:
+#  timestamp: AND the timestamp attribute into the user filter, and search
+#    for all the users to find the deleted ones (see commands.py)
+#  syncrepl: ask the server for the changes since the last sync cookie
+#  usn: (Active Directory) search for uSNChanged above the highest USN the
+#    domain controller had committed at the start of the last run
+SYNC_MODES = ('timestamp', 'syncrepl', 'usn')
+
+# suffix of the file, next to the last update file, which holds the
+# syncrepl cookie and the entryUUID -> DN map
+SYNCREPL_STATE_SUFFIX = '.syncrepl'
+
+# prefix of the suffix of the files, next to the last update file, which
+# hold the USN watermark and the objectGUID -> DN map.  The domain
+# controller's host name is appended, since USNs are per-DC.
+USN_STATE_SUFFIX = '.usn-'
+
+# Active Directory's "show deleted objects" control, for finding tombstones
+SHOW_DELETED_OID = '1.2.840.113556.1.4.417'
+
 
 class LdapContext(utils.Configurable):
 
@@ -62,6 +114,9 @@ class LdapContext(utils.Configurable):
                   'ldap_base_dn': messages.MSG_LDAP_BASE_DN,
                   'ldap_timeout': messages.MSG_LDAP_TIMEOUT,
                   'ldap_page_size': messages.MSG_LDAP_PAGE_SIZE,
+                  'ldap_max_retries': messages.MSG_LDAP_MAX_RETRIES,
+                  'ldap_memory_budget': messages.MSG_LDAP_MEMORY_BUDGET,
+                  'ldap_sync_mode': messages.MSG_LDAP_SYNC_MODE,
                   'tls_option': messages.MSG_TLS_OPTION,
                   'tls_cacertdir': messages.MSG_TLS_CACERTDIR,
                   'tls_cacertfile': messages.MSG_TLS_CACERTFILE}
@@ -80,6 +135,9 @@ class LdapContext(utils.Configurable):
     self.ldap_timeout = TIMEOUT_SECS
     self.ldap_url = None
     self.ldap_page_size = 0
+    self.ldap_max_retries = MAX_RETRIES
+    self.ldap_memory_budget = 0
+    self.ldap_sync_mode = 'timestamp'
     self.tls_option = 'never'
     self.tls_cacertdir = '/etc/ssl/certs'
     self.tls_cacertfile = ''
@@ -91,6 +149,9 @@ class LdapContext(utils.Configurable):
     self._required_config = ['ldap_url', 'ldap_user_filter', 'ldap_base_dn']
     self.config_changed = False
     self.conn = None
+    # prefix of the suffixes of the files where the sync modes keep their
+    # state, for telling apart several servers' (see composite_ctxt.py)
+    self.state_prefix = ''
     if self.tls_option == 'demand':
       ldap.set_option(ldap.OPT_X_TLS, ldap.OPT_X_TLS_DEMAND)
     elif self.tls_option == 'allow':
@@ -126,6 +187,15 @@ class LdapContext(utils.Configurable):
            self.ldap_timeout = float(val)
          except ValueError:
            return messages.msg(messages.ERR_ENTER_NUMBER, val)
+      elif attr in ('ldap_max_retries', 'ldap_memory_budget'):
+        try:
+          setattr(self, attr, int(val))
+        except ValueError:
+          return messages.msg(messages.ERR_ENTER_NUMBER, val)
+      elif attr == 'ldap_sync_mode':
+        if val not in SYNC_MODES:
+          return messages.msg(messages.ERR_INVALID_VALUE, attr)
+        self.ldap_sync_mode = val
       else:
         setattr(self, attr, val)
     except ValueError:
@@ -167,6 +237,52 @@ class LdapContext(utils.Configurable):
     except ldap.LDAPError, e:
       logging.exception('LDAP disconnection error: %s', str(e))
 
+  def _Reconnect(self):
+    """ Drop the current connection, which has presumably failed, and
+    connect and bind again.
+    Returns:
+      True if connected again
+    """
+    if self.conn:
+      try:
+        self.conn.unbind_s()
+      except ldap.LDAPError:
+        pass
+      self.conn = None
+    return not self.Connect()
+
+  def _Recover(self, error, attempt):
+    """ After a search has failed with one of RETRYABLE_ERRORS, wait a
+    little longer on each attempt, and reconnect.  Failures to reconnect
+    count as attempts too.
+    Args:
+      error: the exception
+      attempt: how many times the search has now failed
+    Returns:
+      the attempt number the search can be retried as, or None if
+      ldap_max_retries has been used up
+    """
+    while attempt <= self.ldap_max_retries:
+      logging.warn('LDAP search failed (%s); reconnecting, attempt %d of %d' %
+                   (str(error), attempt, self.ldap_max_retries))
+      time.sleep(RETRY_SLEEP * attempt)
+      if self._Reconnect():
+        return attempt
+      attempt += 1
+    return None
+
+  def _Clone(self):
+    """ Make a copy of this context, with its own connection to the
+    server.  The copy shares all configuration with this one.
+    Returns:
+      the new LdapContext, or None if it could not connect
+    """
+    ctxt = copy.copy(self)
+    ctxt.conn = None
+    if ctxt.Connect():
+      return None
+    return ctxt
+
   def GetUserFilter(self):
     """
     Returns: the current ldap_user_filter
@@ -180,7 +296,8 @@ class LdapContext(utils.Configurable):
     """
     self.ldap_user_filter = query
 
-  def _AsyncSearch(self, query, sizelimit, attrlist=None):
+  def _AsyncSearch(self, query, sizelimit, attrlist=None, base=None,
+                   serverctrls=None):
     """ Helper function that implements an async LDAP search for
     the Search method below.
     Args:
@@ -188,17 +305,49 @@ class LdapContext(utils.Configurable):
       sizelimit: max # of users to return.
       attrlist: list of attributes to return.  If null, all attributes
         are returned
+      base: DN to search under, if not ldap_base_dn
+      serverctrls: list of additional LDAP controls
     Returns:
-      A list of users, as returned by the LDAP search
+      A result_spool.ResultSpool of the users, as returned by the LDAP
+      search
+    Raises:
+      ldap.LDAPError: if the search failed, after any retries
     """
-    logging.debug('Search on %s for %s' % (self.ldap_base_dn, query))
-    msgid = self.conn.search_ext(self.ldap_base_dn, ldap.SCOPE_SUBTREE,
-                                 query, attrlist=attrlist)
-    users = []
+    if not base:
+      base = self.ldap_base_dn
+    logging.debug('Search on %s for %s' % (base, query))
+    users = result_spool.ResultSpool(self.ldap_memory_budget)
+    attempt = 0
+    while True:
+      try:
+        self._AsyncSearchAttempt(query, sizelimit, attrlist, base,
+                                 serverctrls, users)
+        return users
+      except RETRYABLE_ERRORS, e:
+        # there's no resuming a search which isn't paged, so start again,
+        # without what the failed attempt found
+        users.close()
+        attempt = self._Recover(e, attempt + 1)
+        if attempt is None:
+          raise e
+      except:
+        users.close()
+        raise
+
+  def _AsyncSearchAttempt(self, query, sizelimit, attrlist, base,
+                          serverctrls, users):
+    """ One try at the search for _AsyncSearch(), which has the same args,
+    adding the entries found to the ResultSpool 'users'
+    """
+    msgid = self.conn.search_ext(base, ldap.SCOPE_SUBTREE,
+                                 query, attrlist=attrlist,
+                                 serverctrls=serverctrls)
 
     # If we have a sizelimit, we'll get results one by one so that we
-    # can stop processing once we've hit the limit.
-    if sizelimit:
+    # can stop processing once we've hit the limit.  Likewise with a
+    # memory budget, so they can go to the spool as they arrive rather
+    # than all be held by python-ldap until the search is done.
+    if sizelimit or self.ldap_memory_budget:
       all = 0
     else:
       all = 1
@@ -212,14 +361,16 @@ class LdapContext(utils.Configurable):
       if sizelimit and len(users) >= sizelimit:
         self.conn.abandon_ext(msgid)
         break
-      time.sleep(SLEEP_TIME)
-      
-    return users
+      # result() waits for the next entry anyway, and pausing after each
+      # one would make a big search crawl
+      if not self.ldap_memory_budget:
+        time.sleep(SLEEP_TIME)
 
   def IsUsingLdapLibThatSupportsPaging(self):
     return SimplePagedResultsControl
 
-  def _PagedAsyncSearch(self, query, sizelimit, attrlist=None):
+  def _PagedAsyncSearch(self, query, sizelimit, attrlist=None, base=None,
+                        serverctrls=None):
     """ Helper function that implements a paged LDAP search for
     the Search method below.
     Args:
@@ -227,28 +378,61 @@ class LdapContext(utils.Configurable):
       sizelimit: max # of users to return.
       attrlist: list of attributes to return.  If null, all attributes
         are returned
+      base: DN to search under, if not ldap_base_dn
+      serverctrls: list of additional LDAP controls
     Returns:
       A list of users as returned by the LDAP search
+    Raises:
+      ldap.LDAPError: if the search failed, after any retries
+
+    If the connection fails part way, it's re-established and the search
+    resumes from the last page received.  If the server won't accept that
+    page's cookie on the new connection, the search starts over.
     """
     if not self.IsUsingLdapLibThatSupportsPaging():
       logging.error('Your version of python-ldap is too old to support '
                     'paged LDAP queries.  Aborting search.')
       return None
 
+    if not base:
+      base = self.ldap_base_dn
+    if not serverctrls:
+      serverctrls = []
     paged_results_control = SimplePagedResultsControl(
         ldap.LDAP_CONTROL_PAGE_OID, True, (self.ldap_page_size, ''))
-    logging.debug('Paged search on %s for %s' % (self.ldap_base_dn, query))
-    users = []
+    logging.debug('Paged search on %s for %s' % (base, query))
+    users = result_spool.ResultSpool(self.ldap_memory_budget)
     ix = 0
+    attempt = 0
+    resuming = False
     while True: 
       if self.ldap_page_size == 0:
-        serverctrls = []
+        ctrls = serverctrls
       else:
-        serverctrls = [paged_results_control]
-      msgid = self.conn.search_ext(self.ldap_base_dn, ldap.SCOPE_SUBTREE, 
-          query, attrlist=attrlist, serverctrls=serverctrls)
-      res = self.conn.result3(msgid=msgid, timeout=self.ldap_timeout)
-      unused_code, results, unused_msgid, serverctrls = res
+        ctrls = serverctrls + [paged_results_control]
+      try:
+        msgid = self.conn.search_ext(base, ldap.SCOPE_SUBTREE, 
+            query, attrlist=attrlist, serverctrls=ctrls)
+        res = self.conn.result3(msgid=msgid, timeout=self.ldap_timeout)
+      except RETRYABLE_ERRORS, e:
+        attempt = self._Recover(e, attempt + 1)
+        if attempt is None:
+          raise e
+        resuming = paged_results_control.controlValue[1] != ''
+        continue
+      except ldap.LDAPError, e:
+        if not resuming:
+          raise
+        # the cookie belonged to the old connection
+        logging.warn('Cannot resume the search for %s (%s); starting over' %
+                     (query, str(e)))
+        paged_results_control.controlValue = (self.ldap_page_size, '')
+        users.close()
+        ix = 0
+        resuming = False
+        continue
+      resuming = False
+      unused_code, results, unused_msgid, resctrls = res
       for result in results:
         ix += 1
         users.append(result)
@@ -256,8 +440,10 @@ class LdapContext(utils.Configurable):
           break
       if sizelimit and ix >= sizelimit:
         break
+      if ix / PROGRESS_ENTRIES > (ix - len(results)) / PROGRESS_ENTRIES:
+        logging.info('Search for %s: %d entries so far' % (query, ix))
       cookie = None 
-      for serverctrl in serverctrls:
+      for serverctrl in resctrls:
         if serverctrl.controlType == ldap.LDAP_CONTROL_PAGE_OID:
           unused_est, cookie = serverctrl.controlValue
           if cookie:
@@ -278,10 +464,75 @@ class LdapContext(utils.Configurable):
         users matching the user search filter are returned
       attrlist: attributes to return for each user.  If None, all
         attribute are returned
+    Returns:
+      a UserDB, or None if the search failed.  A failed search never
+      yields a partial UserDB, since users missing from it would look
+      deleted.
     Raises:
       utils.ConfigError: if any required config items are not present
       RuntimeError:  if not connected
     """
+    users = self._RawSearch(filter_arg, sizelimit, attrlist)
+    if users is None:
+      return None
+    try:
+      return userdb.UserDB(config=self._config, users=users)
+    finally:
+      users.close()
+
+  def CountUsers(self, filter_arg=None):
+    """ Count the users passing a filter, without fetching any of their
+    attributes.
+    Args:
+      filter_arg: as for Search()
+    Returns:
+      the number of users, or None if the search failed
+    Raises:
+      as for Search()
+    """
+    users = self._RawSearch(filter_arg, 0, ['1.1'])   # "no attributes"
+    if users is None:
+      return None
+    count = len(users)
+    users.close()
+    return count
+
+  def GetSchemaAttributes(self, object_classes):
+    """ Ask the server's schema which attributes objects of the given
+    classes can have.
+    Args:
+      object_classes: list of objectClass names
+    Returns:
+      set of attribute names, or None if the schema couldn't be read
+    """
+    if not SubSchema or not self.conn:
+      return None
+    root_dse = self._ReadRootDSE(['subschemaSubentry'])
+    if 'subschemaSubentry' not in root_dse:
+      return None
+    try:
+      results = self.conn.search_s(root_dse['subschemaSubentry'][0],
+                                   ldap.SCOPE_BASE, '(objectClass=subschema)',
+                                   ['objectClasses', 'attributeTypes'])
+    except ldap.LDAPError, e:
+      logging.exception('LDAP error reading the schema: %s' % str(e))
+      return None
+    if not results:
+      return None
+    schema = SubSchema(results[0][1])
+    (must, may) = schema.attribute_types(object_classes, raise_keyerror=0)
+    attrs = set()
+    for attr_type in must.values() + may.values():
+      if attr_type.names:
+        attrs.add(attr_type.names[0])
+    return attrs
+
+  def _RawSearch(self, filter_arg, sizelimit, attrlist):
+    """ The search for Search(), which has the same args and exceptions
+    Returns:
+      a result_spool.ResultSpool of the entries found, or None if the
+      search failed
+    """
     self._config.TestConfig(self, self._required_config)
     query = filter_arg
     if not query:
@@ -307,10 +558,519 @@ class LdapContext(utils.Configurable):
     except ldap.SIZELIMIT_EXCEEDED, e:
       logging.exception('Size limit exceeded on your server.  '
                         'Try setting ldap_page_size.  %s' % str(e))
+      return None
     except ldap.INSUFFICIENT_ACCESS, e:
       logging.exception('User %s lacks permission to do this search\n%s' %
                         (self.ldap_admin_name, str(e)))
+      return None
     except ldap.LDAPError, e:
       logging.exception('LDAP error searching %s: %s' % (query, str(e)))
+      return None
+    return users
+
+  def IsTrackingChanges(self):
+    """ Whether SearchChanges() should be used to find what's changed since
+    the last run, rather than a search on the timestamp attribute.
+    """
+    return self.ldap_sync_mode != 'timestamp'
+
+  def PopSuperseded(self):
+    """ The DNs of the users the last SearchChanges() found to have lost
+    their GoogleUsername to a changed user, for the caller to drop from
+    its UserDB once all the run's searches have succeeded.  Only a
+    CompositeContext finds any.
+    Returns:
+      list of DNs
+    """
+    return []
+
+  def ExitedUsersSearch(self, attrlist, timestamp, since, directory_type):
+    """ The search for the users disabled since the last run, if there's
+    an ldap_disabled_filter, for ConcurrentSearch().
+    Args:
+      attrlist: attributes to return for each user
+      timestamp: name of the timestamp attribute, or None
+      since: the time of the last run, as YYYYMMDDHHMMSS
+      directory_type: as for TimestampFilter()
+    Returns:
+      a (method, kwargs) tuple, or None if there's no such search
+    """
+    if not self.ldap_disabled_filter or not timestamp:
+      return None
+    logging.debug(messages.msg(messages.MSG_FIND_EXITS,
+                               self.ldap_disabled_filter))
+    query = TimestampFilter(self.ldap_disabled_filter, timestamp, since,
+                            directory_type)
+    return ('Search', {'filter_arg': query, 'attrlist': attrlist})
+
+  def SearchChanges(self, attrlist=None):
+    """ Find the users added, modified or deleted since the last run,
+    according to ldap_sync_mode.  The state needed for the next run is
+    saved by last_update_time.updateIfNoErrors().
+    Args:
+      attrlist: attributes to return for each user.  If None, all
+        attributes are returned
+    Returns:
+      a UserDB of the added and modified users, and a list of the DNs of
+      the deleted users.  On the first run there's nothing to tell the
+      deleted users by, so the UserDB has all the users, and the list is
+      None: the users not in the UserDB are the deleted ones.  (None,
+      None) if the changes couldn't be found.
+    Raises:
+      utils.ConfigError: if any required config items are not present
+      RuntimeError: if ldap_sync_mode is not one that tracks changes
+    """
+    self._config.TestConfig(self, self._required_config)
+    if self.ldap_sync_mode == 'syncrepl':
+      return self._SyncreplSearchChanges(attrlist)
+    elif self.ldap_sync_mode == 'usn':
+      return self._UsnSearchChanges(attrlist)
+    raise RuntimeError('ldap_sync_mode %s does not track changes' %
+                       self.ldap_sync_mode)
+
+  def _SyncreplSearchChanges(self, attrlist):
+    """ SearchChanges() for the 'syncrepl' mode: a refreshOnly content
+    synchronization search from the cookie saved by the last good run.
+    Deletions are reported by entryUUID, so the map of entryUUID to DN is
+    saved along with the cookie.
+    Args:
+      attrlist: as for SearchChanges()
+    Returns:
+      as for SearchChanges()
+    """
+    if not SyncreplConsumer:
+      logging.error('Your version of python-ldap is too old to support '
+                    'content synchronization.  Aborting search.')
+      return (None, None)
+    (cookie, uuids) = self._ReadSyncreplState()
+    logging.debug('Content sync on %s for %s from cookie %s' %
+                  (self.ldap_base_dn, self.ldap_user_filter, cookie))
+    conn = SyncreplConnection(self.ldap_url, cookie, uuids)
+    try:
+      try:
+        conn.simple_bind_s(self.ldap_admin_name, self.ldap_password)
+        msgid = conn.syncrepl_search(self.ldap_base_dn, ldap.SCOPE_SUBTREE,
+                                     mode='refreshOnly',
+                                     filterstr=self.ldap_user_filter,
+                                     attrlist=attrlist)
+        while conn.syncrepl_poll(msgid=msgid, timeout=self.ldap_timeout):
+          pass
+      except ldap.LDAPError, e:
+        logging.exception('LDAP error in content sync of %s: %s' %
+                          (self.ldap_user_filter, str(e)))
+        return (None, None)
+    finally:
+      try:
+        conn.unbind_s()
+      except ldap.LDAPError:
+        pass
+
+    # a changed DN for a known entryUUID means the entry was renamed, so
+    # the old DN has gone away just as if it had been deleted.
+    users = []
+    deleted = []
+    new_uuids = uuids.copy()
+    for (uuid, (dn, attrs)) in conn.entries.iteritems():
+      old_dn = uuids.get(uuid)
+      if old_dn and old_dn != dn.lower():
+        deleted.append(old_dn)
+      new_uuids[uuid] = dn.lower()
+      users.append((dn, attrs))
+    for uuid in conn.deleted:
+      if uuid in new_uuids:
+        deleted.append(new_uuids[uuid])
+        del new_uuids[uuid]
+    logging.debug('Content sync found %d changed and %d deleted entries' %
+                  (len(users), len(deleted)))
+    self._SaveSyncreplState(conn.cookie, new_uuids)
+    if cookie is None:
+      # a full refresh, with no entryUUIDs yet to report deletions by
+      deleted = None
+    return (userdb.UserDB(config=self._config, users=users), deleted)
+
+  def _ReadSyncreplState(self):
+    """ Read the syncrepl state saved by the last good run.  The first
+    line of the file is the cookie, and each following line is an
+    entryUUID and a DN, separated by a tab.
+    Returns:
+      the cookie (None if there isn't one), and a dictionary mapping
+      entryUUID to DN
+    """
+    cookie = None
+    uuids = {}
+    state = last_update_time.getState(self.state_prefix +
+                                      SYNCREPL_STATE_SUFFIX)
+    if not state:
+      return (cookie, uuids)
+    lines = state.split('\n')
+    if lines[0]:
+      cookie = lines[0]
+    for line in lines[1:]:
+      if line:
+        (uuid, dn) = line.split('\t', 1)
+        uuids[uuid] = dn
+    return (cookie, uuids)
+
+  def _SaveSyncreplState(self, cookie, uuids):
+    """ Arrange for the syncrepl state to be saved if this run is good.
+    Args:
+      cookie: the sync cookie the server last sent
+      uuids: dictionary mapping entryUUID to DN
+    """
+    lines = [cookie or '']
+    for (uuid, dn) in uuids.iteritems():
+      lines.append('%s\t%s' % (uuid, dn))
+    last_update_time.setPendingState(
+        self.state_prefix + SYNCREPL_STATE_SUFFIX, '%s\n' % '\n'.join(lines))
+
+  def _UsnSearchChanges(self, attrlist):
+    """ SearchChanges() for the 'usn' mode, for Active Directory.  The
+    domain controller's highestCommittedUSN is read before searching, and
+    saved as the watermark for the next run.  The changes are then:
+      - users passing ldap_user_filter with a uSNChanged above the last
+        watermark (all users, if there's no watermark yet)
+      - known users whose objects changed but no longer pass the filter
+        (disabled, moved, etc.), which count as deleted
+      - tombstones with a uSNChanged above the watermark, which are
+        matched to users by objectGUID, since that's all they keep
+    Args:
+      attrlist: as for SearchChanges()
+    Returns:
+      as for SearchChanges()
+    Raises:
+      RuntimeError: if not connected
+    """
+    if not self.conn:
+      raise RuntimeError('Not connected')
+    root_dse = self._ReadRootDSE(['dnsHostName', 'highestCommittedUSN',
+                                  'defaultNamingContext'])
+    if 'highestCommittedUSN' not in root_dse:
+      logging.error('%s does not report a highestCommittedUSN, so '
+                    'ldap_sync_mode usn cannot be used' % self.ldap_url)
+      return (None, None)
+    highest = int(root_dse['highestCommittedUSN'][0])
+    host = root_dse.get('dnsHostName', [self.ldap_url])[0]
+    state_suffix = '%s%s%s' % (self.state_prefix, USN_STATE_SUFFIX,
+                               host.lower())
+    (watermark, guids) = self._ReadUsnState(state_suffix)
+    if attrlist is not None and 'objectGUID' not in attrlist:
+      attrlist = list(attrlist) + ['objectGUID']
+
+    changed = None
+    tombstones = []
+    if watermark is None:
+      logging.debug('No USN watermark for %s; fetching all users' % host)
+      found = self.Search(filter_arg=self.ldap_user_filter, attrlist=attrlist)
+    else:
+      usn_cond = '(uSNChanged>=%d)' % (watermark + 1)
+      logging.debug('Searching %s for changes since USN %d' %
+                    (host, watermark))
+      found = self.Search(filter_arg='(&%s%s)' % (self.ldap_user_filter,
+                                                  usn_cond),
+                          attrlist=attrlist)
+      changed = self.Search(filter_arg=usn_cond, attrlist=['objectGUID'])
+      tombstones = self._SearchTombstones(
+          root_dse['defaultNamingContext'][0], usn_cond)
+      if changed is None or tombstones is None:
+        return (None, None)
+    if found is None:
+      return (None, None)
+
+    deleted = []
+    new_guids = guids.copy()
+    found_guids = set()
+    for (dn, attrs) in found.db.iteritems():
+      guid = _GuidKey(attrs.get('objectGUID'))
+      if not guid:
+        continue
+      found_guids.add(guid)
+      old_dn = guids.get(guid)
+      if old_dn and old_dn != dn:
+        deleted.append(old_dn)    # renamed
+      new_guids[guid] = dn
+    if changed:
+      for attrs in changed.db.itervalues():
+        guid = _GuidKey(attrs.get('objectGUID'))
+        if guid in guids and guid not in found_guids:
+          deleted.append(new_guids.pop(guid))
+    for guid in tombstones:
+      if guid in new_guids:
+        deleted.append(new_guids.pop(guid))
+    logging.debug('USN search found %d changed and %d deleted users' %
+                  (found.UserCount(), len(deleted)))
+    self._SaveUsnState(state_suffix, highest, new_guids)
+    if watermark is None:
+      # all the users, with no objectGUIDs yet to report deletions by
+      deleted = None
+    return (found, deleted)
+
+  def _ReadRootDSE(self, attrlist):
+    """ Read attributes of the server's root DSE
+    Args:
+      attrlist: attributes wanted
+    Returns:
+      dictionary of the attributes (whose values are lists), empty if
+      the root DSE couldn't be read
+    """
+    try:
+      results = self.conn.search_s('', ldap.SCOPE_BASE, '(objectClass=*)',
+                                   attrlist)
+    except ldap.LDAPError, e:
+      logging.exception('LDAP error reading the root DSE: %s' % str(e))
+      return {}
+    if not results:
+      return {}
+    return results[0][1]
+
+  def _SearchTombstones(self, base, usn_cond):
+    """ Find the objects deleted since the USN watermark.
+    Args:
+      base: DN of the domain naming context
+      usn_cond: LDAP filter condition on uSNChanged
+    Returns:
+      list of the tombstones' objectGUIDs (as returned by _GuidKey), or
+      None on error
+    """
+    query = '(&(isDeleted=TRUE)%s)' % usn_cond
+    show_deleted = LDAPControl(SHOW_DELETED_OID, True, None)
+    try:
+      if self.ldap_page_size:
+        results = self._PagedAsyncSearch(query, 0, attrlist=['objectGUID'],
+                                         base=base,
+                                         serverctrls=[show_deleted])
+      else:
+        results = self._AsyncSearch(query, 0, attrlist=['objectGUID'],
+                                    base=base, serverctrls=[show_deleted])
+    except ldap.LDAPError, e:
+      logging.exception('LDAP error searching for deleted objects: %s' %
+                        str(e))
+      return None
+    if results is None:
+      return None
+    guids = []
+    try:
+      for (dn, attrs) in results:
+        if dn and attrs:
+          guid = _GuidKey(attrs.get('objectGUID'))
+          if guid:
+            guids.append(guid)
+    finally:
+      results.close()
+    return guids
+
+  def _ReadUsnState(self, suffix):
+    """ Read the USN watermark and objectGUID -> DN map saved for a
+    domain controller by the last good run.  The first line of the file
+    is the watermark, and each following line is a hex objectGUID and a
+    DN, separated by a tab.
+    Args:
+      suffix: state file suffix for the domain controller
+    Returns:
+      the watermark (None if there isn't one), and a dictionary mapping
+      objectGUID to DN
+    """
+    watermark = None
+    guids = {}
+    state = last_update_time.getState(suffix)
+    if not state:
+      return (watermark, guids)
+    lines = state.split('\n')
+    try:
+      watermark = int(lines[0])
+    except ValueError:
+      logging.error('Bad USN watermark %s; fetching all users' % lines[0])
+      return (None, guids)
+    for line in lines[1:]:
+      if line:
+        (guid, dn) = line.split('\t', 1)
+        guids[guid] = dn
+    return (watermark, guids)
+
+  def _SaveUsnState(self, suffix, watermark, guids):
+    """ Arrange for the USN state to be saved if this run is good.
+    Args:
+      suffix: state file suffix for the domain controller
+      watermark: the highestCommittedUSN read at the start of this run
+      guids: dictionary mapping objectGUID to DN
+    """
+    lines = [str(watermark)]
+    for (guid, dn) in guids.iteritems():
+      lines.append('%s\t%s' % (guid, dn))
+    last_update_time.setPendingState(suffix, '%s\n' % '\n'.join(lines))
+
+  def ConcurrentSearch(self, searches):
+    """ Run several independent searches at the same time.  The first
+    search runs on this context's connection; each of the others gets
+    a connection of its own, so the total time is roughly that of the
+    slowest search rather than the sum of them all.
+    Args:
+      searches: list of (method, kwargs) tuples, where method is the name
+        of the search method to call, e.g. 'Search' or 'SearchChanges',
+        and kwargs is a dictionary of its arguments
+    Returns:
+      list of the return values of the searches, in the same order as
+      'searches'
+    Raises:
+      utils.ConfigError: if any required config items are not present
+      RuntimeError:  if not connected
+    """
+    if not self.conn:
+      raise RuntimeError('Not connected')
+    threads = []
+    for (method, kwargs) in searches[1:]:
+      ctxt = self._Clone()
+      if not ctxt:
+        logging.warn('unable to open another connection for %s(%s); it '
+                     'will be done after the others' % (method, kwargs))
+        threads.append(None)
+        continue
+      thread = SearchThread(ctxt, method, kwargs)
+      thread.start()
+      threads.append(thread)
+
+    (method, kwargs) = searches[0]
+    results = [getattr(self, method)(**kwargs)]
+    for ix in xrange(len(threads)):
+      thread = threads[ix]
+      if not thread:
+        (method, kwargs) = searches[ix + 1]
+        results.append(getattr(self, method)(**kwargs))
+        continue
+      thread.join()
+      if thread.exc_info:
+        (exc_type, exc_value, exc_tb) = thread.exc_info
+        raise exc_type, exc_value, exc_tb
+      results.append(thread.result)
+    return results
+
+
+def TimestampFilter(search_filter, attr, stamp, directory_type):
+  """ AND in the "modifyTimestamp > time" condition to a filter
+  Args:
+    search_filter: LDAP filter expression
+    attr: name of LDAP attribute containing the timestamp
+    stamp: the time the attribute must be at or after, as YYYYMMDDHHMMSS
+    directory_type: one of 'ad', 'openldap', 'eDirectory'. This is used to
+      deal with differences in directories around querying
+      modifyTimestamp
+  Returns:
+    the new filter
+  """
+  # NOTE: The following table summarizes the format the modifyTimestamp
+  #       filter needs to be in for various directories
+  #
+  #                    %sZ  %s.Z   %s.0Z
+  #  ad                 N     Y      Y
+  #  edirectory         Y     N      N
+  #  openldap           Y     N      Y
+  if directory_type == 'ad':
+    cond = '%s>=%s.Z' % (attr, stamp)
+  else:
+    cond = '%s>=%sZ' % (attr, stamp)
+  return '(&%s(%s))' % (search_filter, cond)
+
+
+def _GuidKey(value):
+  """ Convert a raw objectGUID attribute value to the hex string used
+  as the key of the objectGUID -> DN map.
+  Args:
+    value: the value, or a list containing it, or None
+  Returns:
+    lower-case hex string, or None
+  """
+  if isinstance(value, list):
+    if not value:
+      return None
+    value = value[0]
+  if not value:
+    return None
+  return binascii.hexlify(value)
+
+
+class SearchThread(threading.Thread):
+
+  """ A thread which runs a single search on a (cloned) LdapContext,
+  and disconnects it when done.  Any exception raised by the search is
+  saved in 'exc_info' for the caller to re-raise.
+  """
+  def __init__(self, ldap_context, method, kwargs, disconnect=True):
+    """ Constructor
+    Args:
+      ldap_context: a connected LdapContext, which this thread will own
+      method: name of the LdapContext search method to call
+      kwargs: dictionary of arguments for the method
+      disconnect: whether to disconnect the LdapContext when done
+    """
+    threading.Thread.__init__(self)
+    self._ldap_context = ldap_context
+    self._method = method
+    self._kwargs = kwargs
+    self._disconnect = disconnect
+    self.result = None
+    self.exc_info = None
+
+  def run(self):
+    """ Starts the thread
+    """
+    logging.debug('thread %s started' % self.getName())
+    try:
+      try:
+        search = getattr(self._ldap_context, self._method)
+        self.result = search(**self._kwargs)
+      except:
+        self.exc_info = sys.exc_info()
+    finally:
+      if self._disconnect:
+        self._ldap_context.Disconnect()
+
+
+if SyncreplConsumer:
+  class SyncreplConnection(LDAPObject, SyncreplConsumer):
+
+    """ An LDAP connection for a refreshOnly content synchronization
+    (RFC 4533) search.  python-ldap's SyncreplConsumer calls the
+    syncrepl_* methods below from syncrepl_poll(); they just collect what
+    the server says has changed.
+    """
+    def __init__(self, uri, cookie, uuids):
+      """ Constructor
+      Args:
+        uri: URL of the LDAP server
+        cookie: sync cookie from the last run, or None for a full refresh
+        uuids: dictionary of entryUUID -> DN as of the last run
+      """
+      LDAPObject.__init__(self, uri)
+      self.cookie = cookie
+      self.entries = {}       # entryUUID -> (DN, attrs) of changed entries
+      self.deleted = set()    # entryUUIDs of deleted entries
+      self._uuids = uuids
+      self._present = set()
+
+    def syncrepl_get_cookie(self):
+      return self.cookie
+
+    def syncrepl_set_cookie(self, cookie):
+      self.cookie = cookie
+
+    def syncrepl_entry(self, dn, attributes, uuid):
+      self.entries[uuid] = (dn, attributes)
+      self._present.add(uuid)
+
+    def syncrepl_delete(self, uuids):
+      for uuid in uuids:
+        self.deleted.add(uuid)
 
-    return userdb.UserDB(config=self._config, users=users)
+    def syncrepl_present(self, uuids, refreshDeletes=False):
+      """ During the "present" phase the server lists the entries that
+      still exist; at the end of it (uuids is None), any we knew about
+      that weren't listed have been deleted.
+      """
+      if uuids is not None:
+        for uuid in uuids:
+          self._present.add(uuid)
+        return
+      if not refreshDeletes:
+        for uuid in self._uuids:
+          if uuid not in self._present:
+            self.deleted.add(uuid)
+      self._present = set()
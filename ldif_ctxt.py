@@ -0,0 +1,503 @@
+#!/usr/bin/python2.4
+#
+# Copyright 2006 Google, Inc.
+# All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License")
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+
+""" An LDIF file as a stand-in for the LDAP server
+
+class LdifContext: an LdapContext which searches an LDIF export
+class FilterError: an exception for an LDAP filter that can't be parsed
+
+The file is read a record at a time, with python-ldap's LDIF parser, and
+each record is tested against the search filter locally, so large
+exports can be searched without holding them in memory.  The records
+found go into a result_spool.ResultSpool, so past ldap_memory_budget
+they're held on disk, as a server's results are; when they're only
+being counted, they aren't kept at all.
+"""
+
+import ldap_ctxt
+import ldif
+import logging
+import messages
+import re
+import result_spool
+import userdb
+
+# AD's matching rules for userAccountControl and the like
+MATCH_BIT_AND = '1.2.840.113556.1.4.803'
+MATCH_BIT_OR = '1.2.840.113556.1.4.804'
+
+_ESCAPE_RE = re.compile(r'\\([0-9a-fA-F]{2})')
+_GENERALIZED_TIME_RE = re.compile(r'^\d{14}')
+_DN_SEPARATOR_RE = re.compile(r'\s*,\s*')
+
+
+class FilterError(Exception):
+  """ Raised for an LDAP filter (RFC 4515) that can't be parsed
+  """
+
+
+class LdifContext(ldap_ctxt.LdapContext):
+
+  """ An LdapContext whose searches are done against an LDIF file,
+  rather than a live LDAP server.  Only Search() is supported; there's
+  no change tracking, so ldap_sync_mode is ignored, and updateUsers
+  relies on the timestamp attribute as usual.
+  """
+  config_parms = ldap_ctxt.LdapContext.config_parms.copy()
+  config_parms.update({'ldif_file': messages.MSG_LDIF_FILE})
+
+  def __init__(self, config, **moreargs):
+    """ Constructor
+    Args:
+      config: a utils.Config object, which should have been initialized with
+        the Sync Tool's configuration.
+    """
+    self.ldif_file = None
+    super(LdifContext, self).__init__(config, **moreargs)
+    self._required_config = ['ldif_file', 'ldap_user_filter']
+
+  def Connect(self):
+    """ Overrides: the superclass method.  Just checks that the LDIF file
+    can be read.
+    Returns:
+      None if success, -1 if error occurred
+    Raises:
+      utils.ConfigError: if ldif_file is not set
+    """
+    self._config.TestConfig(self, ['ldif_file'])
+    try:
+      f = open(self.ldif_file, 'rb')
+      f.close()
+    except IOError, e:
+      logging.error('Cannot read LDIF file %s: %s' % (self.ldif_file, str(e)))
+      return -1
+    # stands in for the connection, so "connected" means what it does for
+    # the superclass
+    self.conn = self.ldif_file
+    return None
+
+  def Disconnect(self):
+    """ Overrides: the superclass method.
+    """
+    self.conn = None
+
+  def IsTrackingChanges(self):
+    """ Overrides: the superclass method.  An LDIF export has no change
+    tracking.
+    """
+    return False
+
+  def CountUsers(self, filter_arg=None):
+    """ Overrides: the superclass method.  The records passing the
+    filter are counted as they're read, rather than kept.
+    """
+    reader = self._ReadMatching(filter_arg, 0, ['1.1'], None)
+    if reader is None:
+      return None
+    return reader.count
+
+  def GetSchemaAttributes(self, object_classes):
+    """ Overrides: the superclass method.  An LDIF export has no schema.
+    """
+    return None
+
+  def Search(self, filter_arg=None, sizelimit=0, attrlist=None):
+    """ Overrides: the superclass method.  The LDIF file is read a record
+    at a time, and the records passing the filter are spooled as they're
+    read (see result_spool), then loaded into the UserDB.
+    Args:
+      filter_arg: LDAP search filter to use. If not provided, the
+        configured ldap_user_filter is used.
+      sizelimit: limits the number of users returned. If zero,all
+        users matching the user search filter are returned
+      attrlist: attributes to return for each user.  If None, all
+        attribute are returned
+    Returns:
+      a UserDB, or None if the filter or file couldn't be read
+    Raises:
+      utils.ConfigError: if any required config items are not present
+      RuntimeError:  if not connected
+    """
+    users = result_spool.ResultSpool(self.ldap_memory_budget)
+    try:
+      if self._ReadMatching(filter_arg, sizelimit, attrlist, users) is None:
+        return None
+      return userdb.UserDB(config=self._config, users=users)
+    finally:
+      users.close()
+
+  def _ReadMatching(self, filter_arg, sizelimit, attrlist, entries):
+    """ Read the LDIF file, passing the records under ldap_base_dn which
+    pass the filter to a _MatchingRecords.
+    Args:
+      filter_arg, sizelimit, attrlist: as for Search()
+      entries: as for _MatchingRecords()
+    Returns:
+      the _MatchingRecords, or None if the filter or file couldn't be
+      read
+    Raises:
+      as for Search()
+    """
+    self._config.TestConfig(self, self._required_config)
+    query = filter_arg
+    if not query:
+      query = self.ldap_user_filter
+    if not self.conn:
+      raise RuntimeError('Not connected')
+    try:
+      filter_tree = ParseFilter(query)
+    except FilterError, e:
+      logging.error('Cannot parse LDAP filter %s: %s' % (query, str(e)))
+      return None
+
+    logging.debug('Search of %s for %s' % (self.ldif_file, query))
+    try:
+      f = open(self.ldif_file, 'rb')
+    except IOError, e:
+      logging.exception('Cannot read LDIF file %s: %s' %
+                        (self.ldif_file, str(e)))
+      return None
+    base = None
+    if self.ldap_base_dn:
+      base = _NormalizeDN(self.ldap_base_dn)
+    reader = _MatchingRecords(f, base, filter_tree, sizelimit, attrlist,
+                              entries)
+    try:
+      try:
+        reader.parse()
+      except _EnoughRecords:
+        pass
+      except (IOError, ValueError), e:
+        logging.exception('Error reading LDIF file %s: %s' %
+                          (self.ldif_file, str(e)))
+        return None
+    finally:
+      f.close()
+    return reader
+
+
+def _NormalizeDN(dn):
+  """ Lower-case a DN and remove the spaces around its separators, good
+  enough to compare DNs written by the same tool.
+  """
+  return _DN_SEPARATOR_RE.sub(',', dn.strip().lower())
+
+
+def _SelectAttrs(attrs, attrlist):
+  """ Keep just the requested attributes of a record, as an LDAP server
+  would.
+  Args:
+    attrs: dictionary of attribute name -> list of values
+    attrlist: list of attribute names, or None for all.  '*' means all,
+      and '1.1' none.
+  Returns:
+    dictionary of attribute name -> list of values
+  """
+  if attrlist is None or '*' in attrlist:
+    return attrs
+  if '1.1' in attrlist:
+    return {}
+  wanted = set([attr.lower() for attr in attrlist])
+  result = {}
+  for (attr, vals) in attrs.iteritems():
+    if attr.lower() in wanted:
+      result[attr] = vals
+  return result
+
+
+"""
+*********************************************************************
+LDIF reading (RFC 2849)
+*********************************************************************
+"""
+
+class _MatchingRecords(ldif.LDIFParser):
+
+  """ Reads the content records of an LDIF file with python-ldap's
+  parser, keeping those which are under a base DN and pass a filter.
+  Change records are skipped, other than adds.  Values given by URL
+  ("attr:< file:///...") are never fetched, since the file could name
+  anything the Tool can read; they're left out, with a warning.
+  """
+
+  def __init__(self, f, base, filter_tree, sizelimit, attrlist, entries):
+    """ Constructor
+    Args:
+      f: the open LDIF file
+      base: normalized DN (see _NormalizeDN()) the records must be at
+        or under, or None
+      filter_tree: parsed filter, from ParseFilter()
+      sizelimit: max # of records to keep, or 0 for no limit
+      attrlist: as for LdifContext.Search()
+      entries: list-like (e.g. a result_spool.ResultSpool) to append the
+        (dn, attrs) of the records kept to, or None to just count them
+    """
+    ldif.LDIFParser.__init__(self, f, process_url_schemes=[])
+    self._base = base
+    self._filter_tree = filter_tree
+    self._sizelimit = sizelimit
+    self._attrlist = attrlist
+    self._entries = entries
+    self.count = 0
+
+  def handle(self, dn, entry):
+    """ Reserved method name for ldif.LDIFParser
+    """
+    for (attr, vals) in entry.items():
+      if attr.lower() == 'changetype':
+        if [val.lower() for val in vals if val] != ['add']:
+          return
+        del entry[attr]
+      elif None in vals:
+        logging.warn('Ignoring the %s of %s given by URL' % (attr, dn))
+        vals = [val for val in vals if val is not None]
+        if vals:
+          entry[attr] = vals
+        else:
+          del entry[attr]
+    if self._base:
+      norm_dn = _NormalizeDN(dn)
+      if norm_dn != self._base and not norm_dn.endswith(',' + self._base):
+        return
+    if not MatchFilter(self._filter_tree, entry):
+      return
+    self.count += 1
+    if self._entries is not None:
+      self._entries.append((dn, _SelectAttrs(entry, self._attrlist)))
+    if self._sizelimit and self.count >= self._sizelimit:
+      raise _EnoughRecords()
+
+
+class _EnoughRecords(Exception):
+  """ Stops a _MatchingRecords once it has found 'sizelimit' records
+  """
+
+
+"""
+*********************************************************************
+LDAP filters (RFC 4515), evaluated locally
+*********************************************************************
+"""
+
+def ParseFilter(filter_str):
+  """ Parse an LDAP filter string into a tree of tuples:
+    ('&', [subfilters]), ('|', [subfilters]), ('!', subfilter),
+    ('present', attr), ('substr', attr, [pieces]) where the pieces are
+    separated by wildcards, (op, attr, value) for op '=', '~=', '>=' or
+    '<=', and ('ext', attr, rule, value) for extensible matches.
+  Args:
+    filter_str: the filter
+  Returns:
+    the tree
+  Raises:
+    FilterError: if it can't be parsed
+  """
+  s = filter_str.strip()
+  if not s.startswith('('):
+    s = '(%s)' % s     # servers accept a bare item, so we do too
+  (tree, pos) = _ParseFilter(s, 0)
+  if pos != len(s):
+    raise FilterError('unexpected text at %d' % pos)
+  return tree
+
+
+def _ParseFilter(s, pos):
+  """ Parse the filter starting with the '(' at s[pos]
+  Returns:
+    (tree, position after the closing ')')
+  """
+  if pos >= len(s) or s[pos] != '(':
+    raise FilterError('expected ( at %d' % pos)
+  pos += 1
+  if pos >= len(s):
+    raise FilterError('unterminated filter')
+  op = s[pos]
+  if op in '&|':
+    pos += 1
+    subs = []
+    while pos < len(s) and s[pos] == '(':
+      (sub, pos) = _ParseFilter(s, pos)
+      subs.append(sub)
+    tree = (op, subs)
+  elif op == '!':
+    (sub, pos) = _ParseFilter(s, pos + 1)
+    tree = ('!', sub)
+  else:
+    end = s.find(')', pos)
+    if end < 0:
+      raise FilterError('unterminated filter')
+    tree = _ParseItem(s[pos:end])
+    pos = end
+  if pos >= len(s) or s[pos] != ')':
+    raise FilterError('expected ) at %d' % pos)
+  return (tree, pos + 1)
+
+
+def _ParseItem(item):
+  """ Parse a simple filter item, e.g. "cn=fred*"
+  """
+  ix = item.find('=')
+  if ix < 1:
+    raise FilterError('bad filter item: %s' % item)
+  value = item[ix + 1:]
+  if item[ix - 1] in '~<>:':
+    op = item[ix - 1] + '='
+    attr = item[:ix - 1]
+  else:
+    op = '='
+    attr = item[:ix]
+  if op == ':=':
+    pieces = attr.split(':')
+    attr = pieces[0]
+    rule = None
+    for piece in pieces[1:]:
+      if piece.lower() != 'dn':
+        rule = piece
+    return ('ext', attr, rule, _Unescape(value))
+  if op == '=':
+    if value == '*':
+      return ('present', attr)
+    if '*' in value:
+      return ('substr', attr, [_Unescape(p) for p in value.split('*')])
+  return (op, attr, _Unescape(value))
+
+
+def _Unescape(value):
+  """ Undo the \\XX escapes of a filter value
+  """
+  return _ESCAPE_RE.sub(lambda m: chr(int(m.group(1), 16)), value)
+
+
+def MatchFilter(tree, attrs):
+  """ Evaluate a parsed filter against a record
+  Args:
+    tree: from ParseFilter()
+    attrs: dictionary of attribute name -> list of values
+  Returns:
+    True if the record passes the filter
+  """
+  op = tree[0]
+  if op == '&':
+    for sub in tree[1]:
+      if not MatchFilter(sub, attrs):
+        return False
+    return True
+  if op == '|':
+    for sub in tree[1]:
+      if MatchFilter(sub, attrs):
+        return True
+    return False
+  if op == '!':
+    return not MatchFilter(tree[1], attrs)
+
+  vals = _Values(attrs, tree[1])
+  if op == 'present':
+    return len(vals) > 0
+  if op == 'substr':
+    pieces = [_Normalize(p) for p in tree[2]]
+    for val in vals:
+      if _MatchSubstrings(_Normalize(val), pieces):
+        return True
+    return False
+  if op == 'ext':
+    return _MatchExtensible(vals, tree[2], tree[3])
+  for val in vals:
+    cmp_result = _Compare(val, tree[2])
+    if op in ('=', '~=') and cmp_result == 0:
+      return True
+    if op == '>=' and cmp_result >= 0:
+      return True
+    if op == '<=' and cmp_result <= 0:
+      return True
+  return False
+
+
+def _Values(attrs, attr):
+  """ The values of an attribute of a record, whatever its case
+  """
+  if attr in attrs:
+    return attrs[attr]
+  lattr = attr.lower()
+  for (name, vals) in attrs.iteritems():
+    if name.lower() == lattr:
+      return vals
+  return []
+
+
+def _Normalize(value):
+  """ Case-ignore, space-insensitive form of a value, which is how most
+  user attributes are compared.
+  """
+  return ' '.join(value.lower().split())
+
+
+def _Compare(val, assertion):
+  """ Order a value and a filter's assertion value: numerically if both
+  are integers, by the seconds if both are GeneralizedTime (which can
+  differ in their fractions and time zone), and otherwise as
+  case-ignore strings.
+  Returns:
+    negative, zero or positive, as for cmp()
+  """
+  try:
+    return cmp(int(val), int(assertion))
+  except ValueError:
+    pass
+  if _GENERALIZED_TIME_RE.match(val) and _GENERALIZED_TIME_RE.match(assertion):
+    return cmp(val[:14], assertion[:14])
+  return cmp(_Normalize(val), _Normalize(assertion))
+
+
+def _MatchSubstrings(val, pieces):
+  """ Match a normalized value against the pieces of a substring filter
+  (the first piece is the initial string, the last the final one, and
+  any empty ones are where the wildcards were next to each other or at
+  an end.)
+  """
+  initial = pieces[0]
+  final = pieces[-1]
+  if not val.startswith(initial):
+    return False
+  pos = len(initial)
+  for piece in pieces[1:-1]:
+    ix = val.find(piece, pos)
+    if ix < 0:
+      return False
+    pos = ix + len(piece)
+  return val.endswith(final) and len(val) - len(final) >= pos
+
+
+def _MatchExtensible(vals, rule, assertion):
+  """ Evaluate an extensible match.  AD's bitwise rules are supported;
+  any other rule is treated as equality.
+  """
+  for val in vals:
+    if rule in (MATCH_BIT_AND, MATCH_BIT_OR):
+      try:
+        bits = int(assertion)
+        masked = int(val) & bits
+      except ValueError:
+        continue
+      if rule == MATCH_BIT_AND and masked == bits:
+        return True
+      if rule == MATCH_BIT_OR and masked:
+        return True
+    elif _Compare(val, assertion) == 0:
+      return True
+  return False
@@ -109,6 +109,53 @@ MSG_SYNC_GOOGLE_DOMAIN = "The target domain in Google Apps for Your Domain."
 MSG_SYNC_GOOGLE_MAX_THREADS = """The maximum number of threads to be created at
 any one time for communication with Google."""
 
+MSG_SYNC_GOOGLE_MIN_THREADS = """The minimum number of threads to be kept busy
+communicating with Google.  Between this and max_threads, the number is
+adjusted as the sync runs: raised while Google responds quickly, and
+cut when its responses slow down or it reports quota or 503 errors."""
+
+MSG_SYNC_GOOGLE_RATE_LIMITS = """The most calls per second to make to Google, for
+each type of operation: added, exited, renamed, updated, read, or all (which
+covers every call).  Each is a number of calls per second, or a tuple of that
+and the number of calls allowed through in a burst after a quiet spell, e.g.
+{'added': 2, 'updated': (5, 20), 'all': 10}
+Types not listed have no limit."""
+
+MSG_SYNC_GOOGLE_MAX_RETRIES = """The number of times to retry a user whose
+operation on Google failed for a reason which may go away, e.g. a 503, a
+quota error, or a timeout.  The retries wait longer each time, starting at
+a few seconds."""
+
+MSG_SYNC_GOOGLE_AUTH_TOKEN_FILE = """A file in which to keep the token from
+authenticating to Google, so that the next run can use it rather than
+authenticate again, until it is close to expiring.  It is created readable
+only by its owner.  If not set, each run authenticates once."""
+
+MSG_SYNC_GOOGLE_HTTP_POOL_SIZE = """The number of idle connections to each
+Google host to keep open for reuse, saving a TCP and SSL handshake on each
+call.  0 means a new connection for every call."""
+
+MSG_SYNC_GOOGLE_HTTP_IDLE_TIMEOUT = """How long, in seconds, an idle
+connection to Google is kept open for reuse."""
+
+MSG_SYNC_GOOGLE_PREFLIGHT = """If true, before adding users, look up which of
+them already have accounts in Google (because this tool created them
+earlier, e.g. users being re-added after being exited), and just unlock and
+update those, rather than try to create them first."""
+
+MSG_SYNC_GOOGLE_PROGRESS_LOG = """The name of a file to record each user in as
+soon as their result comes back from Google, so that if the Tool dies before
+the user data file (-f) is written, the next run with that user data file
+picks up where it left off rather than redoing them.  The file is removed
+once the user data file has been written.  It's only kept when there is a
+user data file, and only replayed onto that same file as it was when the
+record was started; any other is thrown away.  If not provided, no such
+record is kept."""
+
+MSG_SYNC_GOOGLE_PROGRESS_SYNC_EVERY = """The most users recorded in the
+progress_log before it is flushed to disk (it is also flushed at least every
+second).  A crash loses at most this many users' results."""
+
 MSG_SYNC_GOOGLE_ALLOWED = """The operations permitted to be performed on
 Google Apps for Your Domain. Must be a comma-separated list comprised of the
 following keywords:  added,updated,exited,renamed.  If not provided, all operations
@@ -138,6 +185,9 @@ Instead, use the attrList command.
 ERR_NO_SET_ATTRS = """The 'attrs' variable may not be set directly
 like this.  Consult the help for the correct command."""
 
+ERR_NO_SET_SOURCES = """The 'ldap_sources' variable may not be set directly
+like this.  Edit it in the config file."""
+
 ERR_NO_SET_MAPPING = """The 'mapping' variable may not be set directly
 like this.  Consult the help for the correct command."""
 
@@ -163,6 +213,25 @@ to request more on subsequent requests.  If you have such a server, set this to
 a positive integer.  If your ldap server does not require paging leave this at
 the default value of 0."""
 
+MSG_LDAP_MAX_RETRIES = """How many times to reconnect to your LDAP server and
+retry a search when the connection drops or times out.  Paged searches
+resume from the last page received."""
+
+MSG_LDAP_MEMORY_BUDGET = """The most LDAP search results to hold in memory
+while a search is running.  Past this many, results are written to a
+temporary file until the search is done.  Set this on hosts with little
+memory and very large directories; 0 means no limit."""
+
+MSG_LDAP_SYNC_MODE = """How to find the users which have changed since the
+last run.  'timestamp' (the default) searches on the timestamp attribute,
+and searches for all users to find the deleted ones.  'syncrepl' uses the
+LDAP Content Synchronization protocol (RFC 4533, e.g. OpenLDAP's syncprov
+overlay) to get exactly the added, modified and deleted users since the
+last run.  'usn' (Active Directory only) searches for uSNChanged above the
+highest USN the domain controller had committed at the start of the last
+run, and finds deleted users from their tombstones.  The state for these
+modes is kept in files next to the last_update_file."""
+
 MSG_LDAP_USER_FILTER = """Filter expression for your LDAP server which
 returns your active users. Examples:
 (objectclass=organizationalPerson)
@@ -175,6 +244,23 @@ this if you do not delete the LDAP records for exited users, but
 instead "disable" them or otherwise leave the objects in place.
 """
 
+MSG_LDAP_SOURCES = """A list of LDAP servers to take users from, instead of
+the single ldap_url.  Each is a dictionary of the ldap_* variables (and
+'timestamp') which are different for that server, e.g.
+[{'name': 'emea', 'ldap_url': 'ldap://dc1.emea.example.com',
+  'ldap_base_dn': 'DC=emea,DC=example,DC=com'},
+ {'name': 'unix', 'ldap_url': 'ldap://ldap.example.com',
+  'ldap_base_dn': 'ou=people,dc=example,dc=com',
+  'ldap_user_filter': '(objectClass=posixAccount)',
+  'timestamp': 'modifyTimestamp'}]
+If two servers have users with the same Google username, the server
+listed first wins."""
+
+MSG_LDIF_FILE = """An LDIF export of your directory, to read users from
+instead of your LDAP server.  If this is set, ldap_url is not used, and the
+user filter is applied to the file's records by the Sync Tool itself.  Values
+given by URL ("attr:< file:///...") are not read."""
+
 MSG_LDAP_BASE_DN = """Distinguished name at the root of your user records
 in your LDAP server."""
 
@@ -564,6 +650,34 @@ Since this is an open source package, you are welcome to change these actions
 to fit your organization's policies and practices.
 """
 
+# reconcileUsers command
+MSG_RECONCILE_FETCHING = """Retrieving %s accounts from Google Apps for Your
+Domain..."""
+
+MSG_RECONCILE_SNAPSHOT = """%s accounts found, %s not found, %s could not be
+retrieved (those users are left as they are)."""
+
+MSG_RECONCILE_CHANGE = "%8d users: %s -> %s"
+
+MSG_RECONCILE_NO_CHANGES = """Google Apps for Your Domain matches your
+database. No changes needed."""
+
+MSG_RECONCILE_PROCEED = 'Apply those changes (y/n) '
+
+MSG_RECONCILE_APPLIED = """%s users re-marked. Use 'syncAllUsers' to carry out
+their actions."""
+
+HELP_RECONCILE_USERS = """Compare every user in the user database with their
+account in Google Apps for Your Domain, and correct how each is marked.
+This is the same comparison as syncOneUser makes, for all users at once,
+and it also finds users marked as up to date whose accounts are missing
+(which are marked 'added'), have been left under their old username
+('renamed'), or differ from the database ('updated').  Usage:
+reconcileUsers [-f]
+where -f applies the changes without asking.  Nothing is sent to Google
+until the next syncAllUsers.
+"""
+
 
 # writeUsers: write out the users to XML file
 MSG_WRITE_USERS = "Writing user file to %s"
@@ -606,6 +720,11 @@ renamed."""
 MSG_UPDATE_RESULTS = """%s users updated successfully. %s users could not be 
 updated."""
 MSG_CONSULT_LOG = "Consult log file for details."
+MSG_PROGRESS_REPLAYED = """Recovered the results for %s users from %s, left by
+an earlier run which didn't finish."""
+
+MSG_THROTTLED_RESULTS = """Calls to Google waited %.1f seconds in all for the
+rate_limits."""
 
 MSG_EXIT_EXITED_USER = """Attempted exit of %s which does not exist in 
 Google Apps."""
@@ -616,5 +735,11 @@ prior errors or inactivity."""
 MSG_UPDATING_LAST_UPDATE_TIME = "Updating last update time to %s"
 
 MSG_EMPTY_LDAP_SEARCH_RESULT = "Empty ldap search result"
+MSG_SOURCE_CONFLICT = """Skipping %s from source %s: its Google username %s
+is already used by %s"""
+MSG_SOURCE_SUPERSEDED = """Dropping %s: its Google username %s now belongs
+to %s, from source %s, which is listed first"""
+ERR_LDAP_SEARCH_FAILED = """An LDAP search failed, so no users have been
+marked.  Try updateUsers again."""
 MSG_SUCCESSFULLY_HANDLED = "Successfully handled action '%s' on dn %s"
 
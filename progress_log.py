@@ -0,0 +1,272 @@
+#!/usr/bin/python2.4
+#
+# Copyright 2006 Google, Inc.
+# All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License")
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+
+""" Remembers what's been done in Google, in case the Tool dies before the
+user data file is written
+
+class ProgressLog: a write-ahead log of the users handled
+function DataFileKey: what identifies the user data file a log goes with
+function Replay: apply a ProgressLog to a UserDB
+function Clear: remove a ProgressLog, once the user data file has it all
+"""
+
+import base64
+import logging
+import os
+import sha
+import threading
+import time
+import types
+
+# the longest a record waits to be fsync'ed, in seconds
+SYNC_INTERVAL = 1.0
+
+# the types of value a record can hold, each with the letter it's saved
+# under; a list's items are saved as strings
+_TYPES = {types.StringType: 's', types.UnicodeType: 'u',
+          types.IntType: 'i', types.BooleanType: 'b',
+          types.NoneType: 'n', types.ListType: 'l'}
+_KINDS = set(_TYPES.values())
+
+
+class ProgressLog(object):
+
+  """ An append-only file with a record for each user handled by the
+  GoogleResultHandler: the user's whole record just after, LDAP
+  attributes and all, since the user data file the next run starts from
+  may not have the user at all (if added during this run), or have an
+  older copy of the user (if updated or renamed).
+  Records are fsync'ed in batches, of 'sync_every' records or
+  SYNC_INTERVAL seconds' worth, whichever comes first, so a crash loses
+  at most one batch.
+
+  It's a text file.  The first line is a digest of the key of the user
+  data file the records go with (see DataFileKey), so they're never
+  replayed onto any other.  Each of the others is a record: the user's
+  DN in base64, then for each attribute its name, the letter for its
+  type, and its value in base64.  A record torn by a crash has no
+  newline, and is simply dropped by Replay().
+  """
+
+  def __init__(self, fname, key, sync_every=100):
+    """ Constructor.  Opens the file, for appending if it's for the same
+    user data file, or afresh if not.
+    Args:
+      fname: name of the file
+      key: DataFileKey() of the user data file
+      sync_every: the most records written between fsyncs
+    Raises:
+      IOError: if the file can't be opened
+    """
+    self.fname = fname
+    self.sync_every = sync_every
+    self._lock = threading.Lock()
+    digest = _Digest(key)
+    if _ReadDigest(fname) != digest:
+      Clear(fname)
+    fd = os.open(fname, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0600)
+    self._file = os.fdopen(fd, 'a')
+    if not os.fstat(fd).st_size:
+      self._file.write('%s\n' % digest)
+    self._pending = 0
+    self._last_sync = time.time()
+
+  def Record(self, dn, attrs):
+    """ Write a record for a user
+    Args:
+      dn: DN of the user
+      attrs: the user's attributes, as now in the UserDB
+    """
+    fields = [base64.b64encode(dn)]
+    for (name, val) in attrs.iteritems():
+      (kind, val) = _Encode(val)
+      fields.append('%s %s %s' % (name, kind, val))
+    line = ' '.join(fields)
+    self._lock.acquire()
+    try:
+      self._file.write(line + '\n')
+      self._pending += 1
+      if (self._pending >= self.sync_every or
+          time.time() - self._last_sync >= SYNC_INTERVAL):
+        self._Sync()
+    finally:
+      self._lock.release()
+
+  def Sync(self):
+    """ Make sure all the records so far are on disk
+    """
+    self._lock.acquire()
+    try:
+      self._Sync()
+    finally:
+      self._lock.release()
+
+  def Close(self):
+    self._lock.acquire()
+    try:
+      self._Sync()
+      self._file.close()
+    finally:
+      self._lock.release()
+
+  def _Sync(self):
+    if self._pending:
+      self._file.flush()
+      os.fsync(self._file.fileno())
+      self._pending = 0
+    self._last_sync = time.time()
+
+
+def DataFileKey(data_file):
+  """ What identifies a user data file as it now is: its full name, the
+  time it was last written, and its size.  A ProgressLog is only good
+  for the file it was written against; once the file is rewritten, it
+  has all the log's records, and replaying them would undo anything
+  done since.
+  Args:
+    data_file: name of the file
+  Returns:
+    the key, a string
+  """
+  try:
+    st = os.stat(data_file)
+    (mtime, size) = (repr(st.st_mtime), str(st.st_size))
+  except OSError:
+    (mtime, size) = ('-', '-')
+  return '%s %s %s' % (os.path.abspath(data_file), mtime, size)
+
+
+def Replay(fname, users, key):
+  """ Apply the records in a ProgressLog to a UserDB read from the user
+  data file, so the users handled since it was written aren't handled
+  again.  Each record replaces the user's, or is added if the user
+  isn't in the UserDB (see UserDB.RestoreUser); anything after a record
+  that can't be read is skipped.  A log written against any other user
+  data file, or against none (key None), is stale: it's removed, and
+  nothing is applied.
+  Args:
+    fname: name of the file; it needn't exist
+    users: the userdb.UserDB
+    key: DataFileKey() of the user data file 'users' was read from, or
+      None if there isn't one
+  Returns:
+    the number of records applied
+  """
+  if not os.path.exists(fname):
+    return 0
+  if key is None or _ReadDigest(fname) != _Digest(key):
+    logging.warn('%s: ignoring it, as it was not written against the '
+                 'user data file: %s' % (fname, key))
+    Clear(fname)
+    return 0
+  count = 0
+  f = open(fname, 'r')
+  try:
+    f.readline()
+    for line in f:
+      try:
+        (dn, attrs) = _ParseRecord(line)
+      except Exception, e:
+        logging.warn('%s: ignoring the rest, from a bad record: %s' %
+                     (fname, str(e)))
+        break
+      users.RestoreUser(dn, attrs)
+      count += 1
+  finally:
+    f.close()
+  return count
+
+
+def Clear(fname):
+  """ Remove a ProgressLog, e.g. once the user data file has been written
+  """
+  if os.path.exists(fname):
+    os.remove(fname)
+
+def _Digest(key):
+  """ What's saved to identify the user data file
+  """
+  return sha.new(key).hexdigest()
+
+def _ReadDigest(fname):
+  """ The digest a ProgressLog starts with, or None if there's no such
+  file, or it's empty
+  """
+  if not os.path.exists(fname):
+    return None
+  f = open(fname, 'r')
+  try:
+    line = f.readline()
+  finally:
+    f.close()
+  if not line.endswith('\n'):
+    return None
+  return line[:-1]
+
+def _Encode(val):
+  """ The letter for a value's type, and the value as written
+  """
+  kind = _TYPES.get(type(val), 's')
+  if kind == 'l':
+    return (kind, ','.join([base64.b64encode(_Str(item)) for item in val]))
+  return (kind, base64.b64encode(_Str(val)))
+
+def _Str(val):
+  if type(val) is types.UnicodeType:
+    return val.encode('utf-8')
+  return str(val)
+
+def _Decode(kind, val):
+  """ A value, from what _Encode() gave
+  """
+  if kind not in _KINDS:
+    raise ValueError('unknown type %s' % kind)
+  if kind == 'l':
+    if not val:
+      return []
+    return [base64.b64decode(item) for item in val.split(',')]
+  val = base64.b64decode(val)
+  if kind == 'n':
+    return None
+  if kind == 'b':
+    return val == 'True'
+  if kind == 'i':
+    return int(val)
+  if kind == 'u':
+    return val.decode('utf-8')
+  return val
+
+def _ParseRecord(line):
+  """ The DN and attributes from a line written by ProgressLog.Record()
+  Raises:
+    ValueError: if the line is torn, or not a record
+  """
+  if not line.endswith('\n'):
+    raise ValueError('incomplete record')
+  fields = line[:-1].split(' ')
+  if len(fields) % 3 != 1:
+    raise ValueError('malformed record')
+  attrs = {}
+  for ix in xrange(1, len(fields), 3):
+    (name, kind, val) = fields[ix:ix + 3]
+    attrs[name] = _Decode(kind, val)
+  return (base64.b64decode(fields[0]), attrs)
+
+if __name__ == '__main__':
+  pass
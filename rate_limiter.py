@@ -0,0 +1,187 @@
+#!/usr/bin/python2.4
+#
+# Copyright 2006 Google, Inc.
+# All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License")
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+
+""" Keeps the calls to Google within the domain's quotas
+
+class TokenBucket: a rate limit with room for bursts
+class RateLimiter: the rate limits for each type of operation
+class ThrottledAPI: a provisioning API object which obeys a RateLimiter
+"""
+
+import threading
+import time
+
+# the type of operation each provisioning API method does, as named in
+# the rate_limits config variable.  Any other method only counts
+# against the 'all' limit.
+OPERATIONS = {'CreateAccountWithEmail': 'added',
+              'UnlockAccount': 'added',
+              'LockAccount': 'exited',
+              'RenameAccount': 'renamed',
+              'UpdateAccount': 'updated',
+              'RetrieveAccount': 'read'}
+
+# the limit which applies to every call, whatever its type
+ALL_OPERATIONS = 'all'
+
+
+class TokenBucket(object):
+
+  """ A rate limit of 'rate' calls per second, which lets up to 'burst'
+  calls through at once after a quiet spell.  A caller which has to wait
+  reserves its token before sleeping, so the waits are handed out in
+  order and no lock is held while sleeping.
+  """
+
+  def __init__(self, rate, burst=1):
+    """ Constructor
+    Args:
+      rate: calls per second
+      burst: the most calls allowed through without waiting
+    """
+    self._lock = threading.Lock()
+    self._rate = float(rate)
+    self._burst = max(1.0, float(burst))
+    self._tokens = self._burst
+    self._last = time.time()
+
+  def Take(self):
+    """ Take a token, waiting until there is one.
+    Returns:
+      the time waited, in seconds
+    """
+    self._lock.acquire()
+    try:
+      now = time.time()
+      self._tokens = min(self._burst,
+                         self._tokens + (now - self._last) * self._rate)
+      self._last = now
+      self._tokens -= 1
+      if self._tokens >= 0:
+        return 0.0
+      wait = -self._tokens / self._rate
+    finally:
+      self._lock.release()
+    time.sleep(wait)
+    return wait
+
+
+class RateLimiter(object):
+
+  """ The TokenBucket for each type of operation ('added', 'exited',
+  'renamed', 'updated', 'read'), plus one for 'all' of them, shared by
+  all the worker threads.  Keeps count of the time spent waiting for
+  each.
+  """
+
+  def __init__(self, limits=None):
+    """ Constructor
+    Args:
+      limits: as for SetLimits()
+    """
+    self._lock = threading.Lock()
+    self._buckets = {}
+    self._throttled = {}
+    self.SetLimits(limits)
+
+  def SetLimits(self, limits):
+    """ Replace the limits
+    Args:
+      limits: dictionary of operation type (or 'all') to either calls
+        per second, or a (calls per second, burst) tuple.  A type which
+        isn't there has no limit.
+    Raises:
+      ValueError: if a limit isn't a positive number
+    """
+    buckets = {}
+    for (operation, limit) in (limits or {}).iteritems():
+      if type(limit) in (tuple, list):
+        (rate, burst) = limit
+      else:
+        (rate, burst) = (limit, 1)
+      if float(rate) <= 0:
+        raise ValueError('rate must be positive: %s' % str(rate))
+      buckets[operation] = TokenBucket(rate, burst)
+    self._lock.acquire()
+    try:
+      self._buckets = buckets
+    finally:
+      self._lock.release()
+
+  def Throttle(self, operation):
+    """ Wait until an operation of a type is allowed
+    Args:
+      operation: its type, or 'all' for one with no type of its own
+    """
+    buckets = self._buckets
+    waited = 0.0
+    names = [ALL_OPERATIONS]
+    if operation != ALL_OPERATIONS:
+      names.insert(0, operation)
+    for name in names:
+      bucket = buckets.get(name)
+      if bucket:
+        waited += bucket.Take()
+    if waited:
+      self._lock.acquire()
+      try:
+        self._throttled[operation] = self._throttled.get(operation, 0) + waited
+      finally:
+        self._lock.release()
+
+  def GetThrottled(self):
+    """ The time spent waiting so far.
+    Returns:
+      dictionary of operation type to seconds
+    """
+    self._lock.acquire()
+    try:
+      return self._throttled.copy()
+    finally:
+      self._lock.release()
+
+
+class ThrottledAPI(object):
+
+  """ Wraps a provisioning API object, making each call wait for the
+  RateLimiter first.  Anything else is passed straight through.
+  """
+
+  def __init__(self, api, limiter):
+    """ Constructor
+    Args:
+      api: a google.appsforyourdomain.provisioning.API object
+      limiter: the RateLimiter
+    """
+    self._api = api
+    self._limiter = limiter
+
+  def __getattr__(self, name):
+    attr = getattr(self._api, name)
+    if not callable(attr):
+      return attr
+    limiter = self._limiter
+    operation = OPERATIONS.get(name, ALL_OPERATIONS)
+    def Throttled(*args, **kwargs):
+      limiter.Throttle(operation)
+      return attr(*args, **kwargs)
+    return Throttled
+
+if __name__ == '__main__':
+  pass
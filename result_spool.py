@@ -0,0 +1,99 @@
+#!/usr/bin/python2.4
+#
+# Copyright 2006 Google, Inc.
+# All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License")
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+
+""" Holds LDAP search results, spilling them to disk past a budget
+
+class ResultSpool: a list-like collection of search results
+"""
+
+import cPickle
+import logging
+import tempfile
+
+
+class ResultSpool(object):
+
+  """ Collects the (dn, attrs) entries returned by an LDAP search.  Up to
+  'budget' entries are kept in memory; after that they are written to
+  an anonymous temporary file, which disappears when the spool is
+  closed.  Supports just what the search code and UserDB need from a
+  list: append(), extend(), len() and iteration, which returns the
+  entries in the order they were added.
+  """
+
+  def __init__(self, budget=0):
+    """ Constructor
+    Args:
+      budget: max # of entries to keep in memory; 0 for no limit
+    """
+    self._budget = budget
+    self._entries = []
+    self._file = None
+    self._spilled = 0
+
+  def __len__(self):
+    return self._spilled + len(self._entries)
+
+  def __iter__(self):
+    if self._file:
+      self._file.flush()
+      self._file.seek(0)
+      for unused_ix in xrange(self._spilled):
+        yield cPickle.load(self._file)
+    for entry in self._entries:
+      yield entry
+
+  def append(self, entry):
+    """ Add an entry
+    Args:
+      entry: a (dn, attrs) tuple
+    """
+    self._entries.append(entry)
+    if self._budget and len(self._entries) >= self._budget:
+      self._Spill()
+
+  def extend(self, entries):
+    """ Add a list of entries
+    Args:
+      entries: iterable of (dn, attrs) tuples
+    """
+    for entry in entries:
+      self.append(entry)
+
+  def close(self):
+    """ Discard all the entries, and the temporary file if there is one
+    """
+    if self._file:
+      self._file.close()
+      self._file = None
+    self._entries = []
+    self._spilled = 0
+
+  def _Spill(self):
+    """ Write the in-memory entries to the end of the temporary file
+    """
+    if not self._file:
+      self._file = tempfile.TemporaryFile()
+      logging.debug('Search results passed %d entries; spilling to disk' %
+                    self._budget)
+    self._file.seek(0, 2)
+    for entry in self._entries:
+      cPickle.dump(entry, self._file, cPickle.HIGHEST_PROTOCOL)
+    self._spilled += len(self._entries)
+    self._entries = []
@@ -22,15 +22,24 @@ class SyncGoogle:  the class that does it
 """
 
 
+import account_snapshot
+import adaptive_concurrency
 import added_user_google_action
 import exited_user_google_action
 import updated_user_google_action
 import renamed_user_google_action
+import heapq
+import http_pool
 import last_update_time
 import logging
 import messages
+import progress_log
 import Queue
+import random
+import rate_limiter
 import threading
+import time
+import token_cache
 import google_result_handler
 import google_result_queue
 import utils
@@ -40,58 +49,171 @@ from google.appsforyourdomain import provisioning_auth
 from google.appsforyourdomain import provisioning_backend
 
 # globals governing the threading system
-QUEUE_TIMEOUT = 20
 THREAD_JOIN_TIMEOUT = 120
-STAT_UPDATE_TIMEOUT = 0.2
+# how often the main thread wakes up while waiting for the workers, so
+# that it can be interrupted
+WAIT_INTERVAL = 1.0
+# delay before the first retry of a transient failure, in seconds; it
+# doubles with each retry, up to RETRY_MAX_DELAY
+RETRY_BASE_DELAY = 2.0
+RETRY_MAX_DELAY = 120.0
+# the main thread stops waiting for a batch if no user has been finished
+# for this long, in seconds (more than RETRY_MAX_DELAY, so a retry
+# doesn't count as stalling)
+BATCH_STALL_TIMEOUT = 600.0
 
 class ThreadStats(object):
 
   """ Object for communicating between a "worker thread" and the main
   program, in a thread-safe way.  The worker threads can post their current
   status such that it can be aggregated and reported back to the user while
-  the threads are still busy (as well as when they're done).
+  the threads are still busy (as well as when they're done).  The lock is
+  only held for the few instructions of an update or copy, so no thread
+  ever waits on it for long.
   """
 
   # all legal stats which can be accumulated
   stat_names = frozenset(('adds', 'exits', 'renames', 'updates',
                           'add_fails', 'exit_fails', 'rename_fails',
                           'update_fails',
-                          'authentications'))
+                          'authentications', 'throttled_seconds'))
   def __init__(self):
-    self._condition = threading.Condition()
+    self._lock = threading.Lock()
     self._stats = {}
     for stat in self.stat_names:
       self._stats[stat] = 0
 
   def IncrementStat(self, stat, inc):
-    """ increment a stat in a thread-safe way. Do not wait more than
-    STAT_UPDATE_TIMEOUT to get access to the object.
+    """ increment a stat in a thread-safe way.
     Args:
       stat: name of the stat, which must be one of the stat_names set.
       inc: integer to be added to the stat.  It can be negative, but
           the underlying number if never allowed to become negative.
     """
-    self._condition.acquire()
-    self._condition.wait(STAT_UPDATE_TIMEOUT)
     if stat not in self.stat_names:
       logging.error('Invalid stat name: %s' % stat)
-    else:
-      self._stats[stat] += inc
-      if self._stats[stat] < 0:
-        logging.error('%s prevented from going negative' % stat)
-        self._stats[stat] = 0;
-    self._condition.notifyAll()
-    self._condition.release()
+      return
+    self._lock.acquire()
+    try:
+      value = self._stats[stat] + inc
+      self._stats[stat] = max(value, 0)
+    finally:
+      self._lock.release()
+    if value < 0:
+      logging.error('%s prevented from going negative' % stat)
 
   def GetStats(self):
     """ obtain a copy of the current stats in a thread-safe way.
     """
+    self._lock.acquire()
+    try:
+      return self._stats.copy()
+    finally:
+      self._lock.release()
+
+class ActionOutcome(object):
+
+  """ Stands in for the result queue and the ThreadStats while a
+  GoogleAction handles one user, collecting what it reports.  If the
+  user is to be retried, that's thrown away; otherwise it is passed on
+  by Commit().
+  """
+
+  def __init__(self):
+    self.Reset()
+
+  def Reset(self):
+    """ Throw away what has been collected
+    """
+    self._results = []
+    self._stats = []
+
+  def PutResult(self, dn, action, failure=None, object=None,
+                block=True, timeout=None):
+    """ As for google_result_queue.GoogleResultQueue.PutResult()
+    """
+    self._results.append((dn, action, failure, object))
+
+  def IncrementStat(self, stat, inc):
+    """ As for ThreadStats.IncrementStat()
+    """
+    self._stats.append((stat, inc))
+
+  def GetFailure(self):
+    """ The first failure reported, or None if there wasn't one
+    """
+    for (unused_dn, unused_action, failure, unused_obj) in self._results:
+      if failure:
+        return failure
+    return None
+
+  def Commit(self, result_queue, thread_stats):
+    """ Pass on what has been collected, and Reset()
+    Args:
+      result_queue: the real GoogleResultQueue
+      thread_stats: the real ThreadStats
+    """
+    for (dn, action, failure, obj) in self._results:
+      result_queue.PutResult(dn, action, failure, obj)
+    for (stat, inc) in self._stats:
+      thread_stats.IncrementStat(stat, inc)
+    self.Reset()
+
+class RetryScheduler(threading.Thread):
+
+  """ Puts items back on a queue after a delay.  A single thread holds
+  all the items waiting, in order of when they're due.
+  """
+
+  def __init__(self, queue):
+    """ Constructor
+    Args:
+      queue: the Queue.Queue to put the items on
+    """
+    threading.Thread.__init__(self)
+    self.setDaemon(True)
+    self._queue = queue
+    self._condition = threading.Condition()
+    self._waiting = []
+    self._stopped = False
+
+  def Schedule(self, item, delay):
+    """ Put an item on the queue in 'delay' seconds
+    """
     self._condition.acquire()
-    self._condition.wait(STAT_UPDATE_TIMEOUT)
-    copy_stats = self._stats.copy()
-    self._condition.notifyAll()
-    self._condition.release()
-    return copy_stats
+    try:
+      heapq.heappush(self._waiting, (time.time() + delay, item))
+      self._condition.notify()
+    finally:
+      self._condition.release()
+
+  def Stop(self):
+    """ Stop the thread, dropping any items still waiting
+    """
+    self._condition.acquire()
+    try:
+      self._stopped = True
+      self._waiting = []
+      self._condition.notify()
+    finally:
+      self._condition.release()
+    self.join(THREAD_JOIN_TIMEOUT)
+
+  def run(self):
+    self._condition.acquire()
+    try:
+      while not self._stopped:
+        if not self._waiting:
+          self._condition.wait()
+          continue
+        delay = self._waiting[0][0] - time.time()
+        if delay > 0:
+          self._condition.wait(delay)
+          continue
+        (unused_due, item) = heapq.heappop(self._waiting)
+        self._queue.put(item)
+    finally:
+      self._condition.release()
 
 class SyncGoogle(utils.Configurable):
   """ Synchronizes the UserDB with Google Apps for Your Domain.
@@ -107,17 +229,17 @@ class SyncGoogle(utils.Configurable):
   and the <action name>_user_google_action.py modules for details.
 
   If you subclass any of those modules, you must change the reference to them
-  in the code reproduced below:
+  in the code reproduced below, from _GoogleActionClass():
 
-    # here is where we could allow other actions to be substituted:
+    # here is where different subclasses of GoogleAction would be substituted:
     if action == 'added':
-      gclass = added_user_google_action.AddedUserGoogleAction
+      return added_user_google_action.AddedUserGoogleAction
     elif action == 'exited':
-      gclass = exited_user_google_action.ExitedUserGoogleAction
+      return exited_user_google_action.ExitedUserGoogleAction
     elif action == 'renamed':
-      gclass = renamed_user_google_action.RenamedUserGoogleAction
+      return renamed_user_google_action.RenamedUserGoogleAction
     elif action == 'updated':
-      gclass = updated_user_google_action.UpdatedUserGoogleAction
+      return updated_user_google_action.UpdatedUserGoogleAction
 
   For the same reason, this module does not do anything application-
   specific with the UserDB object after a Google operation succeeds or
@@ -140,6 +262,16 @@ class SyncGoogle(utils.Configurable):
                   'password': messages.MSG_SYNC_GOOGLE_PASSWORD,
                   'domain': messages.MSG_SYNC_GOOGLE_DOMAIN,
                   'max_threads': messages.MSG_SYNC_GOOGLE_MAX_THREADS,
+                  'min_threads': messages.MSG_SYNC_GOOGLE_MIN_THREADS,
+                  'rate_limits': messages.MSG_SYNC_GOOGLE_RATE_LIMITS,
+                  'google_max_retries': messages.MSG_SYNC_GOOGLE_MAX_RETRIES,
+                  'auth_token_file': messages.MSG_SYNC_GOOGLE_AUTH_TOKEN_FILE,
+                  'http_pool_size': messages.MSG_SYNC_GOOGLE_HTTP_POOL_SIZE,
+                  'http_idle_timeout': messages.MSG_SYNC_GOOGLE_HTTP_IDLE_TIMEOUT,
+                  'preflight_accounts': messages.MSG_SYNC_GOOGLE_PREFLIGHT,
+                  'progress_log': messages.MSG_SYNC_GOOGLE_PROGRESS_LOG,
+                  'progress_sync_every':
+                      messages.MSG_SYNC_GOOGLE_PROGRESS_SYNC_EVERY,
                   'google_operations': messages.MSG_SYNC_GOOGLE_ALLOWED,
                   'endpoint': messages.MSG_SYNC_GOOGLE_ENDPOINT,
                   'authurl': messages.MSG_SYNC_GOOGLE_AUTH_URL,
@@ -161,6 +293,7 @@ class SyncGoogle(utils.Configurable):
     self.__endpoint = None
     self.__authurl = None
     self.__max_threads = 10
+    self.__min_threads = 1
     self.__items_per_thread = 32
     self.__google_operations = None
     self.__last_update_file = '/var/local/ldap-sync-last-update'
@@ -169,9 +302,31 @@ class SyncGoogle(utils.Configurable):
     self._users = users
     self.queue_google = None
     self.queue_result = None
-    self._apis = None
-    self._gworkers = None
+    self._gworkers = []
+    self._batch = 0
+    self._batch_done = 0
+    self._batch_condition = threading.Condition()
+    self._limiter = adaptive_concurrency.ConcurrencyLimiter()
+    self.rate_limits = None
+    self._rate_limiter = rate_limiter.RateLimiter()
+    self.google_max_retries = 4
+    self._retries = None
+    self.gclasses = {}
+    self.thread_stats = None
     self.provisioning_api = api
+    self.auth_token_file = None
+    self._tokens = token_cache.TokenCache(api)
+    self.http_pool_size = 10
+    self.http_idle_timeout = 60
+    self._http_pool = None
+    self.preflight_accounts = False
+    self.existing_accounts = None
+    self.progress_log = None
+    self.progress_sync_every = 100
+    # progress_log.DataFileKey() of the user data file, which the
+    # progress_log goes with; None if there isn't one, and so no log
+    self.progress_key = None
+    self._progress = None
 
     super(SyncGoogle, self).__init__(config=config,
                                      config_parms=self.config_parms, **moreargs)
@@ -241,6 +396,24 @@ class SyncGoogle(utils.Configurable):
        """The max number of threads to be used for talking to Google.
 If not specified, a best judgment is made, according to the volume
 of work. If set to 1, only one thread will be used.
+"""
+   )
+
+  def _GetMinThreads(self):
+    return self.__min_threads
+
+  def __GetMinThreads(self):
+    return self._GetMinThreads()
+
+  def _SetMinThreads(self, attr):
+    self.__min_threads = attr
+
+  def __SetMinThreads(self, attr):
+    self._SetMinThreads(attr)
+
+  min_threads = property(__GetMinThreads, __SetMinThreads, None,
+       """The number of threads talking to Google is never cut below this,
+however slowly Google is responding.
 """
    )
 
@@ -348,11 +521,27 @@ max_threads)
     if not attr in self.config_parms:
       return messages.msg(messages.ERR_NO_SUCH_ATTR, attr)
     try:
-      if attr == 'max_threads':
+      if attr in ('max_threads', 'min_threads', 'google_max_retries',
+                  'http_pool_size', 'http_idle_timeout', 'progress_sync_every'):
         try:
-          self.max_threads = int(val)
+          setattr(self, attr, int(val))
         except ValueError:
           return messages.msg(messages.ERR_ENTER_NUMBER, val)
+      elif attr == 'preflight_accounts':
+        if type(val) is str:
+          val = val.strip().lower() in ('1', 'true', 'yes')
+        self.preflight_accounts = val
+      elif attr == 'rate_limits':
+        if type(val) is str:
+          try:
+            val = eval(val)
+          except (SyntaxError, NameError):
+            return messages.msg(messages.ERR_INVALID_VALUE, attr)
+        try:
+          rate_limiter.RateLimiter(val)
+        except (AttributeError, TypeError, ValueError):
+          return messages.msg(messages.ERR_INVALID_VALUE, attr)
+        self.rate_limits = val
       else:
         setattr(self, attr, val)
     except ValueError:
@@ -370,12 +559,29 @@ max_threads)
     """
     self._config.TestConfig(self, ['admin', 'password', 'domain'])
     try:
-      api = provisioning.API(self.admin, self.password, self.domain)
-      return api.RetrieveAccount(username)
+      return self._GetAPI().RetrieveAccount(username)
     except provisioning_errs.ProvisioningApiError, e:
       logging.debug(str(e))
       return None
 
+  def TakeSnapshot(self, usernames):
+    """ Query Google for many users' accounts at once, e.g. for the
+    reconcileUsers command, with max_threads threads which share the
+    authentication token and obey the rate_limits (as 'read's).
+    Args:
+      usernames: list of GoogleUsernames
+    Return:
+      account_snapshot.AccountSnapshot
+    Raises:
+      provisioning_errs.ProvisioningApiError: if authentication fails
+    """
+    self._config.TestConfig(self, ['admin', 'password', 'domain'])
+    apis = []
+    for unused_ix in xrange(max(1, min(self.max_threads, len(usernames)))):
+      apis.append(rate_limiter.ThrottledAPI(self._GetAPI(self.thread_stats),
+                                            self._rate_limiter))
+    return account_snapshot.Fetch(apis, usernames, self.google_max_retries)
+
   def TestConnectivity(self):
     """ Make sure we CAN connect to Google with these parameters. Saves
     spawning a whole bunch of threads that'll all just fail.
@@ -385,16 +591,39 @@ max_threads)
     """
     try:
       self._config.TestConfig(self, ['admin', 'password', 'domain'])
-      api = provisioning.API(self.admin, self.password, self.domain)
-      del api
+      self._GetAPI()
       return None
     except provisioning_errs.AuthenticationError, e:
+      self._tokens.Invalidate()
       return str(e)
     except utils.ConfigError, e:
       return str(e)
 
+  def _GetAPI(self, thread_stats=None):
+    """ Get an authenticated provisioning API object, sharing the token
+    of the last one if it's still good (see token_cache.TokenCache).
+    Args:
+      thread_stats: a ThreadStats to count any authentication in, or None
+    Returns:
+      a provisioning API object, for the caller's use alone, whose calls
+      use the HTTP connection pool if there is one
+    Raises:
+      provisioning_errs.ProvisioningApiError: if authentication fails
+    """
+    if self._http_pool is None and self.http_pool_size > 0:
+      self._http_pool = http_pool.Install(self.http_pool_size,
+                                          self.http_idle_timeout)
+    self._tokens.token_file = self.auth_token_file
+    api = self._tokens.GetAPI(self.admin, self.password, self.domain,
+                              thread_stats)
+    if self._http_pool:
+      api = http_pool.PooledAPI(api, self._http_pool)
+    return api
+
   def _ComputeThreadCount(self, item_count):
-    """ for a given workload, compute the number of threads to launch
+    """ for a given workload, compute the number of threads to start
+    with.  The ConcurrencyLimiter adjusts it from there, between
+    min_threads and max_threads, as it sees how Google is responding.
     Args:
       item_count: number of users to be handled
     Returns:
@@ -406,13 +635,156 @@ max_threads)
     return count
 
   def _Abort(self):
-    """ Safely cancels an ongoing sync operation. Removes all entries from both
-    queue_google and queue_result.
+    """ Safely cancels an ongoing sync operation. Removes all the entries
+    not yet handled from queue_google, and stops the worker threads.
     This is called when the user presses the interrupt key
     (usually control-C).
     """
-    if self._apis:
-      del self._apis
+    self._DrainQueue()
+    self.StopWorkers()
+    if self.queue_result:
+      self.queue_result.put(None)
+
+  def _DrainQueue(self):
+    """ Remove all the entries not yet handled from queue_google
+    """
+    if self.queue_google:
+      try:
+        while True:
+          self.queue_google.get(block=False)
+      except Queue.Empty:
+        pass
+
+  def _StartWorkers(self, thread_count):
+    """ Grow the pool of worker threads to 'thread_count', giving each
+    new one an API object which shares the cached authentication token
+    (see _GetAPI()).  The workers stay alive, waiting on
+    queue_google, until StopWorkers() is called, so the later actions of
+    a sync reuse them.
+    Args:
+      thread_count: the number of workers wanted
+    Returns:
+      None if success, else the string-ified exception that was caught
+    """
+    if self.queue_google is None or self._retries is None:
+      self.queue_google = Queue.Queue()
+      self._retries = RetryScheduler(self.queue_google)
+      self._retries.start()
+    # replace any worker which has died
+    self._gworkers = [gworker for gworker in self._gworkers
+                      if gworker.isAlive()]
+    need = thread_count - len(self._gworkers)
+    if need <= 0:
+      return None
+    logging.debug('forking %d threads' % need)
+
+    # create the API objects first, since that's what's most
+    # likely to fail:
+    apis = []
+    for ix in xrange(need):
+      try:
+        api = self._GetAPI(self.thread_stats)
+      except provisioning_errs.ProvisioningApiError, e:
+        logging.error(str(e))
+        return str(e)
+      apis.append(api)
+
+    for api in apis:
+      # the rate limiting goes outside the timing, so the time spent
+      # waiting for it doesn't look like the server being slow
+      api = adaptive_concurrency.MeasuredAPI(api, self._limiter)
+      api = rate_limiter.ThrottledAPI(api, self._rate_limiter)
+      gworker = Gworker(api, self)
+      gworker.setName('gworker-%d' % len(self._gworkers))
+      gworker.setDaemon(True)
+      self._gworkers.append(gworker)
+      gworker.start()
+    return None
+
+  def StopWorkers(self):
+    """ Stop the pool of worker threads, once they've finished what's
+    already on queue_google.  Each is sent a None, which tells it to
+    exit.  Any retries not yet due are dropped.  The queue and the
+    RetryScheduler go together, so the next _StartWorkers() makes both
+    afresh.
+    """
+    if self._retries:
+      self._retries.Stop()
+    if self._progress:
+      self._progress.Close()
+      self._progress = None
+    for unused_ix in xrange(len(self._gworkers)):
+      self.queue_google.put(None)
+    for gworker in self._gworkers:
+      gworker.join(THREAD_JOIN_TIMEOUT)
+      if gworker.isAlive():
+        logging.error('failed to join thread \'%s\'' % gworker.getName())
+      else:
+        logging.debug('joined thread \'%s\'' % gworker.getName())
+    self._gworkers = []
+    self._retries = None
+    self.queue_google = None
+
+  def ItemDone(self, batch, count=1):
+    """ Called by a worker when it has finished with some items,
+    successfully or not.
+    Args:
+      batch: the batch number the items were queued with
+      count: the number of items
+    """
+    self._batch_condition.acquire()
+    try:
+      if batch == self._batch:
+        self._batch_done += count
+        self._batch_condition.notifyAll()
+    finally:
+      self._batch_condition.release()
+
+  def Retry(self, item, attempt):
+    """ Called by a worker when some items are to be tried again,
+    after a transient failure.  It goes back on queue_google after an
+    exponential backoff, with jitter so that the chains which failed
+    together aren't retried together.
+    Args:
+      item: what to put back on queue_google
+      attempt: how many retries there have been, including this one
+    """
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1))
+    delay = random.uniform(delay / 2, delay)
+    logging.debug('retrying in %.1fs' % delay)
+    self._retries.Schedule(item, delay)
+
+  def _WaitForBatch(self, item_count):
+    """ Wait until the workers have finished all 'item_count' items
+    of the current batch, or until that's not going to happen: a worker
+    has died (taking its items with it), or none has finished an item
+    for BATCH_STALL_TIMEOUT seconds.
+    Returns:
+      True if all the items were finished
+    """
+    self._batch_condition.acquire()
+    try:
+      done = self._batch_done
+      progress_time = time.time()
+      while self._batch_done < item_count:
+        # waking up now and then lets control-C through
+        self._batch_condition.wait(WAIT_INTERVAL)
+        if self._batch_done != done:
+          done = self._batch_done
+          progress_time = time.time()
+        dead = [gworker.getName() for gworker in self._gworkers
+                if not gworker.isAlive()]
+        if dead:
+          logging.error('worker thread(s) %s died, with %d users left' %
+                        (', '.join(dead), item_count - self._batch_done))
+          return False
+        if time.time() - progress_time > BATCH_STALL_TIMEOUT:
+          logging.error('no users finished in %ds, with %d left' %
+                        (BATCH_STALL_TIMEOUT, item_count - self._batch_done))
+          return False
+      return True
+    finally:
+      self._batch_condition.release()
 
   def DoAdds(self, dn_restrict=None):
     """ Go through the UserDB and process all the 'added' users.
@@ -448,125 +820,290 @@ max_threads)
 
   def DoAction(self, action, dn_restrict=None):
     """ For each user for which the Google action is 'action'
-    handle it
+    handle it.  See DoActions() for more details.
     Args:
       action: the action items from self.users to pull out and do
       dn_restrict: if non-null, must be a DN which is to be the sole
       target
+    """
+    return self.DoActions([action], dn_restrict)
+
+  def DoActions(self, actions, dn_restrict=None):
+    """ Handle every user whose Google action is one of 'actions', all
+    in a single run of the worker threads.  Users whose actions have
+    to be done in order, because they involve the same Google username
+    (e.g. a user renamed away from a name which another user is being
+    added with), are handed to one worker together, renames first (see
+    _Chains()); everything else is done in parallel.
+    Args:
+      actions: list of the action items from self.users to pull out
+        and do
+      dn_restrict: if non-null, must be a DN which is to be the sole
+      target
     Return :
-      err: errors, if any
-      count of successes
-      count of failures
+      the stats (see ThreadStats) of the run, or None if there was
+      nothing to do
     Side-effects :
       Each user's record is updated with the results, assuming
       the default google_result_handler.py is used.
     Notes:
-      Be sure to do TestConnectivity() before doing this
+      Be sure to do TestConnectivity() before doing this, and
+      StopWorkers() after the last run.
     """
 
-    # count up the users, and figure out how many threads to spin up
+    # group the users, and figure out how many threads to spin up
     if dn_restrict:
       if not self._users.LookupDN(dn_restrict):
         logging.error('%s not in the user list' % dn_restrict)
-      item_count = 1
+      chains = [[(actions[0], dn_restrict)]]
     else:
-      item_count = self._users.UserCount('meta-Google-action', action)
+      chains = self._Chains(actions)
 
-    logging.debug('Counted %d users to be %s' % (item_count, action))
+    item_count = 0
+    for chain in chains:
+      item_count += len(chain)
+    logging.debug('Counted %d users to be %s' % (item_count,
+                                                 ', '.join(actions)))
     if not item_count:
       return
 
     # make sure we have the configuration items we need:
     self._config.TestConfig(self, ['admin', 'password', 'domain'])
-    self.queue_google = Queue.Queue(item_count)
-    self.queue_result = google_result_queue.GoogleResultQueue(item_count)
+    self.queue_result = google_result_queue.GoogleResultQueue(item_count + 1)
+    # start enough workers for the limiter to reach max_threads; it
+    # decides how many are busy at once
     thread_count = self._ComputeThreadCount(item_count)
-    logging.debug('forking %d threads' % thread_count)
+    pool_size = max(min(self.max_threads, len(chains)), thread_count)
+    self._limiter.SetBounds(thread_count, self.min_threads, pool_size)
 
     # establish the ThreadStats object:
     self.thread_stats = ThreadStats()
+    self._rate_limiter.SetLimits(self.rate_limits)
+    throttled_before = self._rate_limiter.GetThrottled()
+    http_before = self._GetHttpStats()
+
+    self.gclasses = {}
+    for action in actions:
+      self.gclasses[action] = self._GoogleActionClass(action)
+    if self.preflight_accounts and 'added' in actions:
+      self.existing_accounts = self._FindExistingAccounts()
+    else:
+      self.existing_accounts = None
 
     try:
-      # create N API objects first, since that's what's most
-      # likely to fail:
-      self._apis = []
-      errs = None
-      for ix in xrange(thread_count):
-        try:
-          api = self.provisioning_api.API(self.admin, self.password, 
-              self.domain)
-          self.thread_stats.IncrementStat('authentications', 1)
-        except provisioning_errs.ProvisioningApiError, e:
-          errs = str(e)
-          logging.error(errs)
-          break
-        self._apis.append(api)
-
-      # if we had errors creating the api objects, kill whatever
-      # ones we succeeded at, and exit
-      if errs:
-        for ix in len(self._apis):
-          del self._apis[ix]
+      # if we couldn't authenticate new workers, give up
+      if self._StartWorkers(pool_size):
         return self.thread_stats.GetStats()
 
-      # create the actual threads to read requests
-      self._gworkers = []
-
-      # here is where different subclasses of GoogleAction would be substituted:
-      if action == 'added':
-        self.gclass = added_user_google_action.AddedUserGoogleAction
-      elif action == 'exited':
-        self.gclass = exited_user_google_action.ExitedUserGoogleAction
-      elif action == 'renamed':
-        self.gclass = renamed_user_google_action.RenamedUserGoogleAction
-      elif action == 'updated':
-        self.gclass = updated_user_google_action.UpdatedUserGoogleAction
-      else:
-        raise RuntimeError('invalid action: %s' % action)
-
-      # actually launch the worker threads:
-      for ix in xrange(thread_count):
-        gworker = Gworker(self._apis[ix], self)
-        gworker.setName('%s-%d' % (action, ix))
-        self._gworkers.append(gworker)
-        gworker.start()
-
       # create thread(s) to read the requests coming back
-      self._reader = StatusReader(self.queue_result, self._users,
-                                  google_result_handler.GoogleResultHandler)
-      self._reader.start()
+      reader = StatusReader(self.queue_result, self._users,
+                            google_result_handler.GoogleResultHandler,
+                            self._OpenProgressLog())
+      reader.setDaemon(True)
+      reader.start()
       logging.debug('done creating threads')
 
-      # stuff the queue that the worker threads are reading from:
-      if dn_restrict:
-        dns = [dn_restrict]
-      else:
-        dns = self._users.UserDNs('meta-Google-action', action)
-      for dn in dns:
-        attrs = self._users.LookupDN(dn)
-        logging.debug('queueing %s' % dn)
-        self.queue_google.put((dn, attrs))
-
-      # wait for all the threads to terminate
-      for gworker in self._gworkers:
-        gworker.join(THREAD_JOIN_TIMEOUT)
-        if gworker.isAlive():
-          logging.error('failed to join thread \'%s\'' % gworker.getName())
-        else:
-          logging.debug('joined thread \'%s\'' % gworker.getName())
-
-      # join the "self._reader" thread
-      self._reader.join()
-      if self._reader.isAlive():
-        logging.error('failed to join thread \'%s\'' % self._reader.getName())
-      else:
-        logging.debug('joined thread \'%s\'' % self._reader.getName())
+      # a new batch number tells the workers to pick up the new gclasses,
+      # queue_result and thread_stats
+      self._batch_condition.acquire()
+      try:
+        self._batch += 1
+        self._batch_done = 0
+        batch = self._batch
+      finally:
+        self._batch_condition.release()
+
+      # stuff the queue that the worker threads are reading from, longest
+      # chains first so they don't hold up the end of the run:
+      chains.sort(lambda a, b: cmp(len(b), len(a)))
+      for chain in chains:
+        items = []
+        for (action, dn) in chain:
+          logging.debug('queueing %s to be %s' % (dn, action))
+          items.append((action, dn, self._users.LookupDN(dn)))
+        self.queue_google.put((batch, items, 0))
+
+      # wait for the workers to finish them, then tell the reader that
+      # it has all the results
+      if not self._WaitForBatch(item_count):
+        # the users not finished keep their actions for the next run
+        self._DrainQueue()
+        last_update_time.reportError()
+      self.queue_result.put(None)
+      reader.join()
+      logging.debug('joined thread \'%s\'' % reader.getName())
+      if self._progress:
+        self._progress.Sync()
     except KeyboardInterrupt:
       logging.error('Interrupted, cleaning up ...')
       self._Abort()
       logging.error('Done')
       pass
-    return self.thread_stats.GetStats()
+    stats = self.thread_stats.GetStats()
+    throttled = self._rate_limiter.GetThrottled()
+    for (operation, seconds) in throttled.iteritems():
+      seconds -= throttled_before.get(operation, 0)
+      if seconds:
+        logging.debug('throttled %s calls for %.1fs' % (operation, seconds))
+      stats['throttled_seconds'] += seconds
+    self._LogHttpStats(http_before)
+    return stats
+
+  def _OpenProgressLog(self):
+    """ The ProgressLog the results are recorded in, opening it if need
+    be, or None if there's no progress_log, or no user data file for it
+    to go with (or it can't be opened)
+    """
+    if (self.progress_log and self.progress_key is not None and
+        not self._progress):
+      try:
+        self._progress = progress_log.ProgressLog(self.progress_log,
+                                                  self.progress_key,
+                                                  self.progress_sync_every)
+      except (IOError, OSError), e:
+        logging.error('Cannot open %s: %s' % (self.progress_log, str(e)))
+    return self._progress
+
+  def _GetHttpStats(self):
+    """ The counts from the HTTP connection pool, or None if there isn't
+    one
+    """
+    if self._http_pool:
+      return self._http_pool.GetStats()
+    return None
+
+  def _LogHttpStats(self, before):
+    """ Log how well the HTTP connection pool did since 'before'
+    Args:
+      before: what _GetHttpStats() returned then
+    """
+    after = self._GetHttpStats()
+    if not after:
+      return
+    if before:
+      for (name, value) in before.iteritems():
+        after[name] -= value
+    if not after['requests']:
+      return
+    logging.info('%d requests to Google used %d connections, saving %d '
+                 'handshakes' % (after['requests'], after['handshakes'],
+                                 after['reused']))
+    if after['handshakes'] and after['reused']:
+      logging.info('average request took %.0fms on a new connection, '
+                   '%.0fms on a reused one' %
+                   (1000 * after['new_seconds'] / after['handshakes'],
+                    1000 * after['reused_seconds'] / after['reused']))
+
+  def _FindExistingAccounts(self):
+    """ The pre-flight check for adds: the usernames of the accounts
+    known to be in Google already, which the AddedUserGoogleAction can
+    just unlock and update rather than try to create.  An account is
+    known to be there if this tool created it or renamed it to its
+    current name (and so recorded it in meta-Google-old-username), e.g.
+    a user who is being re-added after being exited, or one from a run
+    which didn't finish.  A wrong guess costs one failed call, after
+    which the account is created as usual.
+    Returns:
+      set of lower-cased usernames
+    """
+    existing = set()
+    for dn in self._users.UserDNs():
+      name = self._users.LookupDN(dn).get('meta-Google-old-username')
+      if name:
+        existing.add(name.lower())
+    logging.debug('pre-flight: %d accounts known to exist' % len(existing))
+    return existing
+
+  def _GoogleActionClass(self, action):
+    """ The GoogleAction subclass which handles an action.
+    Args:
+      action: one of userdb.UserDB.google_action_vals
+    Returns:
+      a subclass of google_action.GoogleAction
+    Raises:
+      RuntimeError: if the action isn't valid
+    """
+    # here is where different subclasses of GoogleAction would be substituted:
+    if action == 'added':
+      return added_user_google_action.AddedUserGoogleAction
+    elif action == 'exited':
+      return exited_user_google_action.ExitedUserGoogleAction
+    elif action == 'renamed':
+      return renamed_user_google_action.RenamedUserGoogleAction
+    elif action == 'updated':
+      return updated_user_google_action.UpdatedUserGoogleAction
+    else:
+      raise RuntimeError('invalid action: %s' % action)
+
+  def _Chains(self, actions):
+    """ Group the users to be handled into chains which must be done in
+    order.  Two users are in the same chain if they share a Google
+    username, counting a renamed user's old username as well as its new
+    one; most users are in a chain of their own.  Within a chain the
+    renames come first, so a username is freed before another user is
+    added or updated under it, each rename after any rename away from
+    its new username; the rest follow in the order of 'actions'.
+    Args:
+      actions: list of the actions to be done, in the order they should
+        be done within a chain, after the renames
+    Returns:
+      list of chains, each a list of (action, dn) tuples
+    """
+    # union-find over the usernames, with the DNs as the members
+    parent = {}
+    def Find(key):
+      root = key
+      while parent[root] != root:
+        root = parent[root]
+      while parent[key] != root:
+        (parent[key], key) = (root, parent[key])
+      return root
+
+    owner = {}
+    order = {}
+    renames = {}
+    for ix in xrange(len(actions)):
+      action = actions[ix]
+      for dn in self._users.UserDNs('meta-Google-action', action):
+        order[dn] = (ix, dn)
+        parent[dn] = dn
+        attrs = self._users.LookupDN(dn)
+        names = [attrs.get('GoogleUsername')]
+        if action == 'renamed':
+          names.append(attrs.get('meta-Google-old-username'))
+          renames[dn] = [(name or '').lower() for name in names]
+        for name in names:
+          if not name:
+            continue
+          name = name.lower()
+          if name in owner:
+            parent[Find(dn)] = Find(owner[name])
+          else:
+            owner[name] = dn
+
+    groups = {}
+    for dn in parent:
+      groups.setdefault(Find(dn), []).append(order[dn])
+    chains = []
+    for group in groups.itervalues():
+      group.sort()
+      pending = [dn for (ix, dn) in group if dn in renames]
+      chain = []
+      while pending:
+        # a rename can go once no pending rename still holds its new name
+        held = dict([(renames[dn][1], dn) for dn in pending])
+        ready = [dn for dn in pending
+                 if held.get(renames[dn][0], dn) == dn]
+        if not ready:
+          # a cycle, e.g. two users swapping names; one of them will fail
+          ready = pending[:1]
+        for dn in ready:
+          chain.append(('renamed', dn))
+          pending.remove(dn)
+      chain.extend([(actions[ix], dn) for (ix, dn) in group
+                    if dn not in renames])
+      chains.append(chain)
+    return chains
 
 
 class Gworker(threading.Thread):
@@ -575,49 +1112,124 @@ class Gworker(threading.Thread):
   in this case means adding them to Google Apps for Your Domain,
   locking their account, or whatever the 'handleClass' class does.
   This is where the <action>GoogleAction classes are called.
+  The same thread handles every action of a sync, one batch after
+  another, until it reads a None from the queue.
   """
   def __init__(self, api, sync_google):
     """ Constructor.
     Args:
       api: instance of google.appsforyourdomain.provisioning.API
       (which means the caller must have already authenticated with
-      Google)
+      Google), usually wrapped in an adaptive_concurrency.MeasuredAPI
       sync_google: instance of SyncGoogle object containing
-        queueIn: a queue for reading
-        gclass: a new-style Class object, which must be a subclass of
-          GoogleAct
+        _limiter: the ConcurrencyLimiter deciding how many workers
+          may be busy at once
+        queue_google: a queue for reading
+        queue_result: the queue for the current batch's results
+        gclasses: dictionary of new-style Class objects, which must be
+          subclasses of GoogleAction, by action, for the current batch
         thread_stats: an object of class ThreadStats, to be used for
-          accumulating statistics while we're running
+          accumulating statistics for the current batch
     """
     threading.Thread.__init__(self)
+    self._sync_google = sync_google
+    self._limiter = sync_google._limiter
     self._queueIn = sync_google.queue_google
-    self._queueOut = sync_google.queue_result
-    self._timeout = QUEUE_TIMEOUT
     self._api = api
-    self._handleClass = sync_google.gclass
-    self._handler = sync_google.gclass(api, self._queueOut, 
-                                       sync_google.thread_stats,
-                                       vars=sync_google)
+    self._batch = None
+    self._queueOut = None
+    self._handlers = {}
+    # what the handlers report goes here first, in case of a retry
+    self._outcome = ActionOutcome()
+
+  def _Handler(self, batch, action):
+    """ The handler for an action in a batch.  The handlers are made from
+    the SyncGoogle's gclasses, queue_result and thread_stats, which
+    change from batch to batch.
+    Args:
+      batch: the batch number
+      action: the action
+    Returns:
+      an instance of a GoogleAction subclass
+    """
+    sync_google = self._sync_google
+    if batch != self._batch:
+      self._batch = batch
+      self._queueOut = sync_google.queue_result
+      self._handlers = {}
+    if action not in self._handlers:
+      self._handlers[action] = sync_google.gclasses[action](
+          self._api, self._outcome, self._outcome, vars=sync_google)
+    return self._handlers[action]
+
+  def _IsTransient(self, failure, attempt):
+    """ Whether a failure should be retried
+    Args:
+      failure: the failure message
+      attempt: how many times the item has been retried already
+    """
+    return (adaptive_concurrency.IsOverload(failure) and
+            attempt < self._sync_google.google_max_retries)
+
+  def _HandleChain(self, batch, chain, attempt):
+    """ Handle the items of a chain, in order.  If one fails in a way
+    which might go away (see adaptive_concurrency.IsOverload), it and
+    the rest of the chain are retried later, up to google_max_retries
+    times.
+    Args:
+      batch: the batch number
+      chain: list of (action, dn, attrs) tuples
+      attempt: how many times the chain has been retried
+    Returns:
+      the number of users finished with
+    """
+    sync_google = self._sync_google
+    for ix in xrange(len(chain)):
+      (action, dn, attrs) = chain[ix]
+      try:
+        self._Handler(batch, action).Handle(dn, attrs)
+      except Exception, e:
+        # the handlers report their own failures, so this is a bug, but
+        # the user still needs a result
+        logging.exception('error handling %s' % dn)
+        self._outcome.PutResult(dn, action, str(e))
+      failure = self._outcome.GetFailure()
+      if failure and self._IsTransient(failure, attempt):
+        logging.info('transient failure to handle \'%s\' on %s: %s' %
+                     (action, dn, failure))
+        self._outcome.Reset()
+        sync_google.Retry((batch, chain[ix:], attempt + 1), attempt + 1)
+        return ix
+      self._outcome.Commit(self._queueOut, sync_google.thread_stats)
+    return len(chain)
 
   def run(self):
-    """ Starts the thread. This will keep reading the queue until it's
-    empty and then return.
+    """ Starts the thread. This will keep reading the queue until it
+    reads a None, and then return.
     """
     logging.debug('thread %s started' % self.getName())
     while True:
-      try:
-        item = self._queueIn.get(block=True, timeout=self._timeout)
-        (dn, attrs) = item
-        self._handler.Handle(dn, attrs)
-      except Queue.Empty:
+      item = self._queueIn.get()
+      if item is None:
         break
+      (batch, chain, attempt) = item
+      if batch != self._sync_google._batch:
+        # left over from a batch which was given up on
+        continue
+      self._limiter.Acquire()
+      try:
+        done = self._HandleChain(batch, chain, attempt)
+      finally:
+        self._limiter.Release()
+      if done:
+        self._sync_google.ItemDone(batch, done)
 
 class StatusReader(threading.Thread):
 
   """ An object that sits on the end of the queue with status results
   coming back, e.g. "added user X" or "failed to rename user Y"
   """
-  def __init__(self, queue, userdb, handle_class, timeout=QUEUE_TIMEOUT):
+  def __init__(self, queue, userdb, handle_class, progress=None):
     """ Constructor
     Args:
       queue: an instance of google_result_queue.GoogleResultQueue
@@ -625,26 +1237,30 @@ class StatusReader(threading.Thread):
       handle_class: class to instantiate to handle results (note this
         is a class variable, not an instance of the class). This must
         be a new-style Class object and a subclass of GoogleResultHandler
-      timeout: time, in seconds, to wait for queue results
+      progress: a progress_log.ProgressLog to record each user in once
+        their result is handled, or None
     """
     threading.Thread.__init__(self)
     self._queue = queue
     self._userdb = userdb
     self._handle_class = handle_class
     self._handler = handle_class(userdb)
-    self._timeout = timeout
+    self._progress = progress
 
   def run(self):
-    """ Starts the thread
+    """ Starts the thread. This handles results until it reads a None.
     """
     logging.debug('thread %s started' % self.getName())
     while True:
-      try:
-        (dn, act, failure, obj) = self._queue.get(block=True,
-                                                  timeout=self._timeout)
-        self._handler.Handle(dn, act, failure, obj)
-      except Queue.Empty:
+      result = self._queue.get()
+      if result is None:
         break
+      (dn, act, failure, obj) = result
+      self._handler.Handle(dn, act, failure, obj)
+      if self._progress:
+        attrs = self._userdb.LookupDN(dn)
+        if attrs:
+          self._progress.Record(dn, attrs)
 
 if __name__ == '__main__':
   pass
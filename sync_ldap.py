@@ -35,10 +35,13 @@ Key objects used by this module:
     logging for the Tool
 """
 
+import composite_ctxt
 import ldap_ctxt
+import ldif_ctxt
 import logging
 from optparse import OptionParser
 import messages
+import progress_log
 import sys
 import commands
 import sync_google
@@ -57,7 +60,8 @@ def SetupMain(options, api=provisioning):
          a mock api for testing.
   """
   parms = {}
-  parms.update(ldap_ctxt.LdapContext.config_parms)
+  parms.update(ldif_ctxt.LdifContext.config_parms)
+  parms.update(composite_ctxt.CompositeContext.config_parms)
   parms.update(userdb.UserDB.config_parms)
   parms.update(sync_google.SyncGoogle.config_parms)
   parms.update(utils.LogConfig.config_parms)
@@ -70,12 +74,26 @@ def SetupMain(options, api=provisioning):
   # configure the logging system accordingly:
   log_config.ConfigureBasicLogging()
 
-  ldap_context = ldap_ctxt.LdapContext(config)
   user_database = userdb.UserDB(config)
+  if config.GetAttr('ldap_sources'):
+    ldap_context = composite_ctxt.CompositeContext(config, users=user_database)
+  elif config.GetAttr('ldif_file'):
+    ldap_context = ldif_ctxt.LdifContext(config)
+  else:
+    ldap_context = ldap_ctxt.LdapContext(config)
   google_context = sync_google.SyncGoogle(user_database, config, api=api)
 
   if options.data_file:
     user_database.ReadDataFile(options.data_file)
+    google_context.progress_key = progress_log.DataFileKey(options.data_file)
+  if google_context.progress_log:
+    # any users handled after that file was written; a log left by a run
+    # without it, or with another version of it, is thrown away
+    count = progress_log.Replay(google_context.progress_log, user_database,
+                                google_context.progress_key)
+    if count:
+      logging.info(messages.msg(messages.MSG_PROGRESS_REPLAYED,
+                                (count, google_context.progress_log)))
   return (config, ldap_context, user_database, google_context, log_config)
 
 def GetValidFileFromUser():
@@ -150,6 +168,10 @@ def DoMain(options):
     while True:
       try:
         user_database.WriteDataFile(options.data_file)
+        # the data file now has everything in the progress log
+        if google_context.progress_log:
+          google_context.StopWorkers()
+          progress_log.Clear(google_context.progress_log)
         break
       except IOError, e:
         logging.error(str(e))
@@ -32,13 +32,20 @@ tool relies heavily on the 'whenChanged' timestamp, we just have to allow time
 for AD to quiesce before we start fetching from AD.
 """
 
+import BaseHTTPServer
+import Queue
+import SocketServer
+import base64
+import binascii
 import ldap
 import ldif
 import logging
 import os
 import sys
+import threading
 import time
 import unittest
+import urllib2
 from traceback import print_exc
 from google.appsforyourdomain import provisioning
 from google.appsforyourdomain import provisioning_errs
@@ -48,9 +55,22 @@ import provisioning_api_mock
 import string
 import random
 
+from src import account_snapshot
+from src import http_pool
+from src import adaptive_concurrency
+from src import composite_ctxt
+from src import last_update_time
 from src import ldap_ctxt
+from src import ldif_ctxt
+from src import progress_log
+from src import rate_limiter
+from src import result_spool
 from src import commands
 from src import sync_ldap
+from src import sync_google
+from src import token_cache
+from src import updated_user_google_action
+from src import userdb
 
 ###############################################################################
 
@@ -1354,6 +1374,2537 @@ class SyncLdapUnitTest(unittest.TestCase):
     self.cmd.onecmd('syncOneUser -f name=%s' % name)
     self.assertAccountExists(attrs['GoogleUsername'])
 
+class LdifContextUnitTest(unittest.TestCase):
+
+  """ Searches of an LDIF file, which need no LDAP server
+  """
+
+  FNAME = 'ldif_context_unittest.ldif'
+
+  def setUp(self):
+    # the DNs have to be filled in for the LDIF parser to accept them
+    f = open(os.path.join('.', 'testsourcedata', 'userspec.ldif'))
+    ldif_text = f.read()
+    f.close()
+    ldif_text = ldif_text.replace('${LDAPOU}', 'Users')
+    ldif_text = ldif_text.replace('${LDAPDN}', 'DC=example,DC=com')
+    f = open(self.FNAME, 'w')
+    f.write(ldif_text)
+    f.close()
+    self.config = utils.Config(ldif_ctxt.LdifContext.config_parms)
+    self.ctxt = ldif_ctxt.LdifContext(self.config)
+    self.ctxt.ldif_file = self.FNAME
+    self.ctxt.ldap_user_filter = '(&(objectClass=user)(cn=tuser))'
+    self.assertEqual(self.ctxt.Connect(), None)
+
+  def tearDown(self):
+    os.remove(self.FNAME)
+
+  def testUserFilter(self):
+    users = self.ctxt.Search()
+    self.assertEqual(users.UserCount(), 1)
+    self.assertEqual(users.db.values()[0]['mail'], 'tuser@${MAILDOMAIN}')
+
+  def testFilterOperators(self):
+    for (query, count) in [
+        ('(cn=nobody)', 0),
+        ('(!(cn=nobody))', 1),
+        ('(|(cn=nobody)(sn=TUSER))', 1),
+        ('(mail=tu*@*)', 1),
+        ('(mail=*x*)', 0),
+        ('(userAccountControl>=544)', 1),
+        ('(userAccountControl<=543)', 0),
+        ('(userAccountControl:1.2.840.113556.1.4.803:=32)', 1),
+        ('(userAccountControl:1.2.840.113556.1.4.803:=2)', 0),
+        ('(telephoneNumber=*)', 0)]:
+      users = self.ctxt.Search(filter_arg=query)
+      self.assertEqual(users.UserCount(), count, query)
+
+  def testAttrlist(self):
+    users = self.ctxt.Search(attrlist=['cn', 'SN'])
+    attrs = users.db.values()[0]
+    self.assert_('sn' in attrs)
+    self.assert_('mail' not in attrs)
+
+  def testBadFilter(self):
+    self.assertEqual(self.ctxt.Search(filter_arg='(&(cn=tuser)'), None)
+
+class _FakeLdapConn(object):
+
+  """ Stands in for an LDAP connection, for the async searches: it has
+  'entries' to return, and raises 'error' once, after 'fail_after' of
+  them.  'batches' records how many entries each result() returned.
+  """
+
+  def __init__(self, entries, fail_after=None, error=None):
+    self.entries = entries
+    self.fail_after = fail_after
+    self.error = error
+    self.batches = []
+    self._pending = []
+
+  def search_ext(self, base, scope, query, attrlist=None, serverctrls=None):
+    self._pending = list(self.entries)
+    return 1
+
+  def result(self, msgid=None, all=1, timeout=None):
+    if self.fail_after is not None and (
+        len(self.entries) - len(self._pending) >= self.fail_after):
+      self.fail_after = None
+      raise self.error
+    if not self._pending:
+      return (ldap.RES_SEARCH_RESULT, [])
+    if all:
+      (found, self._pending) = (self._pending, [])
+      self.batches.append(len(found))
+      return (ldap.RES_SEARCH_RESULT, found)
+    self.batches.append(1)
+    return (ldap.RES_SEARCH_ENTRY, [self._pending.pop(0)])
+
+  def abandon_ext(self, msgid):
+    self._pending = []
+
+class AsyncSearchUnitTest(unittest.TestCase):
+
+  """ LdapContext's searches without paging, against a stand-in
+  connection
+  """
+
+  ENTRIES = [('cn=tuser%d,o=example' % ix, {'cn': ['tuser%d' % ix]})
+             for ix in xrange(5)]
+
+  def setUp(self):
+    self.ctxt = ldap_ctxt.LdapContext(
+        utils.Config(ldap_ctxt.LdapContext.config_parms))
+    self.ctxt.ldap_base_dn = 'o=example'
+    self._retry_sleep = ldap_ctxt.RETRY_SLEEP
+    ldap_ctxt.RETRY_SLEEP = 0
+
+  def tearDown(self):
+    ldap_ctxt.RETRY_SLEEP = self._retry_sleep
+
+  def testAllAtOnce(self):
+    self.ctxt.conn = _FakeLdapConn(self.ENTRIES)
+    users = self.ctxt._AsyncSearch('(cn=*)', 0)
+    self.assertEqual(list(users), self.ENTRIES)
+    self.assertEqual(self.ctxt.conn.batches, [5])
+
+  def testMemoryBudget(self):
+    self.ctxt.ldap_memory_budget = 2
+    self.ctxt.conn = _FakeLdapConn(self.ENTRIES)
+    users = self.ctxt._AsyncSearch('(cn=*)', 0)
+    self.assertEqual(list(users), self.ENTRIES)
+    self.assertEqual(self.ctxt.conn.batches, [1, 1, 1, 1, 1])
+    self.assert_(users._file)
+    users.close()
+
+  def testRetry(self):
+    self.ctxt.ldap_memory_budget = 1
+    self.ctxt.conn = _FakeLdapConn(self.ENTRIES, 3, ldap.SERVER_DOWN())
+    self.ctxt._Reconnect = lambda: True
+    spools = []
+    ResultSpool = result_spool.ResultSpool
+    class Spool(ResultSpool):
+      def __init__(self, budget=0):
+        ResultSpool.__init__(self, budget)
+        spools.append(self)
+    result_spool.ResultSpool = Spool
+    try:
+      users = self.ctxt._AsyncSearch('(cn=*)', 0)
+    finally:
+      result_spool.ResultSpool = ResultSpool
+    # nothing from the failed attempt is kept, in memory or on disk
+    self.assertEqual(list(users), self.ENTRIES)
+    for spool in spools:
+      if spool is not users:
+        self.assertEqual((len(spool), spool._file), (0, None))
+    users.close()
+
+  def testFailure(self):
+    self.ctxt.ldap_max_retries = 0
+    self.ctxt.conn = _FakeLdapConn(self.ENTRIES, 0, ldap.SERVER_DOWN())
+    self.assertRaises(ldap.SERVER_DOWN, self.ctxt._AsyncSearch, '(cn=*)', 0)
+
+class _Gate(object):
+
+  """ Holds up each search that Arrive()s until 'count' of them have, or
+  a few seconds have gone by, and notes whether they all got there
+  together, i.e. ran at the same time
+  """
+
+  def __init__(self, count):
+    self.count = count
+    self.arrived = 0
+    self.together = True
+    self._cond = threading.Condition()
+
+  def Arrive(self):
+    self._cond.acquire()
+    try:
+      self.arrived += 1
+      self._cond.notifyAll()
+      deadline = time.time() + 5
+      while self.arrived < self.count and time.time() < deadline:
+        self._cond.wait(deadline - time.time())
+      if self.arrived < self.count:
+        self.together = False
+    finally:
+      self._cond.release()
+
+class _QueryLdapConn(_FakeLdapConn):
+
+  """ A _FakeLdapConn with the entries for each filter in 'by_query',
+  whose searches wait at 'gate', if there is one
+  """
+
+  def __init__(self, by_query, gate=None, fail_after=None, error=None):
+    _FakeLdapConn.__init__(self, [], fail_after, error)
+    self.by_query = by_query
+    self.gate = gate
+
+  def search_ext(self, base, scope, query, attrlist=None, serverctrls=None):
+    if self.gate:
+      self.gate.Arrive()
+    self.entries = self.by_query.get(query, [])
+    return _FakeLdapConn.search_ext(self, base, scope, query, attrlist,
+                                    serverctrls)
+
+  def unbind_s(self):
+    pass
+
+class _ClonedLdapContext(ldap_ctxt.LdapContext):
+
+  """ An LdapContext whose Connect() hands out the stand-in connections
+  in 'conns' in turn, rather than connecting, so its clones share them
+  """
+
+  def __init__(self, config, conns):
+    ldap_ctxt.LdapContext.__init__(self, config)
+    self.conns = conns
+
+  def Connect(self):
+    if not self.conns:
+      return -1
+    self.conn = self.conns.pop(0)
+    return None
+
+class ConcurrentSearchUnitTest(unittest.TestCase):
+
+  """ LdapContext.ConcurrentSearch, against stand-in connections, and
+  updateUsers' use of it
+  """
+
+  FNAME = 'concurrent_search_unittest.tmp'
+  BY_QUERY = {}
+  for name in ('a', 'b', 'c'):
+    BY_QUERY['(cn=%s*)' % name] = [
+        ('cn=%s%d,o=example' % (name, ix), {'cn': ['%s%d' % (name, ix)]})
+        for ix in xrange(3)]
+  SEARCHES = [('Search', {'filter_arg': '(cn=a*)'}),
+              ('Search', {'filter_arg': '(cn=b*)'}),
+              ('Search', {'filter_arg': '(cn=c*)'})]
+
+  def setUp(self):
+    last_update_time.setFilename(self.FNAME)
+    parms = {}
+    parms.update(ldap_ctxt.LdapContext.config_parms)
+    parms.update(userdb.UserDB.config_parms)
+    self.config = utils.Config(parms)
+    self.ctxt = _ClonedLdapContext(self.config, [])
+    self.ctxt.ldap_url = 'ldap://example'
+    self.ctxt.ldap_base_dn = 'o=example'
+    self.ctxt.ldap_user_filter = '(cn=a*)'
+    self.ctxt.ldap_max_retries = 0
+    self._retry_sleep = ldap_ctxt.RETRY_SLEEP
+    ldap_ctxt.RETRY_SLEEP = 0
+
+  def tearDown(self):
+    ldap_ctxt.RETRY_SLEEP = self._retry_sleep
+    last_update_time.setFilename('')
+
+  def _Conns(self, count, gate=None):
+    return [_QueryLdapConn(self.BY_QUERY, gate) for ix in xrange(count)]
+
+  def _DNs(self, users):
+    dns = users.UserDNs()
+    dns.sort()
+    return dns
+
+  def testParallel(self):
+    gate = _Gate(3)
+    (self.ctxt.conn, self.ctxt.conns[:]) = (self._Conns(1, gate)[0],
+                                            self._Conns(2, gate))
+    results = self.ctxt.ConcurrentSearch(self.SEARCHES)
+    self.assert_(gate.together)
+    self.assertEqual([self._DNs(users) for users in results],
+                     [[dn.lower() for (dn, attrs) in self.BY_QUERY[query]]
+                      for query in ('(cn=a*)', '(cn=b*)', '(cn=c*)')])
+
+  def testNoConnection(self):
+    # only one more connection to be had: the last search runs after the
+    # others, on this context's connection
+    (self.ctxt.conn, self.ctxt.conns[:]) = (self._Conns(1)[0],
+                                            self._Conns(1))
+    results = self.ctxt.ConcurrentSearch(self.SEARCHES)
+    self.assertEqual([users.UserCount() for users in results], [3, 3, 3])
+    self.assertEqual(self._DNs(results[2])[0], 'cn=c0,o=example')
+
+  def testFailedBranch(self):
+    self.ctxt.conn = self._Conns(1)[0]
+    self.ctxt.conns[:] = [
+        _QueryLdapConn(self.BY_QUERY, fail_after=0, error=ldap.SERVER_DOWN()),
+        _QueryLdapConn(self.BY_QUERY)]
+    results = self.ctxt.ConcurrentSearch(self.SEARCHES)
+    self.assertEqual(results[1], None)
+    self.assertEqual((results[0].UserCount(), results[2].UserCount()),
+                     (3, 3))
+
+  def _UpdateUsers(self, conns):
+    users = userdb.UserDB(self.config)
+    users.MapAttr('GoogleUsername', 'cn')
+    users.MapAttr('GoogleFirstName', 'cn')
+    users.MapAttr('GoogleLastName', 'cn')
+    self.ctxt.conn = self._Conns(1)[0]
+    self.ctxt.conns[:] = conns
+    cmd = commands.Commands(self.ctxt, users, None, self.config)
+    cmd.onecmd('updateUsers')
+    return users
+
+  def testUpdateUsers(self):
+    users = self._UpdateUsers(self._Conns(1))
+    self.assertEqual(_Meta(users, 'meta-Google-action'),
+                     {'cn=a0,o=example': 'added', 'cn=a1,o=example': 'added',
+                      'cn=a2,o=example': 'added'})
+    self.failIf(last_update_time.WAS_ERRORS)
+
+  def testUpdateUsersFails(self):
+    # the search for everyone fails: no users can be told apart from
+    # deleted ones, so nothing's done, and the run's marked bad
+    users = self._UpdateUsers([
+        _QueryLdapConn(self.BY_QUERY, fail_after=0, error=ldap.SERVER_DOWN())])
+    self.assertEqual(users.UserCount(), 0)
+    self.assert_(last_update_time.WAS_ERRORS)
+
+class _AttrsLdapConn(_FakeLdapConn):
+
+  """ A _FakeLdapConn for 'count' users, each with the attributes in
+  'user_attrs' and the operational ones in 'operational', of which it
+  returns those asked for, as a server does.  If 'refuse_both' is set, it
+  won't return both kinds at once.  Its schema is 'schema', the
+  attributes of its subschema entry, or it has none if that's None.
+  """
+
+  def __init__(self, count, user_attrs, operational, schema=None,
+               refuse_both=False):
+    _FakeLdapConn.__init__(self, [])
+    self.dns = ['cn=tuser%d,o=example' % ix for ix in xrange(count)]
+    self.user_attrs = user_attrs
+    self.operational = operational
+    self.schema = schema
+    self.refuse_both = refuse_both
+    self.attrlists = []
+
+  def search_ext(self, base, scope, query, attrlist=None, serverctrls=None):
+    self.attrlists.append(attrlist)
+    wanted = attrlist or ['*']
+    if self.refuse_both and '*' in wanted and '+' in wanted:
+      raise ldap.UNWILLING_TO_PERFORM()
+    attrs = {}
+    if '*' in wanted:
+      attrs.update(self.user_attrs)
+    if '+' in wanted:
+      attrs.update(self.operational)
+    self.entries = [(dn, attrs.copy()) for dn in self.dns]
+    return _FakeLdapConn.search_ext(self, base, scope, query, attrlist,
+                                    serverctrls)
+
+  def search_s(self, base, scope, query, attrlist=None):
+    if self.schema is None:
+      raise ldap.NO_SUCH_OBJECT()
+    if not base:
+      return [('', {'subschemaSubentry': ['cn=Subschema']})]
+    return [('cn=Subschema', self.schema)]
+
+class TestFilterUnitTest(unittest.TestCase):
+
+  """ What the testFilter command asks the server: a count of the users
+  without their attributes, then the attributes of a sample of them,
+  from the users themselves and from the schema
+  """
+
+  USER_ATTRS = {'objectClass': ['top', 'person'], 'cn': ['Test'],
+                'sn': ['User']}
+  OPERATIONAL = {'modifyTimestamp': ['20070101000000Z']}
+  SCHEMA = {
+      'objectClasses': [
+          "( 2.5.6.0 NAME 'top' ABSTRACT MUST objectClass )",
+          "( 2.5.6.6 NAME 'person' SUP top STRUCTURAL MUST ( sn $ cn ) "
+          "MAY ( userPassword $ telephoneNumber ) )"],
+      'attributeTypes': [
+          "( 2.5.4.0 NAME 'objectClass' "
+          "SYNTAX 1.3.6.1.4.1.1466.115.121.1.38 )",
+          "( 2.5.4.41 NAME 'name' SYNTAX 1.3.6.1.4.1.1466.115.121.1.15 )",
+          "( 2.5.4.3 NAME ( 'cn' 'commonName' ) SUP name )",
+          "( 2.5.4.4 NAME ( 'sn' 'surname' ) SUP name )",
+          "( 2.5.4.35 NAME 'userPassword' "
+          "SYNTAX 1.3.6.1.4.1.1466.115.121.1.40 )",
+          "( 2.5.4.20 NAME 'telephoneNumber' "
+          "SYNTAX 1.3.6.1.4.1.1466.115.121.1.50 )"]}
+
+  def setUp(self):
+    parms = {}
+    parms.update(ldap_ctxt.LdapContext.config_parms)
+    parms.update(userdb.UserDB.config_parms)
+    config = utils.Config(parms)
+    self.ctxt = ldap_ctxt.LdapContext(config)
+    self.ctxt.ldap_url = 'ldap://example'
+    self.ctxt.ldap_base_dn = 'o=example'
+    self.ctxt.ldap_user_filter = '(objectClass=person)'
+    self.cmd = commands.Commands(self.ctxt, userdb.UserDB(config), None,
+                                 config)
+    self._sleep_time = ldap_ctxt.SLEEP_TIME
+    ldap_ctxt.SLEEP_TIME = 0
+
+  def tearDown(self):
+    ldap_ctxt.SLEEP_TIME = self._sleep_time
+
+  def _Connect(self, schema=None, refuse_both=False):
+    self.ctxt.conn = _AttrsLdapConn(5, self.USER_ATTRS, self.OPERATIONAL,
+                                    schema, refuse_both)
+
+  def testCountUsers(self):
+    self._Connect()
+    self.assertEqual(self.ctxt.CountUsers(), 5)
+    # no attributes are fetched just to count the users
+    self.assertEqual(self.ctxt.conn.attrlists, [['1.1']])
+
+  def testSampleAttributes(self):
+    self._Connect(self.SCHEMA)
+    (sample, attrs) = self.cmd._SampleAttributes()
+    self.assertEqual(sample.UserCount(), 1)
+    self.assertEqual(attrs, ['cn', 'modifyTimestamp', 'objectClass', 'sn',
+                             'telephoneNumber', 'userPassword'])
+    self.assertEqual(self.ctxt.conn.attrlists, [['*', '+']])
+
+  def testNoSchema(self):
+    # the schema can't be read: the sample's own attributes will do
+    self._Connect()
+    self.assertEqual(self.ctxt.GetSchemaAttributes(['person']), None)
+    (sample, attrs) = self.cmd._SampleAttributes()
+    self.assertEqual(attrs, ['cn', 'modifyTimestamp', 'objectClass', 'sn'])
+
+  def testRefuseBoth(self):
+    # both kinds of attribute at once are refused: ten users, then one
+    # with its operational attributes
+    self._Connect(self.SCHEMA, refuse_both=True)
+    (sample, attrs) = self.cmd._SampleAttributes()
+    self.assertEqual(sample.UserCount(), 5)
+    attrs.sort()
+    self.assertEqual(attrs, ['cn', 'modifyTimestamp', 'objectClass', 'sn'])
+    self.assertEqual(self.ctxt.conn.attrlists, [['*', '+'], None, ['+']])
+
+class _PageControl(object):
+
+  """ Stands in for a paged results control, as the python-ldap this
+  module was written for has it: controlValue is (size, cookie)
+  """
+
+  def __init__(self, control_type, criticality, value):
+    self.controlType = control_type
+    self.criticality = criticality
+    self.controlValue = value
+
+class _FakePagingConn(object):
+
+  """ Stands in for an LDAP connection, for paged searches: it returns
+  'entries' a page at a time, the cookie being the index of the next
+  entry.  It raises 'error' on the result of page 'fail_on' (counting
+  from 0), and then, if 'reject_cookie', rejects the next search which
+  tries to resume.  'cookies' records the cookie of each search.
+  """
+
+  def __init__(self, entries, fail_on=None, error=None, reject_cookie=False):
+    self.entries = entries
+    self.fail_on = fail_on
+    self.error = error
+    self.reject_cookie = reject_cookie
+    self.cookies = []
+    self._pages = 0
+
+  def search_ext(self, base, scope, query, attrlist=None, serverctrls=None):
+    for ctrl in serverctrls:
+      if ctrl.controlType == ldap.LDAP_CONTROL_PAGE_OID:
+        (self._size, cookie) = ctrl.controlValue
+    self.cookies.append(cookie)
+    if cookie and self.reject_cookie and self.fail_on is None:
+      self.reject_cookie = False
+      raise ldap.UNWILLING_TO_PERFORM()
+    self._start = int(cookie or 0)
+    return 1
+
+  def result3(self, msgid=None, all=1, timeout=None):
+    if self._pages == self.fail_on:
+      self.fail_on = None
+      raise self.error
+    self._pages += 1
+    end = self._start + self._size
+    cookie = ''
+    if end < len(self.entries):
+      cookie = str(end)
+    ctrl = _PageControl(ldap.LDAP_CONTROL_PAGE_OID, False,
+                        (len(self.entries), cookie))
+    return (ldap.RES_SEARCH_RESULT, self.entries[self._start:end], msgid,
+            [ctrl])
+
+class PagedSearchUnitTest(unittest.TestCase):
+
+  """ LdapContext's paged searches, against a stand-in connection which
+  can fail part way
+  """
+
+  ENTRIES = [('cn=tuser%d,o=example' % ix, {'cn': ['tuser%d' % ix]})
+             for ix in xrange(5)]
+
+  def setUp(self):
+    self.ctxt = ldap_ctxt.LdapContext(
+        utils.Config(ldap_ctxt.LdapContext.config_parms))
+    self.ctxt.ldap_base_dn = 'o=example'
+    self.ctxt.ldap_page_size = 2
+    self.ctxt._Reconnect = lambda: True
+    self._retry_sleep = ldap_ctxt.RETRY_SLEEP
+    ldap_ctxt.RETRY_SLEEP = 0
+    self._control = ldap_ctxt.SimplePagedResultsControl
+    ldap_ctxt.SimplePagedResultsControl = _PageControl
+
+  def tearDown(self):
+    ldap_ctxt.RETRY_SLEEP = self._retry_sleep
+    ldap_ctxt.SimplePagedResultsControl = self._control
+
+  def _Search(self, conn):
+    self.ctxt.conn = conn
+    users = self.ctxt._PagedAsyncSearch('(cn=*)', 0)
+    try:
+      return list(users)
+    finally:
+      users.close()
+
+  def testPages(self):
+    conn = _FakePagingConn(self.ENTRIES)
+    self.assertEqual(self._Search(conn), self.ENTRIES)
+    self.assertEqual(conn.cookies, ['', '2', '4'])
+
+  def testResume(self):
+    conn = _FakePagingConn(self.ENTRIES, 1, ldap.SERVER_DOWN())
+    self.assertEqual(self._Search(conn), self.ENTRIES)
+    self.assertEqual(conn.cookies, ['', '2', '2', '4'])
+
+  def testStartOver(self):
+    conn = _FakePagingConn(self.ENTRIES, 1, ldap.SERVER_DOWN(),
+                           reject_cookie=True)
+    self.assertEqual(self._Search(conn), self.ENTRIES)
+    self.assertEqual(conn.cookies, ['', '2', '2', '', '2', '4'])
+
+  def testGiveUp(self):
+    self.ctxt.ldap_max_retries = 0
+    self.ctxt.conn = _FakePagingConn(self.ENTRIES, 1, ldap.SERVER_DOWN())
+    self.assertRaises(ldap.SERVER_DOWN, self.ctxt._PagedAsyncSearch,
+                      '(cn=*)', 0)
+
+class _FakeSyncreplConnection(ldap_ctxt.SyncreplConnection):
+
+  """ Stands in for a content sync connection: syncrepl_poll() calls
+  'script' with the connection, to play the server's part.  'cookies'
+  records the cookie each search started from.
+  """
+
+  script = None
+  cookies = []
+
+  def simple_bind_s(self, who, cred):
+    pass
+
+  def syncrepl_search(self, base, scope, mode='refreshOnly', **moreargs):
+    _FakeSyncreplConnection.cookies.append(self.syncrepl_get_cookie())
+    return 1
+
+  def syncrepl_poll(self, msgid=-1, timeout=None, **moreargs):
+    _FakeSyncreplConnection.script(self)
+    return False
+
+  def unbind_s(self):
+    pass
+
+class SyncreplUnitTest(unittest.TestCase):
+
+  """ LdapContext's 'syncrepl' sync mode: the changes and deletions the
+  server reports, and the cookie and entryUUID -> DN map kept between
+  runs
+  """
+
+  FNAME = 'syncrepl_unittest.tmp'
+
+  def setUp(self):
+    last_update_time.setFilename(self.FNAME)
+    self.ctxt = ldap_ctxt.LdapContext(
+        utils.Config(ldap_ctxt.LdapContext.config_parms))
+    self.ctxt.ldap_url = 'ldap://localhost'
+    self.ctxt.ldap_base_dn = 'o=example'
+    self.ctxt.ldap_user_filter = '(objectClass=person)'
+    self.ctxt.ldap_sync_mode = 'syncrepl'
+    self._connection = ldap_ctxt.SyncreplConnection
+    ldap_ctxt.SyncreplConnection = _FakeSyncreplConnection
+    _FakeSyncreplConnection.cookies = []
+
+  def tearDown(self):
+    ldap_ctxt.SyncreplConnection = self._connection
+    for name in [self.FNAME, last_update_time.getStateFilename(
+        ldap_ctxt.SYNCREPL_STATE_SUFFIX)]:
+      if os.path.exists(name):
+        os.remove(name)
+    last_update_time.setFilename('')
+
+  def _Run(self, script, error=False):
+    _FakeSyncreplConnection.script = staticmethod(script)
+    last_update_time.beginNewRun()
+    result = self.ctxt.SearchChanges()
+    if error:
+      last_update_time.reportError()
+    last_update_time.updateIfNoErrors()
+    return result
+
+  def _FirstRun(self, conn):
+    conn.syncrepl_entry('cn=A,o=example', {'cn': ['A']}, 'uuid-a')
+    conn.syncrepl_entry('cn=B,o=example', {'cn': ['B']}, 'uuid-b')
+    conn.syncrepl_set_cookie('cookie-1')
+
+  def testFirstRun(self):
+    (users, deleted) = self._Run(self._FirstRun)
+    self.assertEqual(_FakeSyncreplConnection.cookies, [None])
+    dns = users.UserDNs()
+    dns.sort()
+    self.assertEqual(dns, ['cn=a,o=example', 'cn=b,o=example'])
+    # no entryUUIDs to report deletions by yet: everyone's been found
+    self.assertEqual(deleted, None)
+    self.assertEqual(self.ctxt._ReadSyncreplState(),
+                     ('cookie-1', {'uuid-a': 'cn=a,o=example',
+                                   'uuid-b': 'cn=b,o=example'}))
+
+  def testRenameAndDelete(self):
+    self._Run(self._FirstRun)
+    def Script(conn):
+      conn.syncrepl_entry('cn=A2,o=example', {'cn': ['A2']}, 'uuid-a')
+      conn.syncrepl_delete(['uuid-b'])
+      conn.syncrepl_set_cookie('cookie-2')
+    (users, deleted) = self._Run(Script)
+    self.assertEqual(_FakeSyncreplConnection.cookies, [None, 'cookie-1'])
+    self.assertEqual(users.UserDNs(), ['cn=a2,o=example'])
+    deleted.sort()
+    self.assertEqual(deleted, ['cn=a,o=example', 'cn=b,o=example'])
+    self.assertEqual(self.ctxt._ReadSyncreplState(),
+                     ('cookie-2', {'uuid-a': 'cn=a2,o=example'}))
+
+  def testPresentPhase(self):
+    self._Run(self._FirstRun)
+    def Script(conn):
+      conn.syncrepl_present(['uuid-a'])
+      conn.syncrepl_present(None)
+      conn.syncrepl_set_cookie('cookie-2')
+    (users, deleted) = self._Run(Script)
+    self.assertEqual(users.UserCount(), 0)
+    self.assertEqual(deleted, ['cn=b,o=example'])
+
+  def testBadRun(self):
+    self._Run(self._FirstRun)
+    def Script(conn):
+      conn.syncrepl_delete(['uuid-b'])
+      conn.syncrepl_set_cookie('cookie-2')
+    self._Run(Script, error=True)
+    # the next run starts over from the last good run's cookie
+    self.assertEqual(self.ctxt._ReadSyncreplState()[0], 'cookie-1')
+
+class _FakeAdConn(object):
+
+  """ Stands in for a connection to an Active Directory domain
+  controller, for the 'usn' sync mode: 'entries' maps DN to attributes,
+  and the search filters are applied with ldif_ctxt's filter matching.
+  Tombstones (isDeleted TRUE) are only found with the show-deleted
+  control.
+  """
+
+  def __init__(self, entries, highest):
+    self.entries = entries
+    self.highest = highest
+    self._found = []
+
+  def search_s(self, base, scope, query, attrlist=None):
+    return [('', {'highestCommittedUSN': [str(self.highest)],
+                  'dnsHostName': ['DC1.example.com'],
+                  'defaultNamingContext': ['dc=example,dc=com']})]
+
+  def search_ext(self, base, scope, query, attrlist=None, serverctrls=None):
+    tree = ldif_ctxt.ParseFilter(query)
+    show_deleted = [ctrl for ctrl in serverctrls or []
+                    if ctrl.controlType == ldap_ctxt.SHOW_DELETED_OID]
+    self._found = []
+    for (dn, attrs) in self.entries.iteritems():
+      if 'isDeleted' in attrs and not show_deleted:
+        continue
+      if ldif_ctxt.MatchFilter(tree, attrs):
+        if attrlist is not None:
+          attrs = dict([(attr, vals) for (attr, vals) in attrs.iteritems()
+                        if attr in attrlist])
+        self._found.append((dn, attrs))
+    return 1
+
+  def result(self, msgid=None, all=1, timeout=None):
+    (found, self._found) = (self._found, [])
+    return (ldap.RES_SEARCH_RESULT, found)
+
+class UsnSyncUnitTest(unittest.TestCase):
+
+  """ LdapContext's 'usn' sync mode: the changes found from the
+  uSNChanged watermark, and the deletions found from tombstones and from
+  users who've stopped passing the filter
+  """
+
+  FNAME = 'usn_sync_unittest.tmp'
+  SUFFIX = ldap_ctxt.USN_STATE_SUFFIX + 'dc1.example.com'
+
+  def setUp(self):
+    last_update_time.setFilename(self.FNAME)
+    self.ctxt = ldap_ctxt.LdapContext(
+        utils.Config(ldap_ctxt.LdapContext.config_parms))
+    self.ctxt.ldap_url = 'ldap://dc1'
+    self.ctxt.ldap_base_dn = 'dc=example,dc=com'
+    self.ctxt.ldap_user_filter = '(objectClass=person)'
+    self.ctxt.ldap_sync_mode = 'usn'
+    self.entries = {}
+    for name in ['a', 'b', 'c', 'd', 'e']:
+      self._Put('cn=%s,dc=example,dc=com' % name, name, 10)
+
+  def tearDown(self):
+    for name in [self.FNAME, last_update_time.getStateFilename(self.SUFFIX)]:
+      if os.path.exists(name):
+        os.remove(name)
+    last_update_time.setFilename('')
+
+  def _Put(self, dn, name, usn, object_class='person', deleted=False):
+    attrs = {'objectClass': [object_class], 'cn': [name],
+             'objectGUID': ['guid-%s' % name], 'uSNChanged': [str(usn)]}
+    if deleted:
+      attrs['isDeleted'] = ['TRUE']
+    self.entries[dn] = attrs
+
+  def _Run(self, highest, error=False):
+    self.ctxt.conn = _FakeAdConn(self.entries, highest)
+    last_update_time.beginNewRun()
+    result = self.ctxt.SearchChanges()
+    if error:
+      last_update_time.reportError()
+    last_update_time.updateIfNoErrors()
+    return result
+
+  def testFirstRun(self):
+    (users, deleted) = self._Run(10)
+    self.assertEqual(users.UserCount(), 5)
+    # no objectGUIDs to report deletions by yet: everyone's been found
+    self.assertEqual(deleted, None)
+    lines = last_update_time.getState(self.SUFFIX).split('\n')
+    self.assertEqual(lines[0], '10')
+    self.assertEqual(len([line for line in lines[1:] if line]), 5)
+
+  def testChanges(self):
+    self._Run(10)
+    self._Put('cn=a,dc=example,dc=com', 'a', 11)
+    self._Put('cn=b,dc=example,dc=com', 'b', 12, object_class='computer')
+    del self.entries['cn=c,dc=example,dc=com']
+    self._Put('cn=c\\0ADEL,cn=deleted objects,dc=example,dc=com', 'c', 13,
+              deleted=True)
+    del self.entries['cn=d,dc=example,dc=com']
+    self._Put('cn=d2,dc=example,dc=com', 'd', 14)
+    (users, deleted) = self._Run(14)
+    dns = users.UserDNs()
+    dns.sort()
+    self.assertEqual(dns, ['cn=a,dc=example,dc=com',
+                           'cn=d2,dc=example,dc=com'])
+    deleted.sort()
+    self.assertEqual(deleted, ['cn=b,dc=example,dc=com',
+                               'cn=c,dc=example,dc=com',
+                               'cn=d,dc=example,dc=com'])
+    (watermark, guids) = self.ctxt._ReadUsnState(self.SUFFIX)
+    self.assertEqual(watermark, 14)
+    self.assertEqual(guids[ldap_ctxt._GuidKey('guid-d')],
+                     'cn=d2,dc=example,dc=com')
+    self.assert_(ldap_ctxt._GuidKey('guid-c') not in guids)
+
+  def testNoChanges(self):
+    self._Run(10)
+    (users, deleted) = self._Run(10)
+    self.assertEqual((users.UserCount(), deleted), (0, []))
+
+  def testBadRun(self):
+    self._Run(10)
+    self._Put('cn=a,dc=example,dc=com', 'a', 11)
+    self._Run(11, error=True)
+    self.assertEqual(self.ctxt._ReadUsnState(self.SUFFIX)[0], 10)
+
+  def testTombstonesClosed(self):
+    self._Run(10)
+    self._Put('cn=c\\0ADEL,cn=deleted objects,dc=example,dc=com', 'c', 11,
+              deleted=True)
+    spools = []
+    ResultSpool = result_spool.ResultSpool
+    class Spool(ResultSpool):
+      def __init__(self, budget=0):
+        ResultSpool.__init__(self, budget)
+        spools.append(self)
+    result_spool.ResultSpool = Spool
+    try:
+      self.ctxt.ldap_memory_budget = 1
+      (users, deleted) = self._Run(11)
+    finally:
+      result_spool.ResultSpool = ResultSpool
+    self.assertEqual(deleted, ['cn=c,dc=example,dc=com'])
+    # nothing's left of the searches' results, in memory or on disk
+    for spool in spools:
+      self.assertEqual((len(spool), spool._file), (0, None))
+
+  def testUpdateUsersFirstRun(self):
+    # a user from before, e.g. in timestamp mode, who's gone from LDAP by
+    # the first run in usn mode is found by the full search
+    parms = {}
+    parms.update(ldap_ctxt.LdapContext.config_parms)
+    parms.update(userdb.UserDB.config_parms)
+    users = userdb.UserDB(utils.Config(parms))
+    users.MapAttr('GoogleUsername', 'cn')
+    users.db['cn=gone,dc=example,dc=com'] = {'GoogleUsername': 'gone',
+                                             'meta-Google-action': None}
+    self.ctxt.conn = _FakeAdConn(self.entries, 10)
+    cmd = commands.Commands(self.ctxt, users, None, utils.Config(parms))
+    cmd.onecmd('updateUsers')
+    actions = _Meta(users, 'meta-Google-action')
+    self.assertEqual(actions['cn=gone,dc=example,dc=com'], 'exited')
+    self.assertEqual(actions['cn=a,dc=example,dc=com'], 'added')
+
+class LdifReadingUnitTest(unittest.TestCase):
+
+  """ What's read from an LDIF file, and what isn't
+  """
+
+  FNAME = 'ldif_reading_unittest.ldif'
+  SECRET = 'ldif_reading_unittest.secret'
+
+  def setUp(self):
+    f = open(self.SECRET, 'w')
+    f.write('not for Google')
+    f.close()
+    f = open(self.FNAME, 'w')
+    f.write('version: 1\n'
+            '\n'
+            'dn: cn=tuser1,o=example\n'
+            'objectClass: person\n'
+            'cn: tuser1\n'
+            'sn:: VHVzZXIgT25l\n'
+            'description:< file://%s\n'
+            '\n'
+            '# a comment\n'
+            'dn: cn=tuser2,\n'
+            ' o=example\n'
+            'changetype: add\n'
+            'objectClass: person\n'
+            'cn: tuser2\n'
+            '\n'
+            'dn: cn=tuser3,o=example\n'
+            'changetype: delete\n'
+            '\n'
+            'dn: cn=tuser4,o=other\n'
+            'objectClass: person\n'
+            'cn: tuser4\n' % os.path.abspath(self.SECRET))
+    f.close()
+    parms = {}
+    parms.update(ldif_ctxt.LdifContext.config_parms)
+    parms.update(userdb.UserDB.config_parms)
+    self.ctxt = ldif_ctxt.LdifContext(utils.Config(parms))
+    self.ctxt.ldif_file = self.FNAME
+    self.ctxt.ldap_user_filter = '(objectClass=person)'
+    self.ctxt.ldap_base_dn = 'o=example'
+    self.assertEqual(self.ctxt.Connect(), None)
+
+  def tearDown(self):
+    os.remove(self.FNAME)
+    os.remove(self.SECRET)
+
+  def testRecords(self):
+    users = self.ctxt.Search()
+    dns = users.UserDNs()
+    dns.sort()
+    self.assertEqual(dns, ['cn=tuser1,o=example', 'cn=tuser2,o=example'])
+    attrs = users.LookupDN('cn=tuser1,o=example')
+    self.assertEqual(attrs['sn'], 'Tuser One')
+    self.assert_('description' not in attrs)
+    self.assert_('changetype' not in users.LookupDN('cn=tuser2,o=example'))
+
+  def testSizeLimit(self):
+    self.assertEqual(self.ctxt.Search(sizelimit=1).UserCount(), 1)
+
+  def testCount(self):
+    self.assertEqual(self.ctxt.CountUsers(), 2)
+    self.assertEqual(self.ctxt.CountUsers('(cn=tuser4)'), 0)
+
+  def testSpooled(self):
+    # past ldap_memory_budget the records go to disk, as they're read;
+    # counting them keeps none
+    spills = []
+    spill = result_spool.ResultSpool._Spill
+    def _Spill(spool):
+      spills.append(len(spool))
+      spill(spool)
+    result_spool.ResultSpool._Spill = _Spill
+    try:
+      self.ctxt.ldap_memory_budget = 1
+      self.assertEqual(self.ctxt.CountUsers(), 2)
+      self.assertEqual(spills, [])
+      users = self.ctxt.Search()
+    finally:
+      result_spool.ResultSpool._Spill = spill
+    self.assertEqual(spills, [1, 2])
+    dns = users.UserDNs()
+    dns.sort()
+    self.assertEqual(dns, ['cn=tuser1,o=example', 'cn=tuser2,o=example'])
+
+  def testBadFile(self):
+    f = open(self.FNAME, 'w')
+    f.write('cn: no dn\n')
+    f.close()
+    self.assertEqual(self.ctxt.Search(), None)
+    self.assertEqual(self.ctxt.CountUsers(), None)
+
+class PrimaryKeyUnitTest(unittest.TestCase):
+
+  """ Looking users up by primary key, whatever form the key is given in
+  """
+
+  GUID = '\x4f\x2a\x00\xff\x10\x20\x30\x40\x50\x60\x70\x80\x90\xa0\xb0\xc0'
+
+  def _Users(self, primary_key, users):
+    users_db = userdb.UserDB(utils.Config(userdb.UserDB.config_parms))
+    users_db.primary_key = primary_key
+    users_db._AddUsers(users)
+    return users_db
+
+  def testGuid(self):
+    users = self._Users('objectGUID', [
+        ('CN=Fred,o=example', {'objectGUID': [self.GUID], 'cn': ['Fred']})])
+    hexed = binascii.hexlify(self.GUID)
+    for val in [self.GUID, hexed, hexed.upper(),
+                userdb._ConvertFromGuid(self.GUID),
+                userdb._ConvertFromGuid(self.GUID).lower()]:
+      self.assertEqual(users.LookupAttrVal('objectGUID', val),
+                       ['cn=fred,o=example'], repr(val))
+    self.assertEqual(users._FindPrimaryKey({'objectGUID': hexed}),
+                     'cn=fred,o=example')
+    self.assertEqual(users.LookupAttrVal('objectGUID', '0' * 32), [])
+
+  def testMixedCase(self):
+    users = self._Users('mail', [
+        ('CN=John,o=example', {'mail': ['John.Doe@example.com']}),
+        ('CN=Jane,o=example', {'mail': ['jane@example.com']})])
+    # as syncOneUser passes it:
+    self.assertEqual(users.LookupAttrVal('mail', 'john.doe@example.com'),
+                     ['cn=john,o=example'])
+    self.assertEqual(users.LookupAttrVal('mail', 'John.Doe@example.com'),
+                     ['cn=john,o=example'])
+    self.assertEqual(users.LookupAttrVal('mail', 'jane@example.com'),
+                     ['cn=jane,o=example'])
+    self.assertEqual(users.LookupAttrVal('mail', 'nobody@example.com'), [])
+
+  def testDeleteUser(self):
+    users = self._Users('objectGUID', [
+        ('CN=Fred,o=example', {'objectGUID': [self.GUID], 'cn': ['Fred']})])
+    users.DeleteUser('cn=fred,o=example')
+    self.assertEqual(users.primary_key_lookup, {})
+
+class SearchAttributesUnitTest(unittest.TestCase):
+
+  """ UserDB.GetSearchAttributes(), and telling AD from other directories
+  """
+
+  def _Users(self, seen):
+    users = userdb.UserDB(utils.Config(userdb.UserDB.config_parms))
+    users.SetTimestamp('modifyTimestamp')
+    users.attrs = users.attrs.union(seen)
+    users.mapping['GoogleUsername'] = "mail.split('@')[0]"
+    return users
+
+  def testNothingKnownYet(self):
+    self.assertEqual(self._Users([]).GetSearchAttributes(), None)
+
+  def testOpenLdap(self):
+    users = self._Users(['cn', 'mail', 'givenName', 'sn', 'displayName',
+                         'uid', 'objectClass'])
+    attrs = users.GetSearchAttributes()
+    self.assertEqual(attrs, ['displayName', 'givenName', 'mail',
+                             'modifyTimestamp', 'sn', 'uid'])
+    self.assertEqual(commands._GetDirectoryType(users.GetAttributes(),
+                                                'modifyTimestamp'),
+                     'openldap')
+
+  def testActiveDirectory(self):
+    users = self._Users(['cn', 'givenName', 'sn', 'displayName',
+                         'sAMAccountName'])
+    attrs = users.GetSearchAttributes()
+    self.assert_('sAMAccountName' in attrs)
+    self.assert_('mail' not in attrs)
+    self.assertEqual(commands._GetDirectoryType(users.GetAttributes()), 'ad')
+    self.assertEqual(commands._GetDirectoryType([], 'whenChanged'), 'ad')
+
+class LdapRecordUnitTest(unittest.TestCase):
+
+  """ LdapRecord's de-listifying of values as they're used, and UserDB
+  leaving the rest alone
+  """
+
+  def testGet(self):
+    attrs = userdb.LdapRecord({'cn': ['Fred'], 'mail': ['f@x', 'g@x']})
+    self.assertEqual(dict.__getitem__(attrs, 'cn'), ['Fred'])
+    self.assertEqual(attrs['cn'], 'Fred')
+    self.assertEqual(dict.__getitem__(attrs, 'cn'), 'Fred')
+    self.assertEqual(attrs['mail'], ['f@x', 'g@x'])
+    self.assertEqual(attrs.get('sn', 'none'), 'none')
+    self.assertRaises(KeyError, attrs.__getitem__, 'sn')
+
+  def testWholeRecord(self):
+    attrs = userdb.LdapRecord({'cn': ['Fred'], 'sn': ['Smith']})
+    self.assertEqual(attrs, {'cn': 'Fred', 'sn': 'Smith'})
+    self.assertEqual(dict(attrs.iteritems()), {'cn': 'Fred', 'sn': 'Smith'})
+    self.assertEqual(attrs.values().count('Smith'), 1)
+    copied = userdb.LdapRecord({'cn': ['Fred']}).copy()
+    self.assert_(isinstance(copied, userdb.LdapRecord))
+    self.assertEqual(copied['cn'], 'Fred')
+    attrs = userdb.LdapRecord({'cn': ['Fred'], 'sn': ['Smith']})
+    self.assertEqual(attrs.pop('cn'), 'Fred')
+    self.assertEqual(attrs.setdefault('sn', 'Jones'), 'Smith')
+    self.assertEqual(attrs.pop('cn', None), None)
+
+  def testSetValues(self):
+    attrs = userdb.LdapRecord({})
+    attrs['mail'] = ['f@x']
+    # set, rather than from LDAP, but lists of one are still taken as
+    # LDAP's way of giving a single value
+    self.assertEqual(attrs['mail'], 'f@x')
+    attrs['cn'] = 'Fred'
+    self.assertEqual(attrs['cn'], 'Fred')
+
+  def testUserDB(self):
+    config = utils.Config(userdb.UserDB.config_parms)
+    users = userdb.UserDB(config)
+    users.mapping = {'GoogleUsername': "mail[:mail.find('@')]"}
+    users._AddUsers([('CN=Fred,o=example',
+                      {'mail': ['fred@example.com'], 'cn': ['Fred'],
+                       'objectClass': ['top', 'person']})])
+    attrs = users.db['cn=fred,o=example']
+    self.assert_(isinstance(attrs, userdb.LdapRecord))
+    self.assertEqual(attrs['GoogleUsername'], 'fred')
+    # nothing's been converted until it's asked for
+    self.assertEqual(dict.__getitem__(attrs, 'cn'), ['Fred'])
+    self.assertEqual(attrs['cn'], 'Fred')
+    self.assertEqual(attrs['objectClass'], ['top', 'person'])
+
+  def testCopies(self):
+    attrs = userdb.LdapRecord({'cn': ['Fred']})
+    # Python doesn't ask the record for these, so they see the lists ...
+    self.assertEqual(dict(attrs), {'cn': ['Fred']})
+    plain = {}
+    plain.update(attrs)
+    self.assertEqual(plain, {'cn': ['Fred']})
+    # ... which is why the copies taken are these
+    self.assertEqual(dict(attrs.iteritems()), {'cn': 'Fred'})
+    self.assertEqual(attrs.copy()['cn'], 'Fred')
+
+  def testDataFile(self):
+    # what's written is what item access gives, never a list of one
+    config = utils.Config(userdb.UserDB.config_parms)
+    users = userdb.UserDB(config)
+    users.mapping = {'GoogleUsername': 'cn'}
+    users._AddUsers([('cn=Fred,o=example', {'cn': ['Fred']})])
+    for fname in ('ldap_record_unittest.csv', 'ldap_record_unittest.xml'):
+      try:
+        users.WriteDataFile(fname)
+        f = open(fname, 'r')
+        text = f.read()
+        f.close()
+        self.failIf(text.find('[') >= 0, text)
+        read = userdb.UserDB(config)
+        read.ReadDataFile(fname)
+        self.assertEqual(read.LookupDN('cn=fred,o=example')['cn'], 'Fred')
+      finally:
+        if os.path.exists(fname):
+          os.remove(fname)
+
+  def testAttrList(self):
+    config = utils.Config(userdb.UserDB.config_parms)
+    users = userdb.UserDB(config)
+    users._AddUsers([('cn=a,o=example', {'cn': ['a'], 'sn': ['A']}),
+                     ('cn=b,o=example', {'cn': ['b'], 'sn': ['B']}),
+                     ('cn=c,o=example', {'sn': ['C'], 'cn': ['c'],
+                                         'mail': ['c@x']})])
+    attrs = users.GetAttributes()
+    attrs.sort()
+    self.assertEqual(attrs, ['cn', 'mail', 'sn'])
+    # once the attributes are dropped, so is what was remembered of them
+    users.RemoveAllAttributes()
+    users._AddUsers([('cn=d,o=example', {'cn': ['d'], 'sn': ['D']})])
+    attrs = users.GetAttributes()
+    attrs.sort()
+    self.assertEqual(attrs, ['cn', 'sn'])
+
+def _SourceConfig():
+  parms = {}
+  parms.update(composite_ctxt.CompositeContext.config_parms)
+  parms.update(userdb.UserDB.config_parms)
+  return utils.Config(parms)
+
+class _StubSource(composite_ctxt.SourceContext):
+
+  """ A source which needs no LDAP server: a search for no attributes
+  finds all of 'everyone', and any other finds 'changed' (or fails, if
+  'changed' is None).  'filters' records the filters searched with.
+  Connecting (e.g. for a clone) always works, and needs no server.
+  """
+
+  def __init__(self, name, changed, everyone=(), deleted=()):
+    config = _SourceConfig()
+    config.SetAttr('timestamp', 'modifyTimestamp')
+    config.SetAttr('ldap_user_filter', '(objectClass=person)')
+    composite_ctxt.SourceContext.__init__(self, config, name)
+    self.changed = changed
+    self.everyone = everyone
+    if deleted is not None:
+      deleted = list(deleted)
+    self.deleted = deleted
+    self.filters = []
+
+  def Search(self, filter_arg=None, sizelimit=0, attrlist=None):
+    self.filters.append(filter_arg)
+    if self.changed is None:
+      return None
+    users = userdb.UserDB(config=self._config)
+    if attrlist == []:
+      for dn in self.everyone:
+        users.db[dn] = {}
+    else:
+      for (dn, username) in self.changed:
+        users.db[dn] = {'GoogleUsername': username}
+    return users
+
+  def Connect(self):
+    self.conn = self
+    return None
+
+  def Disconnect(self):
+    self.conn = None
+
+  def SearchSourceChanges(self, attrlist=None):
+    users = self.Search(attrlist=attrlist)
+    if users is None:
+      return (None, None)
+    return (users, self.deleted)
+
+  def ConcurrentSearch(self, searches):
+    return [getattr(self, method)(**kwargs) for (method, kwargs) in searches]
+
+class CompositeContextUnitTest(unittest.TestCase):
+
+  """ Several LDAP servers as one, with stub sources
+  """
+
+  def _Composite(self, sources, users=None):
+    ctxt = composite_ctxt.CompositeContext(_SourceConfig(), users=users)
+    ctxt.ldap_sources = [{'name': source.name} for source in sources]
+    ctxt.contexts = sources
+    ctxt.conn = sources
+    return ctxt
+
+  def _Existing(self, users):
+    existing = userdb.UserDB(config=_SourceConfig())
+    for (dn, username, source) in users:
+      existing.db[dn] = {'GoogleUsername': username}
+      if source is not None:
+        existing.db[dn]['meta-ldap-source'] = source
+    return existing
+
+  def testSearchConflicts(self):
+    ctxt = self._Composite([
+        _StubSource('a', [('cn=z,o=a', 'jdoe'), ('cn=y,o=a', 'jdoe')]),
+        _StubSource('b', [('cn=x,o=b', 'jdoe'), ('cn=w,o=b', 'wsmith')])])
+    users = ctxt.Search()
+    dns = users.UserDNs()
+    dns.sort()
+    self.assertEqual(dns, ['cn=w,o=b', 'cn=y,o=a'])
+    self.assertEqual(users.LookupDN('cn=w,o=b')['meta-ldap-source'], 'b')
+
+  def testChangesLoseToExisting(self):
+    existing = self._Existing([('cn=y,o=a', 'jdoe', 'a'),
+                               ('cn=v,o=b', 'vdoe', None)])
+    ctxt = self._Composite([
+        _StubSource('a', []),
+        _StubSource('b', [('cn=x,o=b', 'jdoe'), ('cn=u,o=b', 'vdoe')])],
+        existing)
+    (users, deleted) = ctxt.SearchChanges()
+    self.assertEqual(users.UserCount(), 0)
+    self.assertEqual(deleted, [])
+    self.assertEqual(existing.UserCount(), 2)
+
+  def testChangesWinOverExisting(self):
+    existing = self._Existing([('cn=y,o=b', 'jdoe', 'b'),
+                               ('cn=v,o=b', 'vdoe', 'b')])
+    ctxt = self._Composite([
+        _StubSource('a', [('cn=x,o=a', 'jdoe')]),
+        _StubSource('b', [('cn=w,o=b', 'vdoe')])], existing)
+    (users, deleted) = ctxt.SearchChanges()
+    self.assertEqual(users.UserDNs(), ['cn=x,o=a'])
+    # the loser's left for the caller to drop, once the run's good
+    self.assertEqual(existing.UserCount(), 2)
+    self.assertEqual(ctxt.PopSuperseded(), ['cn=y,o=b'])
+    self.assertEqual(ctxt.PopSuperseded(), [])
+
+  def testChangesFreeUsername(self):
+    # the old owner's been deleted, or renamed in the same changes
+    existing = self._Existing([('cn=y,o=a', 'jdoe', 'a'),
+                               ('cn=v,o=a', 'vdoe', 'a')])
+    ctxt = self._Composite([
+        _StubSource('a', [('cn=v,o=a', 'vsmith')], deleted=['cn=y,o=a']),
+        _StubSource('b', [('cn=x,o=b', 'jdoe'), ('cn=w,o=b', 'vdoe')])],
+        existing)
+    (users, deleted) = ctxt.SearchChanges()
+    self.assertEqual(users.UserCount(), 3)
+    self.assertEqual(deleted, ['cn=y,o=a'])
+
+  def testSourceFoundEveryone(self):
+    # e.g. a first run in usn mode: the source's other users are deleted
+    existing = self._Existing([('cn=x,o=a', 'jdoe', 'a'),
+                               ('cn=y,o=a', 'ydoe', 'a'),
+                               ('cn=z,o=b', 'zdoe', 'b'),
+                               ('cn=v,o=a', 'vdoe', None)])
+    ctxt = self._Composite([
+        _StubSource('a', [('cn=x,o=a', 'jdoe')], deleted=None),
+        _StubSource('b', [])], existing)
+    (users, deleted) = ctxt.SearchChanges()
+    self.assertEqual(users.UserDNs(), ['cn=x,o=a'])
+    self.assertEqual(deleted, ['cn=y,o=a'])
+
+  def testSourceFails(self):
+    ctxt = self._Composite([_StubSource('a', [('cn=x,o=a', 'jdoe')]),
+                            _StubSource('b', None)])
+    self.assertEqual(ctxt.SearchChanges(), (None, None))
+    self.assertEqual(ctxt.Search(), None)
+
+  def testSearchExited(self):
+    disabled = _StubSource('a', [('cn=x,o=a', 'jdoe')])
+    disabled.ldap_disabled_filter = '(disabled=1)'
+    other = _StubSource('b', [('cn=w,o=b', 'wsmith')])
+    ctxt = self._Composite([disabled, other])
+    # each source builds its own filter, so those given aren't used
+    self.assertEqual(ctxt.ExitedUsersSearch(['cn'], 'whenChanged',
+                                            '20061201000000', 'ad'),
+                     ('SearchExited', {'attrlist': ['cn']}))
+    users = ctxt.SearchExited(attrlist=['cn'])
+    self.assertEqual(users.UserDNs(), ['cn=x,o=a'])
+    self.assertEqual(users.LookupDN('cn=x,o=a')['meta-ldap-source'], 'a')
+    self.assertEqual(disabled.filters, ['(disabled=1)'])
+    self.assertEqual(other.filters, [])
+    disabled.changed = None
+    self.assertEqual(ctxt.SearchExited(), None)
+
+  def testNoExitedSearch(self):
+    ctxt = self._Composite([_StubSource('a', []), _StubSource('b', [])])
+    ctxt.ldap_disabled_filter = '(disabled=1)'
+    self.assertEqual(ctxt.ExitedUsersSearch(['cn'], 'whenChanged',
+                                            '20061201000000', 'ad'), None)
+
+  def _UpdateUsers(self, sources, existing):
+    existing.MapAttr('GoogleUsername', 'GoogleUsername')
+    ctxt = self._Composite(sources, existing)
+    ctxt.ldap_user_filter = '(objectClass=person)'
+    cmd = commands.Commands(ctxt, existing, None, _SourceConfig())
+    cmd.onecmd('updateUsers')
+    return _Meta(existing, 'meta-Google-action')
+
+  def testUpdateUsersSuperseded(self):
+    existing = self._Existing([('cn=y,o=b', 'jdoe', 'b')])
+    actions = self._UpdateUsers([_StubSource('a', [('cn=x,o=a', 'jdoe')]),
+                                 _StubSource('b', [])], existing)
+    self.assertEqual(actions, {'cn=x,o=a': 'added'})
+
+  def testUpdateUsersExitsFail(self):
+    # the loser stays until all the searches have succeeded
+    existing = self._Existing([('cn=y,o=b', 'jdoe', 'b')])
+    disabled = _StubSource('b', [])
+    disabled.ldap_disabled_filter = '(disabled=1)'
+    disabled.SearchExited = lambda attrlist: None
+    self._UpdateUsers([_StubSource('a', [('cn=x,o=a', 'jdoe')]), disabled],
+                      existing)
+    self.assertEqual(existing.UserDNs(), ['cn=y,o=b'])
+    self.assert_(last_update_time.WAS_ERRORS)
+
+  def testMakeContexts(self):
+    ctxt = composite_ctxt.CompositeContext(_SourceConfig())
+    ctxt.ldap_user_filter = '(objectClass=person)'
+    ctxt.ldap_sources = [{'name': 'hq', 'ldap_url': 'ldap://hq',
+                          'timestamp': 'whenChanged'},
+                         {'ldap_url': 'ldap://branch',
+                          'ldap_user_filter': '(uid=*)'}]
+    (hq, branch) = ctxt._MakeContexts()
+    self.assertEqual((hq.name, hq.ldap_url, hq.directory_type),
+                     ('hq', 'ldap://hq', 'ad'))
+    self.assertEqual(hq.ldap_user_filter, '(objectClass=person)')
+    self.assertEqual((branch.name, branch.ldap_user_filter),
+                     ('1', '(uid=*)'))
+    self.assertEqual(branch.directory_type, 'openldap')
+
+class SourceStateUnitTest(unittest.TestCase):
+
+  """ SourceContext's own last update time and DNs, in its state file
+  """
+
+  FNAME = 'source_state_unittest.tmp'
+
+  def setUp(self):
+    last_update_time.setFilename(self.FNAME)
+
+  def tearDown(self):
+    for name in [self.FNAME, last_update_time.getStateFilename('.source-a')]:
+      if os.path.exists(name):
+        os.remove(name)
+    last_update_time.setFilename('')
+
+  def _Run(self, source, error=False):
+    last_update_time.beginNewRun()
+    result = composite_ctxt.SourceContext.SearchSourceChanges(source)
+    if error:
+      last_update_time.reportError()
+    last_update_time.updateIfNoErrors()
+    return result
+
+  def testFirstRun(self):
+    source = _StubSource('a', [('cn=x,o=a', 'jdoe')],
+                         ['cn=x,o=a', 'cn=y,o=a'])
+    (users, deleted) = self._Run(source)
+    self.assertEqual(source.filters[0], '(objectClass=person)')
+    self.assertEqual(users.UserDNs(), ['cn=x,o=a'])
+    self.assertEqual(deleted, [])
+    lines = last_update_time.getState('.source-a').split('\n')
+    self.assertEqual(lines[0], last_update_time.GetBaseline())
+    lines = lines[1:-1]
+    lines.sort()
+    self.assertEqual(lines, ['cn=x,o=a', 'cn=y,o=a'])
+
+  def testNextRun(self):
+    last_update_time.setPendingState('.source-a',
+                                     '20061201000000\ncn=x,o=a\ncn=y,o=a\n')
+    last_update_time.updateIfNoErrors()
+    source = _StubSource('a', [], ['cn=x,o=a'])
+    (users, deleted) = self._Run(source)
+    self.assertEqual(source.filters[0],
+        '(&(objectClass=person)(modifyTimestamp>=20061201000000Z))')
+    self.assertEqual(deleted, ['cn=y,o=a'])
+
+  def testBadRun(self):
+    self._Run(_StubSource('a', [], ['cn=x,o=a']), error=True)
+    self.assertEqual(last_update_time.getState('.source-a'), None)
+
+  def _Disabled(self):
+    source = _StubSource('a', [('cn=x,o=a', 'jdoe')])
+    source.ldap_disabled_filter = '(disabled=1)'
+    return source
+
+  def testExitedFirstRun(self):
+    source = self._Disabled()
+    self.assertEqual(source.SearchExited().UserDNs(), ['cn=x,o=a'])
+    self.assertEqual(source.filters, ['(disabled=1)'])
+
+  def testExitedNextRun(self):
+    last_update_time.beginNewRun()
+    last_update_time.setPendingState('.source-a', '20061201000000\n')
+    last_update_time.updateIfNoErrors()
+    source = self._Disabled()
+    source.SearchExited()
+    self.assertEqual(source.filters,
+                     ['(&(disabled=1)(modifyTimestamp>=20061201000000Z))'])
+
+  def testExitedTracking(self):
+    # a source tracking its changes has no time of its own
+    last_update_time.beginNewRun()
+    last_update_time.updateIfNoErrors()
+    source = self._Disabled()
+    source.ldap_sync_mode = 'usn'
+    source.SearchExited()
+    self.assertEqual(source.filters,
+                     ['(&(disabled=1)(modifyTimestamp>=%sZ))' %
+                      last_update_time.GetBaseline()])
+
+  def testNoDisabledFilter(self):
+    source = _StubSource('a', [('cn=x,o=a', 'jdoe')])
+    self.assertEqual(source.SearchExited().UserCount(), 0)
+    self.assertEqual(source.filters, [])
+
+
+class _FakeClock(object):
+
+  """ Stands in for the time module: sleep() just moves the clock on,
+  and 'sleeps' records how long each was for
+  """
+
+  def __init__(self):
+    self.now = 1000.0
+    self.sleeps = []
+
+  def time(self):
+    return self.now
+
+  def sleep(self, seconds):
+    self.sleeps.append(seconds)
+    self.now += seconds
+
+class _CountingAPI(object):
+
+  """ Stands in for a provisioning API object, counting its calls
+  """
+
+  endpoint = 'https://example.com'
+
+  def __init__(self):
+    self.calls = 0
+
+  def LockAccount(self, username):
+    self.calls += 1
+
+class RateLimiterUnitTest(unittest.TestCase):
+
+  """ rate_limiter's token buckets, timed by a stand-in clock
+  """
+
+  def setUp(self):
+    self.clock = _FakeClock()
+    rate_limiter.time = self.clock
+
+  def tearDown(self):
+    rate_limiter.time = time
+
+  def testBurst(self):
+    bucket = rate_limiter.TokenBucket(2, 3)
+    self.assertEqual([bucket.Take() for ix in xrange(5)],
+                     [0.0, 0.0, 0.0, 0.5, 0.5])
+    self.clock.now += 10
+    # a quiet spell only earns back a burst's worth
+    self.assertEqual([bucket.Take() for ix in xrange(4)],
+                     [0.0, 0.0, 0.0, 0.5])
+
+  def testWaitsReserved(self):
+    bucket = rate_limiter.TokenBucket(4)
+    bucket.Take()
+    # as if two threads took tokens before either had slept: the second
+    # waits its turn after the first
+    self.clock.sleep = lambda seconds: None
+    self.assertEqual(bucket.Take(), 0.25)
+    self.assertEqual(bucket.Take(), 0.5)
+
+  def testLimits(self):
+    limiter = rate_limiter.RateLimiter({'added': 1, 'all': (10, 2)})
+    limiter.Throttle('added')
+    limiter.Throttle('added')
+    limiter.Throttle('exited')
+    self.assertEqual(self.clock.sleeps, [1.0])
+    self.assertEqual(limiter.GetThrottled(), {'added': 1.0})
+    limiter.SetLimits(None)
+    for ix in xrange(10):
+      limiter.Throttle('added')
+    self.assertEqual(len(self.clock.sleeps), 1)
+
+  def testBadLimit(self):
+    limiter = rate_limiter.RateLimiter()
+    self.assertRaises(ValueError, limiter.SetLimits, {'added': 0})
+    self.assertRaises(ValueError, limiter.SetLimits, {'all': (-1, 5)})
+
+  def testThrottledAPI(self):
+    limiter = rate_limiter.RateLimiter({'exited': 2})
+    raw = _CountingAPI()
+    api = rate_limiter.ThrottledAPI(raw, limiter)
+    api.LockAccount('tuser1')
+    api.LockAccount('tuser2')
+    self.assertEqual(raw.calls, 2)
+    self.assertEqual(limiter.GetThrottled(), {'exited': 0.5})
+    self.assertEqual(api.endpoint, 'https://example.com')
+
+class ConcurrencyLimiterUnitTest(unittest.TestCase):
+
+  """ adaptive_concurrency.ConcurrencyLimiter's limit, as calls go well
+  or badly
+  """
+
+  def testIncrease(self):
+    limiter = adaptive_concurrency.ConcurrencyLimiter(2, 1, 10)
+    for ix in xrange(5):
+      limiter.Record(0.1, operation='LockAccount')
+    self.assertEqual(limiter.GetLimit(), 3)
+    for ix in xrange(100):
+      limiter.Record(0.1, operation='LockAccount')
+    self.assertEqual(limiter.GetLimit(), 10)
+
+  def testOverload(self):
+    limiter = adaptive_concurrency.ConcurrencyLimiter(10, 2, 10)
+    # a burst of errors only cuts the limit once per round
+    for ix in xrange(10):
+      limiter.Record(0.1, True, 'LockAccount')
+    self.assertEqual(limiter.GetLimit(), 7)
+    for ix in xrange(100):
+      limiter.Record(0.1, True, 'LockAccount')
+    self.assertEqual(limiter.GetLimit(), 2)
+
+  def testSlowdown(self):
+    limiter = adaptive_concurrency.ConcurrencyLimiter(10, 1, 10)
+    for ix in xrange(10):
+      limiter.Record(0.1, operation='LockAccount')
+    for ix in xrange(10):
+      limiter.Record(1.0, operation='LockAccount')
+    self.assert_(limiter.GetLimit() < 10)
+
+  def testMixedOperations(self):
+    limiter = adaptive_concurrency.ConcurrencyLimiter(5, 1, 10)
+    for ix in xrange(50):
+      limiter.Record(0.1, operation='LockAccount')
+      limiter.Record(2.0, operation='CreateAccountWithEmail')
+    self.assertEqual(limiter.GetLimit(), 10)
+
+  def testMeasuredAPI(self):
+    class API(object):
+      def LockAccount(self, username):
+        raise provisioning_errs.ProvisioningApiError('503', 'unavailable')
+    limiter = adaptive_concurrency.ConcurrencyLimiter(10, 1, 10)
+    api = adaptive_concurrency.MeasuredAPI(API(), limiter)
+    for ix in xrange(10):
+      self.assertRaises(provisioning_errs.ProvisioningApiError,
+                        api.LockAccount, 'tuser')
+    self.assertEqual(limiter.GetLimit(), 7)
+
+
+class ThreadStatsUnitTest(unittest.TestCase):
+
+  """ ThreadStats, as the Gworker threads use it
+  """
+
+  THREADS = 10
+  INCREMENTS = 10000
+
+  def testConcurrentIncrements(self):
+    stats = sync_google.ThreadStats()
+    def Worker():
+      for unused_ix in xrange(self.INCREMENTS):
+        stats.IncrementStat('adds', 1)
+    threads = [threading.Thread(target=Worker)
+               for unused_ix in xrange(self.THREADS)]
+    start = time.time()
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    elapsed = time.time() - start
+    total = self.THREADS * self.INCREMENTS
+    self.assertEqual(stats.GetStats()['adds'], total)
+    logging.info('ThreadStats: %.2f usec per increment with %d threads' %
+                 (elapsed * 1e6 / total, self.THREADS))
+    # a wait of any length on each increment would take minutes
+    self.assert_(elapsed < 10)
+
+  def testNeverNegative(self):
+    stats = sync_google.ThreadStats()
+    stats.IncrementStat('exits', 2)
+    stats.IncrementStat('exits', -5)
+    stats.IncrementStat('bogus', 1)
+    result = stats.GetStats()
+    self.assertEqual(result['exits'], 0)
+    self.assert_('bogus' not in result)
+
+class _StandInAPI(object):
+
+  """ Stands in for the provisioning API module: every call waits, as if
+  on the endpoint, until 'target' calls are in flight at once (or a
+  second has passed), and 'peak' records the most calls in flight.
+  """
+
+  target = 0
+  in_flight = 0
+  peak = 0
+  lock = threading.Condition()
+
+  @classmethod
+  def Reset(cls, target):
+    (cls.target, cls.in_flight, cls.peak) = (target, 0, 0)
+
+  class API(object):
+    def __init__(self, admin, password, domain):
+      pass
+
+    def LockAccount(self, username):
+      cls = _StandInAPI
+      cls.lock.acquire()
+      try:
+        cls.in_flight += 1
+        cls.peak = max(cls.peak, cls.in_flight)
+        cls.lock.notifyAll()
+        deadline = time.time() + 1.0
+        while cls.peak < cls.target and time.time() < deadline:
+          cls.lock.wait(deadline - time.time())
+        cls.in_flight -= 1
+      finally:
+        cls.lock.release()
+
+class SyncGoogleThroughputUnitTest(unittest.TestCase):
+
+  """ How many calls SyncGoogle keeps in flight, against an endpoint
+  which is slow but never overloaded
+  """
+
+  USERS = 100
+
+  def _Exit(self, threads):
+    """ Exit USERS users with 'threads' threads
+    Returns:
+      the most calls in flight at once
+    """
+    parms = {}
+    parms.update(sync_google.SyncGoogle.config_parms)
+    parms.update(userdb.UserDB.config_parms)
+    config = utils.Config(parms)
+    users = userdb.UserDB(config)
+    users.SetTimestamp('modifyTimestamp')
+    for ix in xrange(self.USERS):
+      users.db['cn=tuser%d,o=example' % ix] = {
+          'GoogleUsername': 'tuser%d' % ix,
+          'modifyTimestamp': '20070101000000Z',
+          'meta-Google-action': 'exited'}
+    google = sync_google.SyncGoogle(users, config, api=_StandInAPI)
+    (google.admin, google.password, google.domain) = ('a', 'p', 'example')
+    google.max_threads = google.min_threads = threads
+    _StandInAPI.Reset(threads)
+    try:
+      stats = google.DoAction('exited')
+    finally:
+      google.StopWorkers()
+    self.assertEqual(stats['exits'], self.USERS)
+    self.assertEqual(stats['authentications'], 1)
+    return _StandInAPI.peak
+
+  def testManyInFlight(self):
+    self.assertEqual(self._Exit(10), 10)
+    self.assertEqual(self._Exit(50), 50)
+
+
+def _SyncGoogleFor(api, count, action='exited'):
+  """ A SyncGoogle using the stand-in API module 'api', and a UserDB of
+  'count' users marked with 'action'
+  """
+  parms = {}
+  parms.update(sync_google.SyncGoogle.config_parms)
+  parms.update(userdb.UserDB.config_parms)
+  config = utils.Config(parms)
+  users = userdb.UserDB(config)
+  for ix in xrange(count):
+    users.db['cn=tuser%d,o=example' % ix] = {
+        'GoogleUsername': 'tuser%d' % ix, 'GoogleFirstName': 'Test',
+        'GoogleLastName': 'User%d' % ix, 'GooglePassword': 'secret',
+        'meta-Google-action': action}
+  google = sync_google.SyncGoogle(users, config, api=api)
+  (google.admin, google.password, google.domain) = ('a', 'p', 'example')
+  # as a run of the tool does, so there's a time for meta-last-updated
+  last_update_time.beginNewRun()
+  return google
+
+def _Meta(users, attr):
+  """ The value of an attribute for each user in a UserDB, by DN
+  """
+  result = {}
+  for dn in users.UserDNs():
+    result[dn] = users.LookupDN(dn).get(attr)
+  return result
+
+def _Handled(users, attr):
+  """ The DNs of the users in a UserDB whose results have been handled,
+  i.e. who have a meta-last-updated, and the value each has for 'attr'
+  """
+  result = {}
+  for (dn, updated) in _Meta(users, 'meta-last-updated').iteritems():
+    if updated == last_update_time.GetBaseline():
+      result[dn] = users.LookupDN(dn).get(attr)
+  return result
+
+class _FlakyAPI(object):
+
+  """ Stands in for the provisioning API module, failing as told to:
+  the first 'auth_failures' authentications, the first 'overloads'
+  calls (with a 503), any call on a user in 'fatal' (by killing the
+  thread), and any call but a create on a user in 'missing' (as if the
+  account weren't there).  'calls' records every call.
+  """
+
+  auth_failures = 0
+  overloads = 0
+  fatal = ()
+  missing = ()
+  calls = []
+  lock = threading.Lock()
+
+  @classmethod
+  def Reset(cls, auth_failures=0, overloads=0, fatal=(), missing=()):
+    (cls.auth_failures, cls.overloads, cls.fatal) = (auth_failures,
+                                                     overloads, fatal)
+    cls.missing = missing
+    cls.calls = []
+
+  class API(object):
+    def __init__(self, admin, password, domain):
+      if _FlakyAPI.auth_failures:
+        _FlakyAPI.auth_failures -= 1
+        raise provisioning_errs.AuthenticationError('BadAuthentication', '')
+
+    def _Call(self, name, *args):
+      _FlakyAPI.lock.acquire()
+      try:
+        _FlakyAPI.calls.append((name,) + args)
+        overloaded = _FlakyAPI.overloads > 0
+        if overloaded:
+          _FlakyAPI.overloads -= 1
+      finally:
+        _FlakyAPI.lock.release()
+      if args and args[0] in _FlakyAPI.fatal:
+        raise SystemExit()
+      if overloaded:
+        raise provisioning_errs.ProvisioningApiError('503', 'unavailable')
+      if (name != 'CreateAccountWithEmail' and args and
+          args[0] in _FlakyAPI.missing):
+        raise provisioning_errs.ProvisioningApiError('EntityDoesNotExist',
+                                                     'Object does not exist')
+
+    def LockAccount(self, username):
+      self._Call('LockAccount', username)
+
+    def UnlockAccount(self, username):
+      self._Call('UnlockAccount', username)
+
+    def CreateAccountWithEmail(self, first, last, password, username,
+                               **moreargs):
+      self._Call('CreateAccountWithEmail', username)
+
+    def RenameAccount(self, old_username, new_username):
+      self._Call('RenameAccount', old_username, new_username)
+
+    def UpdateAccount(self, username, fields):
+      self._Call('UpdateAccount', username)
+
+class WorkerPoolUnitTest(unittest.TestCase):
+
+  """ SyncGoogle's pool of worker threads, and its retries
+  """
+
+  def setUp(self):
+    self._delay = sync_google.RETRY_BASE_DELAY
+    sync_google.RETRY_BASE_DELAY = 0.01
+
+  def tearDown(self):
+    sync_google.RETRY_BASE_DELAY = self._delay
+    _FlakyAPI.Reset()
+
+  def testRetryAfterFailedStart(self):
+    _FlakyAPI.Reset(auth_failures=1)
+    google = _SyncGoogleFor(_FlakyAPI, 5)
+    try:
+      self.assertEqual(google.DoAction('exited')['exits'], 0)
+    finally:
+      google.StopWorkers()
+    self.assertEqual(_Meta(google._users, 'meta-Google-action').values(),
+                     ['exited'] * 5)
+    _FlakyAPI.Reset(overloads=2)
+    try:
+      stats = google.DoAction('exited')
+    finally:
+      google.StopWorkers()
+    self.assertEqual(stats['exits'], 5)
+    self.assertEqual(len(_FlakyAPI.calls), 7)
+    self.assertEqual(_Handled(google._users, 'meta-Google-action').values(),
+                     ['previously-exited'] * 5)
+
+  def testWorkerDies(self):
+    _FlakyAPI.Reset(fatal=('tuser3',))
+    google = _SyncGoogleFor(_FlakyAPI, 5)
+    google.max_threads = google.min_threads = 1
+    try:
+      stats = google.DoAction('exited')
+    finally:
+      google.StopWorkers()
+    self.assert_(stats['exits'] < 5)
+    # the users finished before the worker died have their results; the
+    # rest keep their action
+    actions = _Meta(google._users, 'meta-Google-action')
+    handled = _Handled(google._users, 'meta-Google-action')
+    self.assertEqual(handled.values(),
+                     ['previously-exited'] * stats['exits'])
+    self.assertEqual(actions['cn=tuser3,o=example'], 'exited')
+
+  def testWorkersKept(self):
+    google = _SyncGoogleFor(_FlakyAPI, 5)
+    google.max_threads = google.min_threads = 2
+    try:
+      stats = google.DoAction('exited')
+      self.assertEqual(stats['authentications'], 1)
+      workers = list(google._gworkers)
+      self.assertEqual(len(workers), 2)
+      for attrs in google._users.db.itervalues():
+        attrs['meta-Google-action'] = 'updated'
+      stats = google.DoAction('updated')
+      # the second action is done by the same threads, with no new logins
+      self.assertEqual(google._gworkers, workers)
+      self.assertEqual(stats['authentications'], 0)
+      self.assertEqual(stats['updates'], 5)
+    finally:
+      google.StopWorkers()
+    self.assertEqual(_Handled(google._users, 'meta-Google-action').values(),
+                     [None] * 5)
+    for pushed in _Meta(google._users, 'meta-Google-pushed').values():
+      self.assert_(pushed)
+    for gworker in workers:
+      self.failIf(gworker.isAlive())
+    self.assertEqual((google._gworkers, google.queue_google), ([], None))
+
+  def testStopWorkersFinishesQueue(self):
+    google = _SyncGoogleFor(_FlakyAPI, 5)
+    google.max_threads = google.min_threads = 3
+    try:
+      google.DoAction('exited')
+    finally:
+      google.StopWorkers()
+    # every worker had a None of its own, so none was left waiting
+    names = [thread.getName() for thread in threading.enumerate()]
+    self.assertEqual([name for name in names
+                      if name.startswith('gworker-')], [])
+    self.assertEqual(len(_FlakyAPI.calls), 5)
+    self.assertEqual(len(_Handled(google._users, 'meta-Google-action')), 5)
+
+  def testRetriesUsedUp(self):
+    _FlakyAPI.Reset(overloads=10)
+    google = _SyncGoogleFor(_FlakyAPI, 1)
+    google.google_max_retries = 2
+    attrs = google._users.db['cn=tuser0,o=example']
+    attrs['meta-last-updated'] = '20070101000000'
+    try:
+      stats = google.DoAction('exited')
+    finally:
+      google.StopWorkers()
+    self.assertEqual(len(_FlakyAPI.calls), 3)
+    # only the last failure is counted; the retried ones aren't
+    self.assertEqual((stats['exits'], stats['exit_fails']), (0, 1))
+    # and the failure reached the UserDB: the user keeps its action, for
+    # the next run, and isn't counted as up to date
+    self.assertEqual(attrs['meta-Google-action'], 'exited')
+    self.assertEqual(attrs['meta-last-updated'], None)
+
+  def testRetrySucceeds(self):
+    _FlakyAPI.Reset(overloads=2)
+    google = _SyncGoogleFor(_FlakyAPI, 1)
+    try:
+      stats = google.DoAction('exited')
+    finally:
+      google.StopWorkers()
+    self.assertEqual((stats['exits'], stats['exit_fails']), (1, 0))
+    self.assertEqual(_Handled(google._users, 'meta-Google-action'),
+                     {'cn=tuser0,o=example': 'previously-exited'})
+
+  def testRetryScheduler(self):
+    queue = Queue.Queue()
+    retries = sync_google.RetryScheduler(queue)
+    retries.start()
+    try:
+      retries.Schedule('late', 0.2)
+      retries.Schedule('early', 0.05)
+      retries.Schedule('dropped', 60)
+      self.assertEqual(queue.get(timeout=5), 'early')
+      self.assertEqual(queue.get(timeout=5), 'late')
+    finally:
+      retries.Stop()
+    self.failIf(retries.isAlive())
+    self.assert_(queue.empty())
+
+
+class PreflightUnitTest(unittest.TestCase):
+
+  """ The pre-flight check for adds, of accounts already in Google
+  """
+
+  def tearDown(self):
+    _FlakyAPI.Reset()
+
+  def _Add(self, preflight, missing=()):
+    """ Add tuser0, which this tool has had in Google before, and tuser1,
+    which it hasn't
+    Returns:
+      the stats; the UserDB is left in self.users
+    """
+    google = _SyncGoogleFor(_FlakyAPI, 2, action='added')
+    self.users = google._users
+    google.preflight_accounts = preflight
+    google._users.db['cn=tuser0,o=example']['meta-Google-old-username'] = (
+        'TUser0')
+    self.assertEqual(google._FindExistingAccounts(), set(['tuser0']))
+    _FlakyAPI.Reset(missing=missing)
+    try:
+      return google.DoAction('added')
+    finally:
+      google.StopWorkers()
+
+  def _Calls(self, username):
+    return [call[0] for call in _FlakyAPI.calls if call[1] == username]
+
+  def _AssertAdded(self):
+    """ Check that both users' results reached the UserDB as adds
+    """
+    self.assertEqual(_Handled(self.users, 'meta-Google-action'),
+                     {'cn=tuser0,o=example': None,
+                      'cn=tuser1,o=example': None})
+    self.assertEqual(_Meta(self.users, 'meta-Google-old-username'),
+                     {'cn=tuser0,o=example': 'tuser0',
+                      'cn=tuser1,o=example': 'tuser1'})
+    for pushed in _Meta(self.users, 'meta-Google-pushed').values():
+      self.assert_(pushed)
+
+  def testExisting(self):
+    stats = self._Add(True)
+    self.assertEqual((stats['adds'], stats['add_fails']), (2, 0))
+    self.assertEqual(self._Calls('tuser0'), ['UnlockAccount', 'UpdateAccount'])
+    self.assertEqual(self._Calls('tuser1'), ['CreateAccountWithEmail'])
+    self._AssertAdded()
+
+  def testStalePushed(self):
+    # tuser0's digests match its attributes, but the account was found
+    # already there, so what it holds isn't known: everything is sent
+    google = _SyncGoogleFor(_FlakyAPI, 1, action='added')
+    google.preflight_accounts = True
+    attrs = google._users.db['cn=tuser0,o=example']
+    attrs['meta-Google-old-username'] = 'tuser0'
+    attrs['meta-Google-pushed'] = updated_user_google_action.Pushed(
+        updated_user_google_action.AccountFields(attrs))
+    _FlakyAPI.Reset()
+    try:
+      google.DoAction('added')
+    finally:
+      google.StopWorkers()
+    self.assertEqual(self._Calls('tuser0'), ['UnlockAccount', 'UpdateAccount'])
+
+  def testWrongGuess(self):
+    stats = self._Add(True, missing=('tuser0',))
+    self.assertEqual((stats['adds'], stats['add_fails']), (2, 0))
+    self.assertEqual(self._Calls('tuser0'),
+                     ['UnlockAccount', 'CreateAccountWithEmail'])
+    self._AssertAdded()
+
+  def testOff(self):
+    stats = self._Add(False)
+    self.assertEqual(stats['adds'], 2)
+    self.assertEqual(self._Calls('tuser0'), ['CreateAccountWithEmail'])
+    self._AssertAdded()
+
+
+class _RecordingAPI(object):
+  def __init__(self):
+    self.updates = []
+
+  def UpdateAccount(self, username, fields):
+    self.updates.append(fields)
+
+class ChainsUnitTest(unittest.TestCase):
+
+  """ The order of the actions on users sharing a Google username
+  """
+
+  def _SyncGoogle(self, users):
+    google = _SyncGoogleFor(_FlakyAPI, 0)
+    for (dn, action, username, old_username) in users:
+      google._users.db[dn] = {
+          'GoogleUsername': username, 'GoogleFirstName': 'Test',
+          'GoogleLastName': 'User', 'GooglePassword': 'secret',
+          'meta-Google-action': action}
+      if old_username:
+        google._users.db[dn]['meta-Google-old-username'] = old_username
+    return google
+
+  def tearDown(self):
+    _FlakyAPI.Reset()
+
+  def testRenameBeforeAdd(self):
+    google = self._SyncGoogle([('cn=a', 'renamed', 'y', 'x'),
+                               ('cn=b', 'added', 'x', None)])
+    self.assertEqual(google._Chains(['added', 'renamed']),
+                     [[('renamed', 'cn=a'), ('added', 'cn=b')]])
+    _FlakyAPI.Reset()
+    try:
+      google.DoActions(['added', 'renamed'])
+    finally:
+      google.StopWorkers()
+    self.assertEqual(_FlakyAPI.calls[0], ('RenameAccount', 'x', 'y'))
+    self.assertEqual(_FlakyAPI.calls[1], ('CreateAccountWithEmail', 'x'))
+
+  def testRenamesInTurn(self):
+    google = self._SyncGoogle([('cn=a', 'renamed', 'y', 'x'),
+                               ('cn=c', 'renamed', 'z', 'y'),
+                               ('cn=b', 'updated', 'x', None)])
+    self.assertEqual(google._Chains(['updated', 'renamed']),
+                     [[('renamed', 'cn=c'), ('renamed', 'cn=a'),
+                       ('updated', 'cn=b')]])
+
+  def testSwap(self):
+    google = self._SyncGoogle([('cn=a', 'renamed', 'y', 'x'),
+                               ('cn=b', 'renamed', 'x', 'y')])
+    self.assertEqual(google._Chains(['renamed']),
+                     [[('renamed', 'cn=a'), ('renamed', 'cn=b')]])
+
+  def testCaseOnlyRename(self):
+    google = self._SyncGoogle([('cn=a', 'renamed', 'X', 'x'),
+                               ('cn=b', 'exited', 'z', None)])
+    chains = google._Chains(['exited', 'renamed'])
+    chains.sort()
+    self.assertEqual(chains, [[('exited', 'cn=b')], [('renamed', 'cn=a')]])
+
+
+class ShadowStateUnitTest(unittest.TestCase):
+
+  """ updated_user_google_action.Update, and the meta-Google-pushed
+  digests it keeps
+  """
+
+  def testOnlyChangedFields(self):
+    api = _RecordingAPI()
+    attrs = {'GoogleUsername': 'tuser', 'GoogleFirstName': 'Test',
+             'GoogleLastName': 'User', 'GooglePassword': 'secret'}
+    pushed = updated_user_google_action.Update(api, attrs)
+    self.assertEqual(len(api.updates), 1)
+    self.assertEqual(pushed.find('secret'), -1)
+
+    # nothing changed: no call at all
+    attrs['meta-Google-pushed'] = pushed
+    self.assertEqual(updated_user_google_action.Update(api, attrs), pushed)
+    self.assertEqual(len(api.updates), 1)
+
+    attrs['GooglePassword'] = 'newsecret'
+    updated_user_google_action.Update(api, attrs)
+    self.assertEqual(api.updates[-1], {'password': 'newsecret'})
+
+  def testForced(self):
+    api = _RecordingAPI()
+    attrs = {'GoogleUsername': 'tuser', 'GoogleFirstName': 'Test',
+             'GoogleLastName': 'User', 'GooglePassword': 'secret'}
+    attrs['meta-Google-pushed'] = updated_user_google_action.Pushed(
+        updated_user_google_action.AccountFields(attrs))
+    updated_user_google_action.Update(api, attrs, force=True)
+    self.assertEqual(api.updates, [{'firstName': 'Test', 'lastName': 'User',
+                                    'password': 'secret'}])
+
+
+class _SnapshotAPI(object):
+  def RetrieveAccount(self, username):
+    if username.endswith('7'):
+      raise provisioning_errs.ProvisioningApiError('Object does not exist')
+    return {'userName': username}
+
+class AccountSnapshotUnitTest(unittest.TestCase):
+
+  """ account_snapshot.Fetch, as the reconcileUsers command uses it
+  """
+
+  def testFetch(self):
+    usernames = ['tuser%d' % ix for ix in xrange(100)] + ['TUSER1']
+    snapshot = account_snapshot.Fetch([_SnapshotAPI() for ix in xrange(5)],
+                                      usernames)
+    self.assertEqual(snapshot.GetCounts(), (90, 10, 0))
+    self.assertEqual(snapshot.Get('TUser1'), {'userName': 'tuser1'})
+    self.assert_(snapshot.Knows('tuser7'))
+    self.assertEqual(snapshot.Get('tuser7'), None)
+    self.assert_(not snapshot.Knows('tuser100'))
+
+
+class _AccountsAPI(object):
+
+  """ Stands in for the provisioning API module, with the accounts in
+  'accounts', by username
+  """
+
+  accounts = {}
+
+  class API(object):
+    def __init__(self, admin, password, domain):
+      pass
+
+    def RetrieveAccount(self, username):
+      if username not in _AccountsAPI.accounts:
+        raise provisioning_errs.ProvisioningApiError('EntityDoesNotExist',
+                                                     'Object does not exist')
+      return _AccountsAPI.accounts[username]
+
+def _Account(username, last_name):
+  """ What RetrieveAccount returns for a user set up by ReconcileUnitTest
+  """
+  return {'userName': username, 'firstName': 'Test', 'lastName': last_name,
+          'quota': '2048'}
+
+class ReconcileUnitTest(unittest.TestCase):
+
+  """ The reconcileUsers command, and _ReconcileUser's answer for each
+  user with nothing pending, given what's in the snapshot
+  """
+
+  def setUp(self):
+    parms = {}
+    parms.update(sync_google.SyncGoogle.config_parms)
+    parms.update(userdb.UserDB.config_parms)
+    config = utils.Config(parms)
+    self.users = userdb.UserDB(config)
+    # 'renamed' was renamed in LDAP, and Google still has the old name
+    for (dn, username, old_username) in (
+        ('cn=missing,o=example', 'missing', None),
+        ('cn=renamed,o=example', 'renamed', 'renamed-old'),
+        ('cn=differs,o=example', 'differs', None),
+        ('cn=same,o=example', 'same', None)):
+      attrs = {'GoogleUsername': username, 'GoogleFirstName': 'Test',
+               'GoogleLastName': 'User', 'GooglePassword': 'secret',
+               'GoogleQuota': '2048', 'meta-Google-action': None}
+      if old_username:
+        attrs['meta-Google-old-username'] = old_username
+      self.users.db[dn] = attrs
+    self.google = sync_google.SyncGoogle(self.users, config,
+                                         api=_AccountsAPI)
+    (self.google.admin, self.google.password, self.google.domain) = (
+        'a', 'p', 'example')
+    self.cmd = commands.Commands(None, self.users, self.google, config)
+    _AccountsAPI.accounts = {'renamed-old': _Account('renamed-old', 'User'),
+                             'differs': _Account('differs', 'Changed'),
+                             'same': _Account('same', 'User')}
+
+  def tearDown(self):
+    self.google.StopWorkers()
+    _AccountsAPI.accounts = {}
+
+  def _Snapshot(self, unknown=()):
+    """ An AccountSnapshot of _AccountsAPI.accounts, without asking
+    Google; the usernames in 'unknown' couldn't be fetched
+    """
+    snapshot = account_snapshot.AccountSnapshot()
+    for username in ('missing', 'renamed', 'renamed-old', 'differs', 'same'):
+      if username in unknown:
+        snapshot.PutUnknown(username)
+      else:
+        snapshot.Put(username, _AccountsAPI.accounts.get(username))
+    return snapshot
+
+  def testMissing(self):
+    self.assertEqual(self.cmd._ReconcileUser('cn=missing,o=example',
+                                             self._Snapshot()), 'added')
+
+  def testRenamed(self):
+    self.assertEqual(self.cmd._ReconcileUser('cn=renamed,o=example',
+                                             self._Snapshot()), 'renamed')
+
+  def testDiffers(self):
+    self.assertEqual(self.cmd._ReconcileUser('cn=differs,o=example',
+                                             self._Snapshot()), 'updated')
+
+  def testSame(self):
+    self.assertEqual(self.cmd._ReconcileUser('cn=same,o=example',
+                                             self._Snapshot()), None)
+
+  def testUnknown(self):
+    # couldn't be fetched: each keeps what it had, pending or not
+    snapshot = self._Snapshot(unknown=('missing', 'renamed-old'))
+    self.assertEqual(self.cmd._ReconcileUser('cn=missing,o=example',
+                                             snapshot), None)
+    self.assertEqual(self.cmd._ReconcileUser('cn=renamed,o=example',
+                                             snapshot), None)
+    self.users.db['cn=missing,o=example']['meta-Google-action'] = 'exited'
+    self.assertEqual(self.cmd._ReconcileUser('cn=missing,o=example',
+                                             snapshot), 'exited')
+
+  def testReconcileUsers(self):
+    self.cmd.onecmd('reconcileUsers -f')
+    self.assertEqual(_Meta(self.users, 'meta-Google-action'),
+                     {'cn=missing,o=example': 'added',
+                      'cn=renamed,o=example': 'renamed',
+                      'cn=differs,o=example': 'updated',
+                      'cn=same,o=example': None})
+
+
+class _AuthAPI(object):
+
+  """ Stands in for the provisioning API module, counting the
+  authentications.  If 'nested' is set, each API object has a dictionary
+  too.
+  """
+
+  authentications = 0
+  nested = False
+
+  class API(object):
+    def __init__(self, admin, password, domain):
+      _AuthAPI.authentications += 1
+      self.admin = admin
+      self.password = password
+      self.domain = domain
+      self.token = 'token%d' % _AuthAPI.authentications
+      if _AuthAPI.nested:
+        self.headers = {'Authorization': self.token}
+
+class _KeepAliveServer(SocketServer.ThreadingMixIn,
+                       BaseHTTPServer.HTTPServer):
+
+  """ A local HTTP/1.1 server, which counts the requests to each path.
+  /close answers and then closes the connection; /drop closes it
+  without answering.
+  """
+
+  daemon_threads = True
+
+  class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+      pass
+
+    def do_GET(self):
+      self.server.Count(self.path)
+      if self.path == '/drop':
+        self.close_connection = 1
+        return
+      self.send_response(200)
+      self.send_header('Content-Length', '2')
+      self.end_headers()
+      self.wfile.write('ok')
+      if self.path == '/close':
+        self.close_connection = 1
+
+    def do_POST(self):
+      self.rfile.read(int(self.headers['Content-Length']))
+      self.do_GET()
+
+  def __init__(self):
+    BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), self.Handler)
+    self.counts = {}
+    self._lock = threading.Lock()
+    self._serving = True
+    self.url = 'http://127.0.0.1:%d' % self.server_address[1]
+    thread = threading.Thread(target=self._Serve)
+    thread.setDaemon(True)
+    thread.start()
+
+  def _Serve(self):
+    while self._serving:
+      self.handle_request()
+
+  def Stop(self):
+    self._serving = False
+    # wake it up
+    urllib2.urlopen(self.url + '/stop').read()
+    self.server_close()
+
+  def Count(self, path):
+    self._lock.acquire()
+    try:
+      self.counts[path] = self.counts.get(path, 0) + 1
+    finally:
+      self._lock.release()
+
+class HttpPoolUnitTest(unittest.TestCase):
+
+  """ http_pool: keep-alive connections for a PooledAPI's calls
+  """
+
+  class API(object):
+    def Fetch(self, url, data=None):
+      return urllib2.urlopen(url, data).read()
+
+  def setUp(self):
+    self.server = _KeepAliveServer()
+    self.url = self.server.url
+    self.pool = http_pool.Install(2, 60)
+    self.api = http_pool.PooledAPI(self.API(), self.pool)
+
+  def tearDown(self):
+    self.pool.CloseAll()
+    self.server.Stop()
+
+  def testReuse(self):
+    for ix in xrange(3):
+      self.assertEqual(self.api.Fetch(self.url + '/'), 'ok')
+    stats = self.pool.GetStats()
+    self.assertEqual((stats['handshakes'], stats['reused']), (1, 2))
+
+  def testNotPooled(self):
+    self.assertEqual(self.API().Fetch(self.url + '/'), 'ok')
+    self.assertEqual(self.pool.GetStats()['requests'], 0)
+
+  def testClosedWhileIdle(self):
+    self.assertEqual(self.api.Fetch(self.url + '/close'), 'ok')
+    time.sleep(0.2)
+    self.assertEqual(self.api.Fetch(self.url + '/'), 'ok')
+    stats = self.pool.GetStats()
+    self.assertEqual((stats['handshakes'], stats['reused']), (2, 0))
+
+  def testNoResend(self):
+    self.assertEqual(self.api.Fetch(self.url + '/'), 'ok')
+    self.assertRaises(urllib2.URLError, self.api.Fetch, self.url + '/drop',
+                      'username=tuser')
+    self.assertEqual(self.server.counts['/drop'], 1)
+
+
+class TokenCacheUnitTest(unittest.TestCase):
+
+  """ token_cache: authenticating once for many API objects, and runs
+  """
+
+  FNAME = 'token_cache_unittest.tmp'
+
+  def setUp(self):
+    (_AuthAPI.authentications, _AuthAPI.nested) = (0, False)
+
+  def tearDown(self):
+    if os.path.exists(self.FNAME):
+      os.remove(self.FNAME)
+
+  def testShared(self):
+    cache = token_cache.TokenCache(_AuthAPI)
+    api1 = cache.GetAPI('admin', 'secret', 'example.com')
+    api2 = cache.GetAPI('admin', 'secret', 'example.com')
+    self.assertEqual(_AuthAPI.authentications, 1)
+    self.assert_(api1 is not api2)
+    self.assertEqual((api1.token, api2.token), ('token1', 'token1'))
+    self.assertEqual(api2.password, 'secret')
+    cache.GetAPI('admin', 'other', 'example.com')
+    self.assertEqual(_AuthAPI.authentications, 2)
+    cache.Invalidate()
+    cache.GetAPI('admin', 'other', 'example.com')
+    self.assertEqual(_AuthAPI.authentications, 3)
+
+  def testNested(self):
+    _AuthAPI.nested = True
+    cache = token_cache.TokenCache(_AuthAPI, self.FNAME)
+    api1 = cache.GetAPI('admin', 'secret', 'example.com')
+    api2 = cache.GetAPI('admin', 'secret', 'example.com')
+    self.assertEqual(_AuthAPI.authentications, 1)
+    self.assert_(api1.headers is not api2.headers)
+    self.assert_(not os.path.exists(self.FNAME))
+
+  def testSaved(self):
+    token_cache.TokenCache(_AuthAPI, self.FNAME).GetAPI('admin', 'secret',
+                                                        'example.com')
+    self.assertEqual(os.stat(self.FNAME).st_mode & 0777, 0600)
+    f = open(self.FNAME)
+    saved = f.read()
+    f.close()
+    for line in saved.splitlines()[2:]:
+      self.assert_('secret' not in base64.b64decode(line.split(' ')[2]))
+
+    api = token_cache.TokenCache(_AuthAPI, self.FNAME).GetAPI(
+        'admin', 'secret', 'example.com')
+    self.assertEqual(_AuthAPI.authentications, 1)
+    self.assert_(isinstance(api, _AuthAPI.API))
+    self.assertEqual((api.token, api.password, api.domain),
+                     ('token1', 'secret', 'example.com'))
+    token_cache.TokenCache(_AuthAPI, self.FNAME).GetAPI('admin', 'changed',
+                                                        'example.com')
+    self.assertEqual(_AuthAPI.authentications, 2)
+
+  def testBadFile(self):
+    f = open(self.FNAME, 'w')
+    f.write('garbage')
+    f.close()
+    token_cache.TokenCache(_AuthAPI, self.FNAME).GetAPI('admin', 'secret',
+                                                        'example.com')
+    self.assertEqual(_AuthAPI.authentications, 1)
+
+
+class ProgressLogUnitTest(unittest.TestCase):
+
+  """ progress_log: what a run which died leaves for the next one
+  """
+
+  FNAME = 'progress_log_unittest.log'
+  DATA_FNAME = 'progress_log_unittest.csv'
+  CONFIG_FNAME = 'progress_log_unittest.cfg'
+  KEY = 'users.csv 1190000000.0 100'
+
+  def tearDown(self):
+    progress_log.Clear(self.FNAME)
+    for fname in (self.DATA_FNAME, self.CONFIG_FNAME):
+      if os.path.exists(fname):
+        os.remove(fname)
+    _FlakyAPI.Reset()
+
+  def _WriteLog(self, key):
+    log = progress_log.ProgressLog(self.FNAME, key, 10)
+    log.Record('cn=tuser1,o=example', {'GoogleUsername': 'tuser1',
+                                       'meta-Google-action': None})
+    log.Close()
+
+  def testReplay(self):
+    config = utils.Config(userdb.UserDB.config_parms)
+    users = userdb.UserDB(config)
+    users.db['cn=tuser1,o=example'] = {'GoogleUsername': 'tuser1',
+                                       'sn': 'Old',
+                                       'meta-Google-action': 'updated'}
+    users.db['cn=tuser2,o=example'] = {'GoogleUsername': 'tuser2',
+                                       'meta-Google-action': 'updated'}
+    log = progress_log.ProgressLog(self.FNAME, self.KEY, 10)
+    log.Record('cn=tuser1,o=example',
+               {'GoogleUsername': 'tuser1', 'sn': 'New',
+                'meta-Google-action': None, 'cn': u'T\xfcser 1',
+                'mail': ['tuser1@example.com', 'tu1@example.com']})
+    # added during the run, so not in the user data file:
+    log.Record('cn=tuser3,o=example',
+               userdb.LdapRecord({'GoogleUsername': 'tuser3',
+                                  'sn': ['Three'],
+                                  'meta-Google-action': None}))
+    log.Close()
+    # as if the process died in the middle of a record:
+    f = open(self.FNAME, 'a')
+    f.write('Y249dHVzZXIyLG89ZXhhbXBsZQ== GoogleUsername s dHVz')
+    f.close()
+
+    self.assertEqual(progress_log.Replay(self.FNAME, users, self.KEY), 2)
+    attrs = users.LookupDN('cn=tuser1,o=example')
+    self.assertEqual(attrs['meta-Google-action'], None)
+    self.assertEqual(attrs['sn'], 'New')
+    self.assertEqual(attrs['cn'], u'T\xfcser 1')
+    self.assertEqual(attrs['mail'], ['tuser1@example.com', 'tu1@example.com'])
+    attrs = users.LookupDN('cn=tuser2,o=example')
+    self.assertEqual(attrs['meta-Google-action'], 'updated')
+    attrs = users.LookupDN('cn=tuser3,o=example')
+    self.assertEqual(attrs['sn'], 'Three')
+    self.assertEqual(attrs['meta-Google-action'], None)
+
+  def testReplayMovedUser(self):
+    config = utils.Config(userdb.UserDB.config_parms)
+    users = userdb.UserDB(config)
+    users.primary_key = 'uid'
+    old = {'GoogleUsername': 'tuser1', 'uid': 'tuser1',
+           'meta-Google-action': 'renamed'}
+    users.RestoreUser('cn=tuser1,ou=old,o=example', old)
+    log = progress_log.ProgressLog(self.FNAME, self.KEY, 10)
+    log.Record('cn=tuser1,ou=new,o=example',
+               {'GoogleUsername': 'tuser1', 'uid': 'tuser1',
+                'meta-Google-action': None})
+    log.Close()
+    self.assertEqual(progress_log.Replay(self.FNAME, users, self.KEY), 1)
+    self.assertEqual(users.UserDNs(), ['cn=tuser1,ou=new,o=example'])
+
+  def testText(self):
+    self._WriteLog(self.KEY)
+    f = open(self.FNAME, 'r')
+    lines = f.read().splitlines()
+    f.close()
+    self.assertEqual(len(lines), 2)
+    fields = lines[1].split(' ')
+    self.assertEqual(base64.b64decode(fields[0]), 'cn=tuser1,o=example')
+    self.assertEqual(len(fields), 7)
+    self.assert_('GoogleUsername s %s' % base64.b64encode('tuser1')
+                 in lines[1])
+
+  def testStale(self):
+    config = utils.Config(userdb.UserDB.config_parms)
+    users = userdb.UserDB(config)
+    # left by a run against some other user data file:
+    self._WriteLog('other.csv 1190000000.0 100')
+    self.assertEqual(progress_log.Replay(self.FNAME, users, self.KEY), 0)
+    self.assertEqual(users.UserCount(), 0)
+    self.failIf(os.path.exists(self.FNAME))
+    # or against none:
+    self._WriteLog(self.KEY)
+    self.assertEqual(progress_log.Replay(self.FNAME, users, None), 0)
+    self.failIf(os.path.exists(self.FNAME))
+    # a log is started afresh for another data file, not appended to
+    self._WriteLog('other.csv 1190000000.0 100')
+    log = progress_log.ProgressLog(self.FNAME, self.KEY, 10)
+    log.Close()
+    self.assertEqual(progress_log.Replay(self.FNAME, users, self.KEY), 0)
+    self.failUnless(os.path.exists(self.FNAME))
+
+  def testDataFileKey(self):
+    f = open(self.DATA_FNAME, 'w')
+    f.write('dn\n')
+    f.close()
+    key = progress_log.DataFileKey(self.DATA_FNAME)
+    self.assertEqual(key, progress_log.DataFileKey(self.DATA_FNAME))
+    # once the data file's been rewritten, it has the log's records
+    f = open(self.DATA_FNAME, 'a')
+    f.write('cn=tuser1\n')
+    f.close()
+    self.assertNotEqual(key, progress_log.DataFileKey(self.DATA_FNAME))
+
+  def testResultsLogged(self):
+    google = _SyncGoogleFor(_FlakyAPI, 3)
+    google.progress_log = self.FNAME
+    google.progress_key = self.KEY
+    try:
+      self.assertEqual(google.DoAction('exited')['exits'], 3)
+    finally:
+      google.StopWorkers()
+    # as the next run finds the users, from the data file:
+    users = _SyncGoogleFor(_FlakyAPI, 3)._users
+    self.assertEqual(progress_log.Replay(self.FNAME, users, self.KEY), 3)
+    self.assertEqual(_Handled(users, 'meta-Google-action'),
+                     _Handled(google._users, 'meta-Google-action'))
+    self.assertEqual(_Handled(users, 'meta-Google-action').values(),
+                     ['previously-exited'] * 3)
+
+  def testNoDataFile(self):
+    # with nowhere to replay it onto, or clear it from, nothing's logged
+    google = _SyncGoogleFor(_FlakyAPI, 3)
+    google.progress_log = self.FNAME
+    try:
+      self.assertEqual(google.DoAction('exited')['exits'], 3)
+    finally:
+      google.StopWorkers()
+    self.failIf(os.path.exists(self.FNAME))
+
+  def _SetupMain(self, arg_str):
+    f = open(self.CONFIG_FNAME, 'w')
+    f.write('[%s]\nprogress_log = %r\n' % (utils.CONFIG_SECTION,
+                                            self.FNAME))
+    f.close()
+    (options, args) = sync_ldap.GetParser().parse_args(arg_str.split(' '))
+    return sync_ldap.SetupMain(options, api=_FlakyAPI)
+
+  def testSetupMain(self):
+    config = utils.Config(userdb.UserDB.config_parms)
+    userdb.UserDB(config).WriteDataFile(self.DATA_FNAME)
+    self._WriteLog(progress_log.DataFileKey(self.DATA_FNAME))
+    (config, ctxt, users, google, log_config) = self._SetupMain(
+        '-c %s -f %s' % (self.CONFIG_FNAME, self.DATA_FNAME))
+    self.assertEqual(users.UserDNs(), ['cn=tuser1,o=example'])
+    self.assertEqual(google.progress_key,
+                     progress_log.DataFileKey(self.DATA_FNAME))
+
+  def testSetupMainStale(self):
+    # a log from before the data file was last written isn't replayed
+    self._WriteLog(progress_log.DataFileKey(self.DATA_FNAME))
+    config = utils.Config(userdb.UserDB.config_parms)
+    userdb.UserDB(config).WriteDataFile(self.DATA_FNAME)
+    (config, ctxt, users, google, log_config) = self._SetupMain(
+        '-c %s -f %s' % (self.CONFIG_FNAME, self.DATA_FNAME))
+    self.assertEqual(users.UserCount(), 0)
+    self.failIf(os.path.exists(self.FNAME))
+    # and one's dropped by a run with no data file
+    self._WriteLog(progress_log.DataFileKey(self.DATA_FNAME))
+    (config, ctxt, users, google, log_config) = self._SetupMain(
+        '-c %s' % self.CONFIG_FNAME)
+    self.assertEqual(users.UserCount(), 0)
+    self.assertEqual(google.progress_key, None)
+    self.failIf(os.path.exists(self.FNAME))
+
+
 def _LogObjectValue(message, value):
   pp = pprint.PrettyPrinter()
   logging.debug('%s %s' % (message, pp.pformat(value)))
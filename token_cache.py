@@ -0,0 +1,230 @@
+#!/usr/bin/python2.4
+#
+# Copyright 2006 Google, Inc.
+# All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License")
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+
+""" Authenticates to Google once, and shares the result
+
+class TokenCache: hands out authenticated provisioning API objects
+"""
+
+import base64
+import copy
+import logging
+import os
+import sha
+import threading
+import time
+import types
+
+# how long an authentication token is good for, in seconds.  ClientLogin
+# tokens last 24 hours; a new one is fetched TOKEN_REFRESH seconds before
+# that, so none expires in the middle of a sync.
+TOKEN_LIFETIME = 24 * 60 * 60
+TOKEN_REFRESH = 60 * 60
+
+# the types of attribute an API object can be rebuilt from, each with the
+# letter it's saved under
+_PLAIN_TYPES = {types.StringType: 's', types.UnicodeType: 'u',
+                types.IntType: 'i', types.BooleanType: 'b',
+                types.NoneType: 'n'}
+# saved in place of the password, which is never written
+_PASSWORD = 'p'
+
+
+class TokenCache(object):
+
+  """ Authenticates a provisioning API object once, and hands out new
+  objects holding the same token, so N threads don't cost N round trips
+  to the auth URL.  A new token is fetched before the old one expires,
+  or if the credentials change.
+
+  What's kept is the authenticated object's state: its attributes, if
+  they're all plain strings and numbers, like the token itself.  Each
+  caller gets an object of its own built from them, sharing nothing
+  mutable with the others.  The state can also be saved in a text file,
+  readable only by its owner, so the next run doesn't need to
+  authenticate either; the password is left out, and put back from the
+  credentials the next run is given.  An API object with any other kind
+  of attribute is deep-copied for each caller instead, and not saved.
+  """
+
+  def __init__(self, api_module, token_file=None):
+    """ Constructor
+    Args:
+      api_module: the module (or anything else) with the API class,
+        normally google.appsforyourdomain.provisioning
+      token_file: name of the file to keep the token in between runs, or
+        None not to keep it
+    """
+    self._api_module = api_module
+    self.token_file = token_file
+    self._lock = threading.Lock()
+    self._api = None
+    self._state = None
+    self._key = None
+    self._created = 0
+
+  def GetAPI(self, admin, password, domain, thread_stats=None):
+    """ Get an authenticated API object of its own for the caller
+    Args:
+      admin, password, domain: the credentials
+      thread_stats: a ThreadStats, whose 'authentications' stat is
+        incremented if authentication is needed, or None
+    Returns:
+      a provisioning API object
+    Raises:
+      provisioning_errs.ProvisioningApiError: if authentication fails
+    """
+    key = (admin, password, domain)
+    self._lock.acquire()
+    try:
+      if not self._IsFresh(key):
+        self._Load(key)
+      if not self._IsFresh(key):
+        logging.debug('authenticating %s' % admin)
+        self._api = self._api_module.API(admin, password, domain)
+        self._state = _PlainState(self._api)
+        self._key = key
+        self._created = time.time()
+        if thread_stats:
+          thread_stats.IncrementStat('authentications', 1)
+        self._Save()
+      if self._state is None:
+        return copy.deepcopy(self._api)
+      return self._Build(self._state)
+    finally:
+      self._lock.release()
+
+  def Invalidate(self):
+    """ Forget the token, e.g. because Google has rejected it
+    """
+    self._lock.acquire()
+    try:
+      self._api = None
+      self._state = None
+      self._key = None
+    finally:
+      self._lock.release()
+
+  def _IsFresh(self, key):
+    return ((self._api is not None or self._state is not None) and
+            self._key == key and
+            time.time() < self._created + TOKEN_LIFETIME - TOKEN_REFRESH)
+
+  def _Build(self, state):
+    """ A new API object with the given attributes, without
+    authenticating
+    """
+    cls = self._api_module.API
+    api = cls.__new__(cls)
+    api.__dict__.update(state)
+    return api
+
+  def _Load(self, key):
+    """ Read the state saved by an earlier run, if it's for the same
+    credentials and still fresh.  The first line of the file is a digest
+    of the credentials, the second the time of authentication, and each
+    of the others an attribute: its name, the letter for its type, and
+    its value in base64.
+    """
+    if not self.token_file or not os.path.exists(self.token_file):
+      return
+    try:
+      f = open(self.token_file, 'r')
+      try:
+        lines = f.read().splitlines()
+      finally:
+        f.close()
+      if lines[0] != _Digest(key):
+        return
+      created = float(lines[1])
+      state = {}
+      for line in lines[2:]:
+        (name, kind, val) = line.split(' ')
+        state[name] = _Decode(kind, base64.b64decode(val), key[1])
+    except Exception, e:
+      logging.info('Cannot read %s: %s' % (self.token_file, str(e)))
+      return
+    (self._api, self._state) = (None, state)
+    (self._key, self._created) = (key, created)
+
+  def _Save(self):
+    """ Save the state for the next run, if there's a file for it and
+    the API object can be rebuilt from it
+    """
+    if not self.token_file or self._state is None:
+      return
+    lines = [_Digest(self._key), repr(self._created)]
+    for (name, val) in self._state.iteritems():
+      if val == self._key[1]:
+        (kind, val) = (_PASSWORD, '')
+      else:
+        kind = _PLAIN_TYPES[type(val)]
+      if kind == 'u':
+        val = val.encode('utf-8')
+      lines.append('%s %s %s' % (name, kind, base64.b64encode(str(val))))
+    try:
+      fd = os.open(self.token_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                   0600)
+      os.chmod(self.token_file, 0600)
+      f = os.fdopen(fd, 'w')
+      try:
+        f.write('%s\n' % '\n'.join(lines))
+      finally:
+        f.close()
+    except Exception, e:
+      logging.warn('Cannot save the token in %s: %s' % (self.token_file,
+                                                         str(e)))
+
+
+def _PlainState(api):
+  """ The attributes of an API object, if they're all of _PLAIN_TYPES
+  Returns:
+    dictionary of the attributes, or None
+  """
+  state = getattr(api, '__dict__', None)
+  if state is None:
+    return None
+  for val in state.itervalues():
+    if type(val) not in _PLAIN_TYPES:
+      return None
+  return state.copy()
+
+def _Decode(kind, val, password):
+  """ An attribute's value, from what _Save() wrote
+  """
+  if kind == _PASSWORD:
+    return password
+  if kind == 'n':
+    return None
+  if kind == 'b':
+    return val == 'True'
+  if kind == 'i':
+    return int(val)
+  if kind == 'u':
+    return val.decode('utf-8')
+  return val
+
+def _Digest(key):
+  """ What's saved to identify the credentials, so the password itself
+  isn't written to the token file
+  """
+  return sha.new(repr(key)).hexdigest()
+
+if __name__ == '__main__':
+  pass
@@ -23,6 +23,8 @@
 
 import google_action
 import logging
+import random
+import sha
 import userdb
 from google.appsforyourdomain import provisioning
 from google.appsforyourdomain import provisioning_errs
@@ -58,12 +60,13 @@ class UpdatedUserGoogleAction(google_action.GoogleAction):
     self.dn = dn
     self.attrs = attrs
     try:
-      Update(self._api, attrs)
+      pushed = Update(self._api, attrs)
 
       # report success
       logging.debug('updated %s' % self.attrs['GoogleUsername'])
       self._thread_stats.IncrementStat('updates', 1)
-      self._result_queue.PutResult(self.dn, 'updated', None, attrs)
+      self._result_queue.PutResult(self.dn, 'updated', None,
+                                   WithPushed(attrs, pushed))
 
     except provisioning_errs.ProvisioningApiError, e:
       # report failure
@@ -76,23 +79,99 @@ class UpdatedUserGoogleAction(google_action.GoogleAction):
       self._thread_stats.IncrementStat('update_fails', 1)
       self._result_queue.PutResult(self.dn, 'added', str(e))
 
-def Update(api, attrs):
-  """ Update the Google Account given by dn with attrs.
+# the Google account fields, and the attributes they're set from
+MAPPING_FOR_UPDATES = {'firstName': 'GoogleFirstName',
+                       'lastName': 'GoogleLastName',
+                       'password': 'GooglePassword'}
+
+def Update(api, attrs, force=False):
+  """ Update the Google Account given by dn with attrs.  Only the fields
+  which differ from what was last pushed to Google (according to the
+  user's meta-Google-pushed attribute) are sent, and if none do, there's
+  no call at all.
   Args:
     attrs: dictionary of all the user's attributes
+    force: if True, send every field, whatever meta-Google-pushed says,
+      e.g. for an account which this tool didn't find the way it left it
+  Returns:
+    the new value for the user's meta-Google-pushed attribute
+  """
+  fields = AccountFields(attrs)
+  (salt, digests) = _ParsePushed(attrs.get('meta-Google-pushed'))
+  changed = {}
+  for (key, val) in fields.iteritems():
+    if (force or key not in digests or
+        digests[key] != _Digest(salt, key, val)):
+      changed[key] = val
+  if not changed:
+    logging.debug('nothing to update for %s' % attrs['GoogleUsername'])
+  else:
+    logging.debug('about to UpdateAccount for %s: %s' %
+                  (attrs['GoogleUsername'], ', '.join(changed.keys())))
+    api.UpdateAccount(attrs['GoogleUsername'], changed)
+  return Pushed(fields, salt)
+
+def AccountFields(attrs):
+  """ The Google account fields for a user
+  Args:
+    attrs: dictionary of all the user's attributes
+  Returns:
+    dictionary of field name to value, for those which are set
   """
-  mapping_for_updates = {'firstName': 'GoogleFirstName', 
-                         'lastName': 'GoogleLastName',
-                         'password': 'GooglePassword'}
   fields = {}
-  for (key, google_key) in mapping_for_updates.iteritems():
+  for (key, google_key) in MAPPING_FOR_UPDATES.iteritems():
     if google_key in attrs and attrs[google_key]:
       if key == 'password':
         fields[key] = attrs[google_key]
       else:
         fields[key] = userdb.toUnicode(attrs[google_key])
-  logging.debug('about to UpdateAccount for %s' % attrs['GoogleUsername'])
-  api.UpdateAccount(attrs['GoogleUsername'], fields)
+  return fields
+
+def Pushed(fields, salt=None):
+  """ The value of meta-Google-pushed recording that 'fields' are what
+  Google has.  It holds a salted digest of each field, so the values
+  themselves (passwords in particular) aren't kept:
+    <salt>;<field>=<digest>;...
+  Args:
+    fields: as returned by AccountFields()
+    salt: the salt to use; a new one if None
+  Returns:
+    string
+  """
+  if not salt:
+    salt = '%08x' % random.getrandbits(32)
+  parts = [salt]
+  keys = fields.keys()
+  keys.sort()
+  for key in keys:
+    parts.append('%s=%s' % (key, _Digest(salt, key, fields[key])))
+  return ';'.join(parts)
+
+def WithPushed(attrs, pushed):
+  """ A copy of a user's attributes, with meta-Google-pushed set, to hand
+  back to the GoogleResultHandler
+  """
+  result = attrs.copy()
+  result['meta-Google-pushed'] = pushed
+  return result
+
+def _ParsePushed(pushed):
+  """ Split a meta-Google-pushed value into its salt, and a dictionary
+  of field name to digest
+  """
+  if not pushed:
+    return (None, {})
+  parts = pushed.split(';')
+  digests = {}
+  for part in parts[1:]:
+    (key, digest) = part.split('=', 1)
+    digests[key] = digest
+  return (parts[0], digests)
+
+def _Digest(salt, key, val):
+  if type(val) is unicode:
+    val = val.encode('utf-8')
+  return sha.new('%s\0%s\0%s' % (salt, key, val)).hexdigest()
 
 if __name__ == '__main__':
   pass
@@ -67,6 +67,34 @@ def NameSplit(given_name, surname, display_name):
     lastname = ' '.join(pieces[-(num_pieces-split_point):])
     return (firstname, lastname)
 
+class _AttributeProbe(dict):
+  """ Stands in for a user's ldap attributes, recording which ones are
+  looked at.  It has none of them as far as 'in' and get() are
+  concerned, and anything read with [] is the attribute's own name.
+  """
+
+  def __init__(self):
+    dict.__init__(self)
+    self.read = []
+    self.tested = []
+
+  def __contains__(self, attr):
+    if attr not in self.tested:
+      self.tested.append(attr)
+    return False
+
+  def has_key(self, attr):
+    return self.__contains__(attr)
+
+  def get(self, attr, default=None):
+    self.__contains__(attr)
+    return default
+
+  def __getitem__(self, attr):
+    if attr not in self.read:
+      self.read.append(attr)
+    return attr
+
 class UserTransformationRule(object):
   """Defines a rule that maps ldap attributes to Google Apps."""
 
@@ -164,6 +192,44 @@ class UserTransformationRule(object):
     except NameError:
       return attrs[callback_name]
 
+  def Attributes(self):
+    """ Return a list of the ldap attributes the callbacks read
+    unconditionally, so that they get fetched from ldap.  These are found
+    by running the callbacks on a stand-in for a user's attributes.
+
+    Returns:
+      a list of ldap attribute names.
+    """
+    return self._Probe().read
+
+  def OptionalAttributes(self):
+    """ Return a list of the ldap attributes the callbacks only use if the
+    user has them (e.g. sAMAccountName, for AD users without mail).
+
+    Returns:
+      a list of ldap attribute names.
+    """
+    probe = self._Probe()
+    return [attr for attr in probe.tested if attr not in probe.read]
+
+  def _Probe(self):
+    """ Run each callback on an _AttributeProbe, which has none of the
+    attributes the callbacks test for, and a placeholder value for any
+    they read regardless.
+
+    Returns:
+      the _AttributeProbe
+    """
+    probe = _AttributeProbe()
+    for attr in self.google_attributes:
+      callback = getattr(self, attr, None)
+      if callable(callback):
+        try:
+          callback(probe)
+        except Exception:
+          pass
+    return probe
+
   def Callbacks(self):
     """ Return a list of all callback function names.
 
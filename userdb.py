@@ -34,10 +34,12 @@ Methods not tied to a UserDB instance:
   SuggestTimestamp
 
 class UserDB: the main class
+class LdapRecord: one user's attributes from LDAP, de-listified lazily
 """
 
 import codecs
 import csv
+import last_update_time
 import logging
 import messages
 import os
@@ -51,6 +53,7 @@ import user_transformation_rule
 import xml.dom
 import xml.dom.minidom
 import base64
+import binascii
 from xml.sax._exceptions import *
 
 
@@ -196,6 +199,71 @@ def AttrListCompare(attrList, first, second):
   return 0
 
 
+class LdapRecord(dict):
+  """ A user's attributes as returned by an LDAP search, where every value
+  is a list.  A single value is "de-listified", i.e. ['Fred'] becomes
+  'Fred', the first time it's asked for, rather than every value of
+  every user being converted up front.  Values which have been set,
+  rather than come from LDAP, are never lists of one.
+
+  Only the methods below de-listify.  Python copies a dict subclass's
+  contents directly for dict(record) and other_dict.update(record),
+  which can't be overridden, so those see the lists; a copy is taken
+  with record.copy() or dict(record.iteritems()) instead.
+  """
+
+  def __getitem__(self, attr):
+    val = dict.__getitem__(self, attr)
+    if type(val) is types.ListType and len(val) == 1:
+      val = val[0]
+      dict.__setitem__(self, attr, val)
+    return val
+
+  def __eq__(self, other):
+    return dict(self.iteritems()) == other
+
+  def __ne__(self, other):
+    return not self.__eq__(other)
+
+  def __repr__(self):
+    return repr(dict(self.iteritems()))
+
+  def copy(self):
+    return LdapRecord(self)
+
+  def get(self, attr, default=None):
+    if attr in self:
+      return self[attr]
+    return default
+
+  def items(self):
+    return list(self.iteritems())
+
+  def iteritems(self):
+    for attr in self.iterkeys():
+      yield (attr, self[attr])
+
+  def itervalues(self):
+    for attr in self.iterkeys():
+      yield self[attr]
+
+  def pop(self, attr, *default):
+    if attr in self:
+      val = self[attr]
+      del self[attr]
+      return val
+    return dict.pop(self, attr, *default)
+
+  def setdefault(self, attr, default=None):
+    if attr in self:
+      return self[attr]
+    self[attr] = default
+    return default
+
+  def values(self):
+    return list(self.itervalues())
+
+
 class UserDB(utils.Configurable):
   """ Canonical dictionary of users & their LDAP attributes. This is NOT
   identical to the data structure returned by the ldap package, and in
@@ -253,7 +321,8 @@ class UserDB(utils.Configurable):
                   'timestamp': messages.MSG_USERDB_TIMESTAMP}
 
   meta_attrs = frozenset(('meta-last-updated', 'meta-Google-action', 
-                          'meta-Google-old-username'))
+                          'meta-Google-old-username', 'meta-Google-pushed',
+                          'meta-ldap-source'))
 
   # these are all the "Google actions" there are:
   google_action_vals = frozenset(('added', 'exited', 'updated', 'renamed'))
@@ -295,6 +364,13 @@ class UserDB(utils.Configurable):
     self._config = config
     self.db = {}
 
+    # the sets of attribute names already merged into self.attrs by
+    # _UpdateAttrList, so it's done once per "schema" rather than per user;
+    # and the same names, in the order a user's record had them, which
+    # is quicker to check than building the set for every user
+    self._schemas = set()
+    self._schema_keys = set()
+
     # for thread-safe access from sync_google
     self._cond = threading.Condition()
 
@@ -391,6 +467,42 @@ class UserDB(utils.Configurable):
     lst.sort()
     return lst
 
+  def GetSearchAttributes(self):
+    """ Returns the attributes an LDAP search has to fetch for each user,
+    which is less than GetAttributes() (every attribute ever seen): the
+    attributes the user transformation rule reads, the timestamp and the
+    primary key, plus those of the names used by the mapping expressions
+    and tested for by the rule which the directory has been seen to have
+    (sAMAccountName, for instance, only on AD).
+    Returns:
+      sorted list of attribute names, or None (i.e. all of them) if
+      nothing is known yet of the directory's attributes
+    """
+    special = set([str(attr).lower() for attr in
+                   (self.timestamp, self.primary_key) if attr])
+    known = set([attr.lower() for attr in self.attrs]) - special
+    if not known:
+      return None
+    xform = user_transformation_rule.UserTransformationRule()
+    callbacks = set(xform.Callbacks())
+    names = list(xform.Attributes())
+    optional = list(xform.OptionalAttributes())
+    for expr in self.mapping.itervalues():
+      if expr and isinstance(expr, types.StringTypes):
+        optional.extend(_ExpressionNames(expr))
+    names.extend([name for name in optional if name.lower() in known])
+    for attr in (self.timestamp, self.primary_key):
+      if attr:
+        names.append(attr)
+    wanted = {}
+    for name in names:
+      if name in callbacks or name in self.mapping or name in self.meta_attrs:
+        continue
+      wanted.setdefault(name.lower(), str(name))
+    lst = wanted.values()
+    lst.sort()
+    return lst
+
   def GetTimestampAttributeName(self):
     """
     Returns:
@@ -401,13 +513,20 @@ class UserDB(utils.Configurable):
 
   def LookupAttrVal(self, attr, val):
     """ The slow & painful way of looking up a user.  This does a
-    sequential search.  Intended mainly for the syncOneUser command.
+    sequential search, ignoring case, unless 'attr' is the primary key
+    and 'val' is found in the primary key lookup as it is.  Intended
+    mainly for the syncOneUser command, which lower-cases what it's
+    given.
     Args:
       attr: name of attribute
       val: value of 'attr' to be looked up
     Return:
       dns: list of DNs of the users who were found
     """
+    if self.primary_key and attr == self.primary_key:
+      dn = self.primary_key_lookup.get(_PrimaryKeyValue(val))
+      if dn:
+        return [dn]
     dns = []
     for (dn, attrs) in self.db.iteritems():
       if attr in attrs:
@@ -453,6 +572,8 @@ class UserDB(utils.Configurable):
     a number of times.
     """
     self.attrs = set()
+    self._schemas = set()
+    self._schema_keys = set()
 
   def RemoveAttribute(self, attr):
     """ remove attribute from the set we maintain (and which
@@ -473,6 +594,8 @@ class UserDB(utils.Configurable):
       self.attrs.remove(attr)
     except KeyError:
       return 0
+    self._schemas = set()
+    self._schema_keys = set()
     count = 0
     for (dn, attrs) in self.db.iteritems():
       if attr in attrs:
@@ -772,31 +895,54 @@ class UserDB(utils.Configurable):
       logging.debug('ADD! new dn %s no primary key defined ' % dn)
       return 'added'
 
-  def FindDeletedUsers(self, ldap_context):
+  def FindDeletedUsers(self, ldap_context, ldap_users=None):
     """ Find the users in the database NOT in
     that list, which you'll presumably then mark for deletion from
     Google.
 
     Args:
       ldap_context : LdapContext
+      ldap_users : UserDB of all users currently in LDAP, if the caller
+        has already searched for them.  If None, ldap_context is searched.
     Return:
-      list of DNs who are not in ldap_users
+      list of DNs who are not in ldap_users, or None if the search
+      failed
     """
-    try:
-      ldap_users = ldap_context.Search(filter_arg=None, attrlist=[])
-    except RuntimeError,e:
-      logging.exception(str(e))
-      return
-    deleted = []
-    ldap_dns = ldap_users.UserDNs()
+    if ldap_users is None:
+      try:
+        ldap_users = ldap_context.Search(filter_arg=None, attrlist=[])
+      except RuntimeError,e:
+        logging.exception(str(e))
+        return
+      if ldap_users is None:
+        return
+    ldap_dns = set(ldap_users.UserDNs())
+    candidates = []
     for dn in self.UserDNs():
       if dn not in ldap_dns:
-        logging.debug("%s is a deletion candidate self.db[dn]=" % 
-            str(self.db[dn]))
-        if self.__IsMetaGoogleAction('previously-exited', dn):
-            logging.debug('Skipping exit.  Already exited %s' % dn)
-            continue
-        deleted.append(dn)
+        candidates.append(dn)
+    return self.FilterDeletedUsers(candidates)
+
+  def FilterDeletedUsers(self, dns):
+    """ Of a list of DNs which have gone from LDAP, find the ones in
+    the database which haven't already been exited.
+
+    Args:
+      dns : list of DNs no longer in LDAP
+    Return:
+      list of DNs to be marked for deletion from Google
+    """
+    deleted = []
+    for dn_arg in dns:
+      dn = dn_arg.lower()
+      if dn not in self.db:
+        continue
+      logging.debug("%s is a deletion candidate self.db[dn]=" % 
+          str(self.db[dn]))
+      if self.__IsMetaGoogleAction('previously-exited', dn):
+          logging.debug('Skipping exit.  Already exited %s' % dn)
+          continue
+      deleted.append(dn)
     return deleted
 
   def MergeUsers(self, userdbFromLdap):
@@ -812,7 +958,9 @@ class UserDB(utils.Configurable):
       dn = dn.lower()
       old_username = None
       meta_last_updated = None
+      pushed = None
       if dn in self.db:
+        pushed = self.db[dn].get('meta-Google-pushed')
         if 'meta-Google-old-username' in self.db[dn]:
           old_username = self.db[dn]['meta-Google-old-username']
           meta_last_updated = self.db[dn]['meta-last-updated']
@@ -831,6 +979,7 @@ class UserDB(utils.Configurable):
               logging.debug('Replacing old userdb entry %s with %s' % 
                   (dnInUserDb, dn))
               old_username = self.db[dnInUserDb]['GoogleUsername']
+              pushed = self.db[dnInUserDb].get('meta-Google-pushed')
               if 'meta-last-updated' in self.db[dnInUserDb]:
                 meta_last_updated = self.db[dnInUserDb]['meta-last-updated']
               self.DeleteUser(dnInUserDb)
@@ -840,8 +989,31 @@ class UserDB(utils.Configurable):
         self.db[dn]['meta-Google-old-username'] = old_username
       if meta_last_updated:
         self.db[dn]['meta-last-updated'] = meta_last_updated
+      if pushed:
+        self.db[dn]['meta-Google-pushed'] = pushed
       self._UpdateAttrList(attrs)
 
+  def RestoreUser(self, dn_arg, attrs):
+    """ Put back a user's whole record as it was saved, e.g. by a
+    progress_log.ProgressLog, replacing any record with the same DN or
+    primary key.  Unlike MergeUsers(), nothing is mapped and no
+    meta-attribute is carried over from the record replaced.
+    Args:
+      dn_arg: the user's DN
+      attrs: dictionary of all the user's attributes, meta-attributes
+        included
+    """
+    dn = dn_arg.lower()
+    if dn not in self.db:
+      dnInUserDb = self._FindPrimaryKey(attrs)
+      if dnInUserDb and dnInUserDb != dn:
+        self.DeleteUser(dnInUserDb)
+    else:
+      self._DeletePrimaryKey(self.db[dn])
+    self.db[dn] = attrs
+    self._UpdatePrimaryKeyLookup(dn, attrs)
+    self._UpdateAttrList(attrs)
+
   def SetMetaLastUpdated(self, dn, attrs):
     """Sets meta-last-updated field to the self.timestamp attribute in attrs.
     Args:
@@ -927,7 +1099,7 @@ class UserDB(utils.Configurable):
     for unused_i in xrange(count):
       dn = dns[random.randrange(len(dns))]
       attrs = self.db[dn]
-      copy_of_attrs = attrs.copy()
+      copy_of_attrs = dict(attrs.iteritems())
 
       if mapping in callbacks:
         callback_mapping = ldap_user_xform.Mapping(attrs)
@@ -1175,8 +1347,9 @@ class UserDB(utils.Configurable):
   """
   def _AddUsers(self, ldap_users, timestamp=None):
     """ Converts the returned value from an LDAP search into our dictionary
-    format. In the process, all attribute values are "de-listified", i.e.
-    ['Fred'] is converted to 'Fred'.
+    format. Each user's attributes become an LdapRecord, so that attribute
+    values are "de-listified", i.e. ['Fred'] is converted to 'Fred', as
+    they're used.
     Args:
       ldap_users : returned value from LdapContext.Search or AsyncSearch.
       timestamp : the desired value of the 'meta-last-updated' attribute
@@ -1195,9 +1368,7 @@ class UserDB(utils.Configurable):
       foundAny = True
       dn = dn.lower()
       self._UpdateAttrList(attrs)
-      for (attr, val) in attrs.iteritems():
-        if isinstance(val, types.ListType) and len(val) == 1:
-          attrs[attr] = val[0]
+      attrs = LdapRecord(attrs)
 
       self.db[dn] = self._MapUser(attrs)
       self._UpdatePrimaryKeyLookup(dn, attrs)
@@ -1211,9 +1382,11 @@ class UserDB(utils.Configurable):
     Args:
       attrs: dictionary of attributes about a user
     """
-    dn = self._FindPrimaryKey(attrs)
-    if dn:
-      del self.primary_key_lookup[attrs[self.primary_key]]
+    if not self.primary_key or self.primary_key not in attrs:
+      return
+    key = _PrimaryKeyValue(attrs[self.primary_key])
+    if key in self.primary_key_lookup:
+      del self.primary_key_lookup[key]
 
   def _FindPrimaryKey(self, attrs):
     """ For a (presumably) new set of attributes, see if it matches
@@ -1225,8 +1398,8 @@ class UserDB(utils.Configurable):
     """
     if not self.primary_key or self.primary_key not in attrs:
       return
-    if attrs[self.primary_key] in self.primary_key_lookup:
-      return self.primary_key_lookup[attrs[self.primary_key]]
+    return self.primary_key_lookup.get(
+        _PrimaryKeyValue(attrs[self.primary_key]))
 
   def _GoogleAttrsCompare(self, dn_arg, attrs):
     """ Compare the Google attributes (other than GoogleUsername)
@@ -1253,26 +1426,30 @@ class UserDB(utils.Configurable):
     Returns:
       dictionary with (mapped) Google attributes added
 
-    Coding note: the attrs.copy() below is because Python inserts a copy of the
-    globals "builtin" member if not already there!   This is quite unwelcome
-    since we want to use that object for other things.
+    Coding note: each expression is evaluated with a new dictionary of
+    just the attributes it names, since Python inserts a copy of the
+    globals "builtin" member if not already there!   This is quite
+    unwelcome since we want to use that object for other things.  It also
+    means only those attributes of an LdapRecord get de-listified.
     """
 
-    result = {}
-    for (attr, value) in attrs.iteritems():
-      result[attr] = value
+    result = attrs.copy()
 
     ldap_user_xform = user_transformation_rule.UserTransformationRule()
+    callback_mapping = None
     if ldap_user_xform.MeetsPrereqs(attrs):
       callback_mapping = ldap_user_xform.Mapping(attrs)
     # if there were a naming conflict, the Google attrs would trump:
     for (key, expr) in self.mapping.iteritems():
       if expr:
-        copy_of_attrs = attrs.copy()
-        if ldap_user_xform.MeetsPrereqs(attrs):
-          copy_of_attrs.update(callback_mapping)
+        expr_globals = {}
+        for name in _ExpressionNames(expr):
+          if name in attrs:
+            expr_globals[name] = attrs[name]
+        if callback_mapping:
+          expr_globals.update(callback_mapping)
         try:
-          attr_val = eval(expr, copy_of_attrs)
+          attr_val = eval(expr, expr_globals)
           if type(attr_val) is list:
             attr_val = attr_val[0]         # attr_val retyped! and values 
                                            # other than the 1st are ignored
@@ -1287,13 +1464,24 @@ class UserDB(utils.Configurable):
     return result
 
   def _UpdateAttrList(self, attrs):
-    """ Merge a set of attributes into UserDB's configured list
+    """ Merge a set of attributes into UserDB's configured list.  Each
+    distinct set of names is only merged once.
     Args:
       attrs : iterable list of attribute names
     """
+    key = tuple(attrs)
+    if key in self._schema_keys:
+      return
+    self._schema_keys.add(key)
+    schema = frozenset(key)
+    if schema in self._schemas:
+      return
+    self._schemas.add(schema)
     new_attrs = set()
-    # de-Unicode them all  
+    # de-Unicode them all, leaving out our own attributes
     for attr in attrs:
+      if attr in self.mapping or attr in self.meta_attrs:
+        continue
       new_attrs.add(str(attr))
     self.attrs = self.attrs.union(new_attrs)
 
@@ -1309,7 +1497,7 @@ class UserDB(utils.Configurable):
       return
     if self.primary_key not in attrs:
       return
-    self.primary_key_lookup[attrs[self.primary_key]] = dn
+    self.primary_key_lookup[_PrimaryKeyValue(attrs[self.primary_key])] = dn
 
 
   """
@@ -1388,17 +1576,62 @@ def toUnicode(value):
   except UnicodeDecodeError, e:
     return value.decode('utf8')
 
+# cache of _ExpressionNames(), since _MapUser needs it for every user
+_EXPRESSION_NAMES = {}
+
+def _ExpressionNames(expr):
+  """ The names used by a mapping expression, which include the LDAP
+  attributes it refers to.  Attribute and method names, as in
+  mail.split('@'), are included too, so callers should only take those
+  which are attributes the user (or the directory) has.
+  Args:
+    expr: a Python expression, as for UserDB.MapAttr
+  Returns:
+    list of names, empty if the expression doesn't compile
+  """
+  if expr in _EXPRESSION_NAMES:
+    return _EXPRESSION_NAMES[expr]
+  try:
+    code = compile(expr, '<mapping>', 'eval')
+  except SyntaxError:
+    return []
+  names = []
+  codes = [code]
+  while codes:
+    code = codes.pop()
+    names.extend(code.co_names)
+    # lambdas and the like have code objects of their own
+    codes.extend([const for const in code.co_consts
+                  if hasattr(const, 'co_names')])
+  _EXPRESSION_NAMES[expr] = names
+  return names
+
+# a binary GUID, as text: 32 hex digits, or 16 "\\XX" filter escapes
+_HEX_GUID_RE = re.compile(r'^(\\?[0-9a-fA-F]{2}){16}$')
+_HEX_PAIR_RE = re.compile('(..)')
+
+def _PrimaryKeyValue(value):
+  """ The key for a primary key value in the primary key lookup.  A
+  binary GUID (e.g. AD's objectGUID) is keyed by its 16 raw bytes, which
+  is also what it looks like when it's been read back from a data file,
+  or typed in as hex or as an escaped filter value.  Anything else is
+  used as it is.
+  Args:
+    value: the primary key attribute's value
+  Returns:
+    the key
+  """
+  if (isinstance(value, types.StringType) and len(value) != 16 and
+      _HEX_GUID_RE.match(value)):
+    return binascii.unhexlify(value.replace('\\', ''))
+  return value
+
 def _ConvertFromGuid(key):
-  return _GuidRange(key, 0, 15)
-
-def _GuidRange(key, start, end):
-  incr = 1
-  if start > end:
-    incr = -1
-  result = ""
-  for i in xrange(start, end + incr, incr):
-    result += '\\%s' % _GuidElement(key, i)
-  return result
-
-def _GuidElement(key, i):
-  return ('0%X' % ord(key[i]))[-2:]
+  """ Escape a binary GUID for use in an LDAP filter, e.g.
+  (objectGUID=\\4F\\2A...)
+  Args:
+    key: the 16 raw bytes
+  Returns:
+    the escaped value
+  """
+  return _HEX_PAIR_RE.sub(r'\\\1', binascii.hexlify(key).upper())